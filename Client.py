@@ -1,20 +1,195 @@
 import socket as skt
+import queue, random, struct, threading, time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from headers import MSG_SACK, SACK_STRUCT
+
+# a slow-down hint is honoured this long after the last reply that carried one
+SLOWDOWN_HOLD = 60.0
+# unclaimed ACKs/SACKs kept for the SACK window; older ones are dropped once it is full
+ACK_QUEUE_MAX = 256
+
+
+class SystemClock:
+    """Time and blocking waits for the client code: wall clock and real threads.
+
+    simulate.VirtualClock offers the same calls in virtual time, so the client
+    runs unchanged in the simulator.
+    """
+
+    sleep = staticmethod(time.sleep)
+    # last: the class attribute shadows the time module inside this class body
+    time = staticmethod(time.time)
+
+    @staticmethod
+    def result(fut, timeout):
+        """fut's result, or None if it is not resolved within timeout seconds."""
+        try:
+            return fut.result(timeout=timeout)
+        except FutureTimeout:
+            return None
+
+    @staticmethod
+    def get(q, timeout):
+        """Next item of q; raises queue.Empty after timeout seconds."""
+        return q.get(timeout=timeout)
+
+    @staticmethod
+    def spawn(target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+
+SYSTEM_CLOCK = SystemClock()
+
+
+class ReplyDispatcher:
+    """Single reader for a client socket.
+
+    Every datagram from the server is read by this one thread and routed by type:
+    an ACK (type 1) resolves the future registered for its seq, ALIVE (type 4)
+    resolves every pending heartbeat future, INIT_ACK (type 6) resolves the INIT
+    futures with the negotiated wire version, and anything else ACK-like (SACKs,
+    ACKs nobody is waiting for) goes to the `acks` queue, which keeps only the
+    newest ACK_QUEUE_MAX when nothing reads it (stop-and-wait, CLIENT_SACK=0).
+    Register a future before sending the packet it answers, so a fast reply
+    cannot be missed.
+
+    ALIVE, ACK and SACK replies from an overloaded server carry one extra byte, its
+    admission level (admission.py); slowdown() reports the latest one.
+
+    Without a socket no thread is started and the caller feeds replies to
+    dispatch() itself (simulate.py).
+    """
+
+    def __init__(self, sock, server_addr, clock=SYSTEM_CLOCK):
+        self.sock = sock
+        self.server_addr = server_addr
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.ack_futures = {}   # seq -> Future
+        self.alive_futures = []
+        self.init_futures = []
+        self.acks = queue.Queue(maxsize=ACK_QUEUE_MAX)
+        self.hint = 0
+        self.hint_at = 0.0
+        self.thread = None
+        if sock is not None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def expect_ack(self, seq):
+        with self.lock:
+            fut = self.ack_futures.get(seq)
+            if fut is None or fut.done():
+                fut = self.ack_futures[seq] = Future()
+            return fut
+
+    def cancel_ack(self, seq):
+        with self.lock:
+            self.ack_futures.pop(seq, None)
+
+    def expect_alive(self):
+        fut = Future()
+        with self.lock:
+            self.alive_futures.append(fut)
+        return fut
+
+    def expect_init_ack(self):
+        fut = Future()
+        with self.lock:
+            self.init_futures.append(fut)
+        return fut
+
+    def slowdown(self):
+        """Server's slow-down hint: 0 when none arrived within SLOWDOWN_HOLD seconds."""
+        if self.hint and self.clock.time() - self.hint_at > SLOWDOWN_HOLD:
+            self.hint = 0
+        return self.hint
+
+    def _note_hint(self, pkt, size):
+        # a reply without the extra byte means the server is no longer shedding
+        self.hint = pkt[size] if len(pkt) > size else 0
+        self.hint_at = self.clock.time()
+
+    def _run(self):
+        while True:
+            try:
+                pkt, addr = self.sock.recvfrom(1024)
+            except OSError:
+                # socket closed: wake nobody, the waiters time out
+                return
+            if addr != self.server_addr or not pkt:
+                continue
+            self.dispatch(pkt)
+
+    def dispatch(self, pkt):
+        """Route one non-empty reply from the server."""
+        t = pkt[0]
+        if t == 4:
+            self._note_hint(pkt, 1)
+            with self.lock:
+                waiting, self.alive_futures = self.alive_futures, []
+            for fut in waiting:
+                fut.set_result(True)
+        elif t == 6 and len(pkt) >= 2:
+            with self.lock:
+                waiting, self.init_futures = self.init_futures, []
+            for fut in waiting:
+                fut.set_result(pkt[1])
+        elif t == 1 and len(pkt) >= 5:
+            self._note_hint(pkt, 5)
+            seq = struct.unpack_from('!I', pkt, 1)[0]
+            with self.lock:
+                fut = self.ack_futures.pop(seq, None)
+            if fut is not None:
+                fut.set_result(pkt)
+            else:
+                self._queue_ack(pkt)
+        else:
+            if t == MSG_SACK and len(pkt) >= SACK_STRUCT.size:
+                self._note_hint(pkt, SACK_STRUCT.size)
+            self._queue_ack(pkt)
+
+    def _queue_ack(self, pkt):
+        while True:
+            try:
+                self.acks.put_nowait(pkt)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.acks.get_nowait()
+            except queue.Empty:
+                pass
+
 
 class Client:
-    def __init__(self, device_id, client_ip, client_port):
+    def __init__(self, device_id, client_ip, client_port, clock=SYSTEM_CLOCK, rng=random):
         self.device_id = device_id
         self.client_ip = client_ip
         self.client_port = client_port
+        # time and waits (SystemClock or simulate.VirtualClock), and the source of readings and boot ids
+        self.clock = clock
+        self.rng = rng
 
-        # Create socket for this client
-        self.sock = skt.socket(skt.AF_INET, skt.SOCK_DGRAM)
-        self.sock.bind((client_ip, client_port))
-
+        # Create socket for this client; without an address the caller provides the transport
+        # (self.netem with a send(packet, addr, seq) method) and feeds self.replies
+        self.sock = None
+        if client_ip is not None:
+            self.sock = skt.socket(skt.AF_INET, skt.SOCK_DGRAM)
+            self.sock.bind((client_ip, client_port))
+        self.replies = None
+        # wire format in use (wire.WIRE_V1 / WIRE_V2) and the v2 timestamp base, set by the INIT exchange
+        self.wire = 1
+        self.base_ms = 0
+        # per-socket netem.NetemScheduler, created on first send
+        self.netem = None
 
+    def start_receiver(self, server_addr):
+        """Start the socket's single reader; all replies are then taken from self.replies."""
+        if self.replies is None:
+            self.replies = ReplyDispatcher(self.sock, server_addr, self.clock)
+        return self.replies
 
     @staticmethod
     def create_client(ip, port, device_id):
         return Client(device_id, ip, port)
-
-
-
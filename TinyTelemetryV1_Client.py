@@ -1,215 +1,341 @@
-import socket as skt
-from headers import Header
-import threading, time, struct, os, random, sys
+from headers import Header, FLAG_SACK, MSG_SACK, SACK_STRUCT
+from seqnum import SEQ_MASK
+import wire
+from reliability import SackWindow
+import threading, time, struct, os, random, sys, queue
 from globals import server_IP, server_port, client_IP
-from Client import Client
-from collections import deque
-import heapq
+from Client import Client, SYSTEM_CLOCK
+from netem import NetemProfile, NetemScheduler
+from eventlog import event, log_totals, INFO, WARNING
 
 RUN_DURATION = int(os.getenv("RUN_DURATION", 50))
-start_time = time.time()
 
-SIMULATE_NETEM = os.getenv("SIMULATE_NETEM", "0") == "1"
-SIMULATE_LOSS = float(os.getenv("SIMULATE_LOSS", "0"))
-SIMULATE_DELAY_MS = float(os.getenv("SIMULATE_DELAY_MS", "0"))
-SIMULATE_JITTER_MS = float(os.getenv("SIMULATE_JITTER_MS", "0"))
-
-reorder_buffer = deque()
-reorder_lock = threading.Lock()
-
-# Scheduler queue for delayed sends: list of (send_time, seq, packet, addr)
-send_queue = []
-send_queue_lock = threading.Lock()
+# network impairment emulation (SIMULATE_NETEM, SIMULATE_LOSS, SIMULATE_DELAY_MS, ... see netem.NetemProfile)
+NETEM_PROFILE = NetemProfile.from_env()
+# log every scheduled/released packet (off by default: one line per packet is expensive)
+SIMULATE_VERBOSE = os.getenv("SIMULATE_VERBOSE", "0") == "1"
+
+# Reading batching: a DATA packet carries up to CLIENT_BATCH_MAX readings (payload <= CLIENT_BATCH_BYTES)
+# and is sent once its oldest reading is CLIENT_BATCH_LATENCY seconds old, or right away on a danger reading.
+# CLIENT_BATCH_MAX=1 sends one reading per packet.
+CLIENT_BATCH_MAX = max(1, int(os.getenv("CLIENT_BATCH_MAX", 5)))
+CLIENT_BATCH_BYTES = max(2, int(os.getenv("CLIENT_BATCH_BYTES", 512)))
+CLIENT_BATCH_LATENCY = float(os.getenv("CLIENT_BATCH_LATENCY", 20))
+# While the server's replies carry a slow-down hint (admission level L, see admission.py), batches
+# may hold 2**L times as many readings and wait 2**L times as long; danger readings still go at once.
+CLIENT_SLOWDOWN_MAX = 3
+READING_INTERVAL = 4
+
+# Windowed reliability for danger readings: keep up to CLIENT_SACK_WINDOW unacknowledged packets in
+# flight (per-packet RTO from measured RTT) and let the server answer with selective ACKs.
+# CLIENT_SACK=0 falls back to stop-and-wait: block on each danger packet until ACKed.
+CLIENT_SACK = os.getenv("CLIENT_SACK", "1") == "1"
+CLIENT_SACK_WINDOW = max(1, int(os.getenv("CLIENT_SACK_WINDOW", 32)))
+
+# Highest wire format to offer in INIT (2 = compact v2 frames, see wire.py). v1 is the
+# default: v2 is only smaller unbatched (see bench_wire.py) and decodes slower. INIT is
+# repeated until the server answers INIT_ACK, at most CLIENT_INIT_ATTEMPTS times; the
+# client stays on v1 if the server does not confirm v2.
+CLIENT_WIRE = int(os.getenv("CLIENT_WIRE", 1))
+CLIENT_INIT_ATTEMPTS = 3
+INIT_TIMEOUT = 1.0
+
+# heartbeat schedule: first after HEARTBEAT_FIRST s, then HEARTBEAT_INTERVAL s after each reply or
+# timeout; HEARTBEAT_MISSES unanswered in a row means the server is down
+HEARTBEAT_FIRST = 5
+HEARTBEAT_TIMEOUT = 5.0
+HEARTBEAT_INTERVAL = 30
+HEARTBEAT_MISSES = 3
+
+# per-packet log lines (eventlog.py: LOG_LEVEL, LOG_SAMPLE, LOG_FORMAT, ...)
+DATA_LOG = event('client.data', "[CLIENT {dev}] DATA seq={seq} val={value} danger={danger}")
+DATA_BATCH_LOG = event('client.data_batch', "[CLIENT {dev}] DATA seq={seq}..{last} vals={values} danger={danger}")
+ACK_LOG = event('client.ack', "[CLIENT {dev}] ACK seq={seq}")
+RETRANSMIT_LOG = event('client.retransmit', "[CLIENT {dev}] RETRANSMIT seq={seq} attempt={attempt} rto={rto:.3f}")
+GIVE_UP_LOG = event('client.give_up', "[CLIENT {dev}] WARNING: no ACK for seq={seq} after {attempts} attempts", WARNING)
+INIT_LOG = event('client.init', "[CLIENT {dev}] INIT sent{result}", INFO)
+MISSED_LOG = event('client.missed_heartbeat', "[CLIENT {dev}] Missed heartbeat reply {missed}", WARNING)
+SERVER_DOWN_LOG = event('client.server_down', "[CLIENT {dev}] Server appears down — stopping client threads", WARNING)
+SLOWDOWN_LOG = event('client.slowdown', "[CLIENT {dev}] Server slow-down hint {level}: batching x{scale}", INFO)
+SHUTDOWN_LOG = event('client.shutdown', "[CLIENT {dev}] Shutdown cleanly", INFO)
+
+
+class ClientProcess:
+    """Run window and server liveness shared by the devices of one client process.
+
+    Every function below takes its time and waits from client.clock, and the
+    devices' socket from client.netem / client.replies, so simulate.py runs them
+    in virtual time with one ClientProcess per simulated process.
+    """
+
+    def __init__(self, clock=SYSTEM_CLOCK, duration=RUN_DURATION, start_time=None):
+        self.clock = clock
+        self.duration = duration
+        self.start_time = clock.time() if start_time is None else start_time
+        # cleared by any device that stops hearing heartbeat replies
+        self.server_alive = True
+
+    def in_window(self):
+        return self.clock.time() - self.start_time < self.duration
+
+    def running(self):
+        return self.server_alive and self.in_window()
+
+
+PROCESS = ClientProcess()
+
+
+def custom_random(rnd=random):
+    return rnd.randint(51, 110) if rnd.random() < 0.10 else rnd.randint(1, 50)
+
+
+def batch_scale(level):
+    return 1 << min(level, CLIENT_SLOWDOWN_MAX)
+
+
+def netem_send(client, packet, addr, seq=None):
+    """Send or schedule a send through the client's netem scheduler. Returns True if sent or scheduled, False if dropped."""
+    if client.netem is None:
+        client.netem = NetemScheduler(client.sock, NETEM_PROFILE, verbose=SIMULATE_VERBOSE)
+    return client.netem.send(packet, addr, seq)
+
+
+def send_heartbeat(client, process=PROCESS):
+    clock = client.clock
+    clock.sleep(HEARTBEAT_FIRST)
+    missed = 0
+    while process.running():
+        if client.wire >= wire.WIRE_V2:
+            hb = wire.encode_heartbeat(client.device_id)
+        else:
+            hb = Header(device_id=client.device_id, msg_type=0, timestamp=clock.time()).heartbeat()
+        reply = client.replies.expect_alive()
+        netem_send(client, hb, (server_IP, server_port))
+        # wait for server alive reply (routed to us by the socket's dispatcher)
+        alive = clock.result(reply, HEARTBEAT_TIMEOUT)
+        if not alive:
+            missed += 1
+            if MISSED_LOG.enabled:
+                MISSED_LOG.emit(dev=client.device_id, missed=missed)
+            if missed >= HEARTBEAT_MISSES:
+                if SERVER_DOWN_LOG.enabled:
+                    SERVER_DOWN_LOG.emit(dev=client.device_id)
+                process.server_alive = False
+                break
+        else:
+            missed = 0
+        clock.sleep(HEARTBEAT_INTERVAL)
 
-# Server liveness flag
-SERVER_ALIVE = True
 
-# start a background thread to flush scheduled sends
-def _sender_thread(sock):
+def service_window(client, window, until):
+    """Process ACKs and retransmission timers for in-flight danger packets until `until`."""
+    addr = (server_IP, server_port)
+    clock = client.clock
+    acks = client.replies.acks
     while True:
-        now = time.time()
-        to_send = None
-        with send_queue_lock:
-            if send_queue and send_queue[0][0] <= now:
-                send_time, seq, packet, addr = heapq.heappop(send_queue)
-                to_send = (packet, addr, seq)
-        if to_send:
-            p, a, s = to_send
-            try:
-                sock.sendto(p, a)
-                # indicate release from netem scheduler
-                print(f"[NETEM RELEASE] seq={s} sent to {a}")
-            except Exception:
-                pass
+        now = clock.time()
+        resend, dropped = window.due(now)
+        for p in resend:
+            netem_send(client, p.packet, addr, p.seq)
+            if RETRANSMIT_LOG.enabled:
+                RETRANSMIT_LOG.emit(dev=client.device_id, seq=p.seq, attempt=p.attempts, rto=window.rto)
+        for p in dropped:
+            if GIVE_UP_LOG.enabled:
+                GIVE_UP_LOG.emit(dev=client.device_id, seq=p.seq, attempts=p.attempts)
+        if now >= until:
+            return
+        deadline = window.next_deadline()
+        wait_until = until if deadline is None else min(until, deadline)
+        try:
+            pkt = clock.get(acks, max(0.001, wait_until - now))
+        except queue.Empty:
             continue
-        time.sleep(0.01)
-
-# We'll start the sender thread lazily when first needed
-_sender_started = False
-
-
-def custom_random():
-    return random.randint(51, 110) if random.random() < 0.10 else random.randint(1, 50)
-
-
-def maybe_recv_ack(sock, expected_addr, expected_seq=None, timeout=1.0):
-    prev = sock.gettimeout()
-    sock.settimeout(timeout)
-    try:
-        pkt, a = sock.recvfrom(1024)
-        if a != expected_addr:
-            return False
-        if len(pkt) >= 5:
-            t = pkt[0]
+        if pkt[0] == MSG_SACK and len(pkt) >= SACK_STRUCT.size:
+            for seq in window.on_sack(pkt, clock.time()):
+                if ACK_LOG.enabled:
+                    ACK_LOG.emit(dev=client.device_id, seq=seq)
+        elif pkt[0] == 1 and len(pkt) >= 5:
             seq = struct.unpack('!I', pkt[1:5])[0]
-            return t == 1 and (expected_seq is None or seq == expected_seq)
-        return False
-    except Exception:
-        return False
-    finally:
-        sock.settimeout(prev)
-
-
-def maybe_recv_alive(sock, expected_addr, timeout=5.0):
-    prev = sock.gettimeout()
-    sock.settimeout(timeout)
-    try:
-        pkt, a = sock.recvfrom(1024)
-        if a != expected_addr:
-            return False
-        if len(pkt) >= 1:
-            t = pkt[0]
-            return t == 4
-        return False
-    except Exception:
-        return False
-    finally:
-        sock.settimeout(prev)
-
-
-def netem_send(sock, packet, addr, seq=None):
-    """Send or schedule a send. Returns True if sent or scheduled, False if dropped."""
-    global _sender_started
-    # Simulated loss
-    if SIMULATE_NETEM and SIMULATE_LOSS > 0 and random.random() < SIMULATE_LOSS:
-        print(f"[SIM NETEM] DROPPED seq={seq}")
-        return False
-
-    # If not simulating delay, send immediately
-    if not (SIMULATE_NETEM and SIMULATE_DELAY_MS > 0 and seq is not None):
-        try:
-            sock.sendto(packet, addr)
-            return True
-        except Exception:
-            return False
+            if window.on_ack(seq, clock.time()) and ACK_LOG.enabled:
+                ACK_LOG.emit(dev=client.device_id, seq=seq)
+
+
+def send_init(client):
+    """Send INIT with a fresh boot id and negotiate the wire format. Sets client.wire."""
+    # fresh boot id per start, so the server opens a new stream even though seq restarts at 0
+    clock = client.clock
+    boot_id = client.rng.getrandbits(32)
+    client.base_ms = int(clock.time() * 1000)
+    # the server answers even a v1-only INIT, so a lost one is retried like a v2 offer
+    init = wire.encode_init(client.device_id, boot_id, client.base_ms, max(CLIENT_WIRE, wire.WIRE_V1))
+    for attempt in range(CLIENT_INIT_ATTEMPTS):
+        ack = client.replies.expect_init_ack()
+        netem_send(client, init, (server_IP, server_port))
+        version = clock.result(ack, INIT_TIMEOUT)
+        if version:
+            client.wire = version
+            if INIT_LOG.enabled:
+                INIT_LOG.emit(dev=client.device_id, result=f", wire v{version}")
+            return
+    if INIT_LOG.enabled:
+        INIT_LOG.emit(dev=client.device_id, result=", no INIT_ACK: staying on wire v1")
+
+
+def encode_batch(client, first_seq, values, flags, stamps):
+    """DATA packet for a batch in the client's negotiated wire format.
+
+    v1 carries one timestamp for the whole batch: the time of its first reading.
+    """
+    if client.wire >= wire.WIRE_V2:
+        return wire.encode_data(client.device_id, first_seq, flags, client.base_ms, stamps, values)
+    h = Header(device_id=client.device_id, seq_num=first_seq, msg_type=1, flags=flags,
+               timestamp=stamps[0] / 1000.0 if stamps else None)
+    return h.Pack_Message() + struct.pack(f"!{len(values)}H", *values)
+
+
+def send_batch(client, first_seq, values, window=None, stamps=None, process=PROCESS):
+    """Send buffered readings as one DATA packet (reading i has seq first_seq + i).
+
+    stamps are the readings' times in ms, used by the v2 wire format.
+
+    With a SackWindow a danger packet is tracked and retransmitted in the background;
+    without one the call blocks until it is ACKed (stop-and-wait).
+    """
+    danger = 1 if any(v >= 60 for v in values) else 0
+    flags = danger | (FLAG_SACK if window is not None else 0)
+    pkt = encode_batch(client, first_seq, values, flags, stamps)
+    seq = first_seq
+    clock = client.clock
+
+    if danger and window is not None:
+        # bounded window: wait for ACKs (or give-ups) before adding another packet
+        while window.full():
+            service_window(client, window, clock.time() + 0.05)
+        sent = netem_send(client, pkt, (server_IP, server_port), seq)
+        window.track(seq, (seq + len(values) - 1) & SEQ_MASK, pkt, clock.time())
+    else:
+        if danger:
+            ack = client.replies.expect_ack(seq)
+        sent = netem_send(client, pkt, (server_IP, server_port), seq)
+
+    if danger and window is None:
+        attempts = 0
+        timeout = 1.0
+        max_attempts = 5
+        while attempts < max_attempts and process.in_window():
+            got = clock.result(ack, timeout)
+            if got:
+                if ACK_LOG.enabled:
+                    ACK_LOG.emit(dev=client.device_id, seq=seq)
+                break
+            attempts += 1
+            timeout = min(4.0, timeout * 2)
+            sent = netem_send(client, pkt, (server_IP, server_port), seq)
+        else:
+            client.replies.cancel_ack(seq)
+            if GIVE_UP_LOG.enabled:
+                GIVE_UP_LOG.emit(dev=client.device_id, seq=seq, attempts=attempts)
 
-    # Ensure sender thread running
-    if not _sender_started:
-        t = threading.Thread(target=_sender_thread, args=(sock,), daemon=True)
-        t.start()
-        _sender_started = True
+    # Log only when packet was actually sent/scheduled
+    if sent:
+        if len(values) == 1:
+            if DATA_LOG.enabled:
+                DATA_LOG.emit(dev=client.device_id, seq=seq, value=values[0], danger=danger)
+        elif DATA_BATCH_LOG.enabled:
+            DATA_BATCH_LOG.emit(dev=client.device_id, seq=seq, last=seq + len(values) - 1, values=values, danger=danger)
 
-    # Compute target send time using base delay + jitter
-    jitter = random.uniform(-SIMULATE_JITTER_MS, SIMULATE_JITTER_MS)
-    delay_ms = SIMULATE_DELAY_MS + jitter
-    # occasional reordering by increasing delay for this packet
-    if random.random() < 0.3:
-        delay_ms += random.uniform(0, SIMULATE_DELAY_MS * 2)
 
-    send_time = time.time() + max(0.0, delay_ms / 1000.0)
+def client_thread(client, process=PROCESS):
+    seq = 0
+    max_batch = min(CLIENT_BATCH_MAX, CLIENT_BATCH_BYTES // 2)
+    clock = client.clock
 
-    with send_queue_lock:
-        heapq.heappush(send_queue, (send_time, seq if seq is not None else 0, packet, addr))
+    # one reader per socket; heartbeat and data paths wait on futures/queues instead of recvfrom
+    client.start_receiver((server_IP, server_port))
+    if client.netem is None:
+        client.netem = NetemScheduler(client.sock, NETEM_PROFILE, verbose=SIMULATE_VERBOSE)
 
-    # log that packet was scheduled (held)
-    print(f"[NETEM SCHEDULE] seq={seq} delay_ms={delay_ms:.1f} target={send_time:.3f}")
-    return True
+    send_init(client)
 
+    clock.spawn(send_heartbeat, client, process)
 
-def send_heartbeat(client):
-    global SERVER_ALIVE
-    time.sleep(5)
-    missed = 0
-    while time.time() - start_time < RUN_DURATION and SERVER_ALIVE:
-        hb = Header(device_id=client.device_id, msg_type=0).heartbeat()
-        netem_send(client.sock, hb, (server_IP, server_port))
-        # wait for server alive reply
-        alive = maybe_recv_alive(client.sock, (server_IP, server_port), timeout=5.0)
-        if not alive:
-            missed += 1
-            print(f"[CLIENT {client.device_id}] Missed heartbeat reply {missed}")
-            if missed >= 3:
-                print(f"[CLIENT {client.device_id}] Server appears down — stopping client threads")
-                SERVER_ALIVE = False
-                break
-        else:
-            missed = 0
-        time.sleep(30)
+    window = SackWindow(CLIENT_SACK_WINDOW) if CLIENT_SACK else None
+    pending = []       # buffered reading values
+    stamps = []        # and their times in ms
+    batch_seq = 0      # seq of pending[0]
+    batch_deadline = 0.0
+    batch_limit = max_batch
+    scale = 1
 
+    while process.running():
+        value = custom_random(client.rng)
+        danger = 1 if value >= 60 else 0
 
-def client_thread(client):
-    seq = 0
+        if not pending:
+            batch_seq = seq
+            level = client.replies.slowdown()
+            if batch_scale(level) != scale:
+                scale = batch_scale(level)
+                if SLOWDOWN_LOG.enabled:
+                    SLOWDOWN_LOG.emit(dev=client.device_id, level=level, scale=scale)
+            batch_limit = min(max_batch * scale, CLIENT_BATCH_BYTES // 2)
+            batch_deadline = clock.time() + CLIENT_BATCH_LATENCY * scale
+        pending.append(value)
+        stamps.append(int(clock.time() * 1000))
+        seq = (seq + 1) & SEQ_MASK
+
+        if danger or len(pending) >= batch_limit or clock.time() >= batch_deadline:
+            send_batch(client, batch_seq, pending, window, stamps, process)
+            pending, stamps = [], []
+
+        # sleep until the next reading, flushing early if the batch latency bound expires first
+        next_reading = clock.time() + READING_INTERVAL
+        while clock.time() < next_reading:
+            if pending and clock.time() >= batch_deadline:
+                send_batch(client, batch_seq, pending, window, stamps, process)
+                pending, stamps = [], []
+            wake = min(next_reading, batch_deadline) if pending else next_reading
+            if window is not None:
+                service_window(client, window, wake)
+            else:
+                clock.sleep(max(0.0, wake - clock.time()))
 
-    init = Header(device_id=client.device_id, msg_type=2).Pack_Init()
-    netem_send(client.sock, init, (server_IP, server_port))
-    print(f"[CLIENT {client.device_id}] INIT sent")
+    if pending and process.server_alive:
+        send_batch(client, batch_seq, pending, window, stamps, process)
 
-    threading.Thread(target=send_heartbeat, args=(client,), daemon=True).start()
+    if client.sock is not None:
+        try:
+            client.sock.close()
+        except Exception:
+            pass
+    if SHUTDOWN_LOG.enabled:
+        SHUTDOWN_LOG.emit(dev=client.device_id)
 
-    while time.time() - start_time < RUN_DURATION and SERVER_ALIVE:
-        value = custom_random()
-        danger = 1 if value >= 60 else 0
 
-        h = Header(device_id=client.device_id, seq_num=seq, msg_type=1, flags=(1 if danger else 0))
-        pkt = h.Pack_Message() + struct.pack("!H", value)
+CLIENT_DEVICES = (101, 102, 103)
+# seconds between starting consecutive devices
+CLIENT_STAGGER = 0.5
 
-        sent = netem_send(client.sock, pkt, (server_IP, server_port), seq)
 
-        if danger:
-            attempts = 0
-            timeout = 1.0
-            max_attempts = 5
-            while attempts < max_attempts and time.time() - start_time < RUN_DURATION:
-                got = maybe_recv_ack(client.sock, (server_IP, server_port), expected_seq=seq, timeout=timeout)
-                if got:
-                    print(f"[CLIENT {client.device_id}] ACK seq={seq}")
-                    break
-                attempts += 1
-                timeout = min(4.0, timeout * 2)
-                sent = netem_send(client.sock, pkt, (server_IP, server_port), seq)
-            else:
-                print(f"[CLIENT {client.device_id}] WARNING: no ACK for seq={seq} after {attempts} attempts")
+def main():
+    clients = [Client(device_id, client_IP, 0) for device_id in CLIENT_DEVICES]
 
-        # Log only when packet was actually sent/scheduled
-        if sent:
-            print(f"[CLIENT {client.device_id}] DATA seq={seq} val={value} danger={danger}")
-        seq += 1
-        time.sleep(4)
+    for c in clients:
+        threading.Thread(target=client_thread, args=(c,), daemon=True).start()
+        time.sleep(CLIENT_STAGGER)
 
     try:
-        client.sock.close()
-    except Exception:
+        while PROCESS.running():
+            time.sleep(1)
+    except KeyboardInterrupt:
         pass
-    print(f"[CLIENT {client.device_id}] Shutdown cleanly")
-
-
-clients = [
-    Client(101, client_IP, 0),
-    Client(102, client_IP, 0),
-    Client(103, client_IP, 0),
-]
 
-for c in clients:
-    threading.Thread(target=client_thread, args=(c,), daemon=True).start()
-    time.sleep(0.5)
+    log_totals()
+    if not PROCESS.server_alive:
+        print("Server detected down — exiting client process")
 
-try:
-    while time.time() - start_time < RUN_DURATION and SERVER_ALIVE:
-        time.sleep(1)
-except KeyboardInterrupt:
-    pass
+    sys.exit(0)
 
-if not SERVER_ALIVE:
-    print("Server detected down — exiting client process")
 
-sys.exit(0)
+if __name__ == "__main__":
+    main()
@@ -1,410 +1,442 @@
 import socket as skt
-from headers import Header
-import csv, time, struct, os
+import asyncio, csv, ctypes, json, time, struct, os, queue, select, sys
+import multiprocessing as mp
 from globals import server_IP, server_port
-import matplotlib.pyplot as plt
+from ingest import IngestState, merge_counters, derived_metrics
+from rx import BatchReceiver
+from sinks import CsvSink, CSV_HEADER, SINK_CLOSE_TIMEOUT
+from storage import SegmentSink
+from server_engine import TelemetryServer
+from wire import device_id_of
+from metrics import MetricsExporter, METRICS_PORT, METRICS_JSON
+from profiling import CaptureControl, forward_signals, print_stages
+from eventlog import log_totals
+from rollup import RollupStore, ROLLUP_DIR
+from admission import AdmissionControl
 
 RUN_DURATION = int(os.getenv("RUN_DURATION", 75))
+# number of ingest worker processes sharing the UDP port (SO_REUSEPORT); 1 = single process
+SERVER_WORKERS = max(1, int(os.getenv("SERVER_WORKERS", 1)))
+# single-process engine: 'loop' (select + batched drain) or 'asyncio' (server_engine.TelemetryServer)
+SERVER_ENGINE = os.getenv("SERVER_ENGINE", "loop").lower()
+# seconds past RUN_DURATION + SINK_CLOSE_TIMEOUT the parent waits for a worker's report
+WORKER_REPORT_GRACE = float(os.getenv("WORKER_REPORT_GRACE", 10))
 
+# reading output: 'csv' (PACKETS_CSV) or 'binary' (rotating segment files under PACKETS_DIR)
+PACKETS_SINK = os.getenv("PACKETS_SINK", "csv").lower()
+PACKETS_DIR = os.getenv("PACKETS_DIR", "segments")
 
 snapshot_points = [10, 30, 60]
-snapshots_taken = set()
 
-snap_time = []
-snap_bytes = []
-snap_dup_rate = []
-snap_loss = []
-snap_cpu = []
+# forwarded datagram prefix: client IPv4 address + port
+FWD_ADDR = struct.Struct('!4sH')
 
-# -------------------------
-# Socket setup
-# -------------------------
-server_socket = skt.socket(skt.AF_INET, skt.SOCK_DGRAM)
-server_socket.bind((server_IP, server_port))
-server_socket.settimeout(0.5)
+# Linux: a classic BPF program on the SO_REUSEPORT group returns the index (bind order) of
+# the socket that gets the datagram. It runs on the UDP payload.
+SO_ATTACH_REUSEPORT_CBPF = getattr(skt, 'SO_ATTACH_REUSEPORT_CBPF', 51)
+BPF_INSN = struct.Struct('HBBI')
+BPF_PROG = struct.Struct('HP')
 
-print(f"[SERVER] Listening on UDP {server_IP}:{server_port}")
 
 # -------------------------
-# CSV setup
+# Socket setup
 # -------------------------
-# CSV path: allow override via PACKETS_CSV env var. If opening fails, fall back to /tmp
-csv_path = os.getenv('PACKETS_CSV', 'temp.csv')
-try:
-    csv_dir = os.path.dirname(csv_path)
-    if csv_dir:
-        os.makedirs(csv_dir, exist_ok=True)
-    temp_csv = open(csv_path, 'w', newline='')
-except Exception:
-    # fallback to /tmp/<project>/tests/packets.csv
-    fallback_base = os.path.join('/tmp', os.path.basename(os.getcwd()))
+def make_server_socket(reuse_port=False):
+    sock = skt.socket(skt.AF_INET, skt.SOCK_DGRAM)
+    if reuse_port:
+        sock.setsockopt(skt.SOL_SOCKET, skt.SO_REUSEPORT, 1)
+    sock.bind((server_IP, server_port))
+    return sock
+
+
+def steer_by_device(sock, workers):
+    """Make the kernel deliver each datagram to socket device_id % workers of sock's group.
+
+    Matches wire.device_id_of: device_id is at offset 0 (v1) or 2 (v2 marker 0xFF).
+    Returns False where the program cannot be attached; forwarding then covers it.
+    """
+    program = [
+        (0x30, 0, 0, 0),        # ldb [0]
+        (0x15, 2, 0, 0xFF),     # jeq #0xff -> v2
+        (0x28, 0, 0, 0),        # ldh [0]
+        (0x05, 0, 0, 1),        # ja mod
+        (0x28, 0, 0, 2),        # v2: ldh [2]
+        (0x94, 0, 0, workers),  # mod: A %= workers
+        (0x16, 0, 0, 0),        # ret A
+    ]
+    insns = ctypes.create_string_buffer(b''.join(BPF_INSN.pack(*i) for i in program))
     try:
-        os.makedirs(os.path.join(fallback_base, 'tests'), exist_ok=True)
-    except Exception:
-        pass
-    csv_path = os.path.join(fallback_base, 'tests', os.path.basename(csv_path) or 'packets.csv')
-    try:
-        temp_csv = open(csv_path, 'w', newline='')
-    except Exception:
-        # last resort: open in current dir (may raise)
-        temp_csv = open('temp.csv', 'w', newline='')
-writer = csv.writer(temp_csv)
-writer.writerow([
-    'device_id', 'seq_num', 'timestamp', 'value',
-    'duplicate_flag', 'gap_flag', 'arrival_time'
-])
-print(f"[SERVER] Writing packets CSV to: {csv_path}")
+        sock.setsockopt(skt.SOL_SOCKET, SO_ATTACH_REUSEPORT_CBPF,
+                        BPF_PROG.pack(len(program), ctypes.addressof(insns)))
+    except OSError:
+        return False
+    return True
 
-# -------------------------
-# Metrics
-# -------------------------
-# packets_received: number of unique DATA packets accepted (not duplicate packets)
-packets_received = 0
-# total bytes across accepted packets (for bytes_per_report)
-packets_bytes_total = 0
-# duplicate metrics: total duplicate packet arrivals, and number of distinct seqs that experienced duplication
-dup_total = 0
-dup_seq_count = 0
-dup_seq_seen = {}  # dev -> set(seq)
-loss_count = 0
-
-# readings_written: total number of individual readings written to CSV (after batching)
-readings_written = 0
-
-cpu_counts = 0
-cpu_total_time = 0
 
 # -------------------------
-# Tracking
+# CSV setup
 # -------------------------
-last_seq = {}
-last_written = {}
-buffers = {}
-BUFFER_THRESHOLD = 5
-max_seq_seen = {}
-
-start_time = time.time()
-
-# =====================================================
-# Main loop
-# =====================================================
-while time.time() - start_time < RUN_DURATION:
+def open_packets_csv(csv_path):
+    """Open the packets CSV; if that fails fall back to /tmp. Returns (file, path)."""
     try:
-        packet, address = server_socket.recvfrom(1024)
-    except skt.timeout:
-        continue
-
-    if len(packet) < Header.Size:
-        continue
-
-    header = Header()
-    header.unPack(packet[:Header.Size])
-    arrival_time = time.time()
-
-    dev = header.device_id
-    seq = header.seq_num
-
-    # track highest sequence seen for this device
-    max_seq_seen[dev] = max(seq, max_seq_seen.get(dev, -1))
-
-    # -------------------------
-    # HEARTBEAT
-    # -------------------------
-    if header.msg_type == 0:
-        print(f"[SERVER] HEARTBEAT from {dev}")
-        # reply to heartbeat so clients can detect server liveness
+        csv_dir = os.path.dirname(csv_path)
+        if csv_dir:
+            os.makedirs(csv_dir, exist_ok=True)
+        return open(csv_path, 'w', newline=''), csv_path
+    except Exception:
+        # fallback to /tmp/<project>/tests/packets.csv
+        fallback_base = os.path.join('/tmp', os.path.basename(os.getcwd()))
         try:
-            alive = struct.pack('!B', 4)
-            server_socket.sendto(alive, address)
+            os.makedirs(os.path.join(fallback_base, 'tests'), exist_ok=True)
         except Exception:
             pass
-        continue
-
-    # -------------------------
-    # INIT
-    # -------------------------
-    if header.msg_type == 2:
-        print(f"[SERVER] INIT from {dev}")
-        continue
-
-    # -------------------------
-    # DATA
-    # -------------------------
-    cpu_start = time.process_time()
-
-    # initialize per-device structures
-    if dev not in buffers:
-        buffers[dev] = []  # list of (seq, timestamp, value, arrival_time)
-    if dev not in last_written:
-        last_written[dev] = -1
-
-    duplicate_flag = 0
-    gap_flag = 0
-
-    # parse payload into one or more readings (batch support)
-    payload = packet[Header.Size:]
-    num_readings = max(1, len(payload) // 2)
-    readings = []
-    for i in range(num_readings):
-        start = i * 2
-        value = struct.unpack('!H', payload[start:start+2])[0]
-        seq_i = seq + i
-        readings.append((seq_i, header.timestamp, value, arrival_time))
-
-    # classify readings: detect duplicates and collect new readings
-    new_readings = []
-    for seq_i, ts_i, val_i, at_i in readings:
-        if seq_i <= last_written[dev]:
-            # already written -> duplicate arrival
-            dup_total += 1
-            if dev not in dup_seq_seen:
-                dup_seq_seen[dev] = set()
-            if seq_i not in dup_seq_seen[dev]:
-                dup_seq_seen[dev].add(seq_i)
-                dup_seq_count += 1
-            continue
-        if any(p[0] == seq_i for p in buffers[dev]):
-            # already buffered -> duplicate arrival
-            dup_total += 1
-            if dev not in dup_seq_seen:
-                dup_seq_seen[dev] = set()
-            if seq_i not in dup_seq_seen[dev]:
-                dup_seq_seen[dev].add(seq_i)
-                dup_seq_count += 1
-            continue
-        new_readings.append((seq_i, ts_i, val_i, at_i))
-
-    # accept packet only if it contains at least one new reading
-    if new_readings:
-        buffers[dev].extend(new_readings)
-        packets_received += 1
-        packets_bytes_total += len(packet)
-
-    # send ACK if requested (type 1 + seq32)
-    if header.flags == 1:
+        fallback = os.path.join(fallback_base, 'tests', os.path.basename(csv_path) or 'packets.csv')
         try:
-            ack = struct.pack('!BI', 1, seq)
-            server_socket.sendto(ack, address)
+            return open(fallback, 'w', newline=''), fallback
         except Exception:
-            pass
-
-    # count writing later when the packet is flushed to CSV
-
-    # process batch when we have at least 10 packets buffered for this device
-    if len(buffers[dev]) >= 10:
-        # reorder by sender timestamp
-        batch = sorted(buffers[dev], key=lambda x: x[1])
-        buffers[dev] = []
-        expected = last_written.get(dev, -1) + 1
-        for seq_b, ts_b, val_b, at_b in batch:
-            duplicate_flag = 0
-            gap_flag = 0
-            if seq_b < expected:
-                # already written -> duplicate arrival
-                duplicate_flag = 1
-                dup_total += 1
-                if dev not in dup_seq_seen:
-                    dup_seq_seen[dev] = set()
-                if seq_b not in dup_seq_seen[dev]:
-                    dup_seq_seen[dev].add(seq_b)
-                    dup_seq_count += 1
-            elif seq_b > expected:
-                # gap detected, count missing as loss
-                missing = seq_b - expected
-                loss_count += missing
-                gap_flag = 1
-                # write the packet and advance
-                writer.writerow([dev, seq_b, ts_b, val_b, duplicate_flag, gap_flag, at_b])
-                temp_csv.flush()
-                readings_written += 1
-                last_written[dev] = seq_b
-                expected = seq_b + 1
-            else:
-                # in-order packet
-                writer.writerow([dev, seq_b, ts_b, val_b, duplicate_flag, gap_flag, at_b])
-                temp_csv.flush()
-                readings_written += 1
-                last_written[dev] = seq_b
-                expected += 1
-
-    cpu_end = time.process_time()
-    cpu_counts += 1
-    cpu_total_time += (cpu_end - cpu_start)
-    elapsed = int(time.time() - start_time)
+            # last resort: open in current dir (may raise)
+            return open('temp.csv', 'w', newline=''), 'temp.csv'
+
+
+def merge_csv_shards(csv_path, shard_paths):
+    """Concatenate per-worker CSV shards into csv_path (single header row)."""
+    out, csv_path = open_packets_csv(csv_path)
+    with out:
+        csv.writer(out).writerow(CSV_HEADER)
+        for shard in shard_paths:
+            try:
+                with open(shard, newline='') as f:
+                    next(f, None)  # skip shard header
+                    for line in f:
+                        out.write(line)
+                os.remove(shard)
+            except OSError:
+                pass
+    return csv_path
 
-    for t in snapshot_points:
-        if elapsed >= t and t not in snapshots_taken:
-            snapshots_taken.add(t)
-
-            cur_dup_rate = dup_total / max((readings_written + dup_total), 1)
-            cur_bytes = packets_bytes_total / max(readings_written, 1)
-            cur_cpu = (cpu_total_time / max(readings_written, 1)) * 1000
-
-            snap_time.append(t)
-            snap_bytes.append(cur_bytes)
-            snap_dup_rate.append(cur_dup_rate)
-            snap_loss.append(loss_count)
-            snap_cpu.append(cur_cpu)
-
-            print(f"[SNAPSHOT @ {t}s] bytes={cur_bytes:.2f}, dup={cur_dup_rate:.4f}, loss={loss_count}, cpu={cur_cpu:.3f}")
-
-    # safety: if buffer grows excessively large, flush the earliest batch of 10 by arrival time
-    if len(buffers[dev]) > BUFFER_THRESHOLD * 10:
-        buffers[dev].sort(key=lambda x: x[3])
-        batch = buffers[dev][:10]
-        buffers[dev] = buffers[dev][10:]
-        expected = last_written.get(dev, -1) + 1
-        for seq_b, ts_b, val_b, at_b in batch:
-            duplicate_flag = 0
-            gap_flag = 0
-            if seq_b < expected:
-                duplicate_flag = 1
-                dup_total += 1
-                if dev not in dup_seq_seen:
-                    dup_seq_seen[dev] = set()
-                if seq_b not in dup_seq_seen[dev]:
-                    dup_seq_seen[dev].add(seq_b)
-                    dup_seq_count += 1
-            elif seq_b > expected:
-                missing = seq_b - expected
-                loss_count += missing
-                gap_flag = 1
-                writer.writerow([dev, seq_b, ts_b, val_b, duplicate_flag, gap_flag, at_b])
-                temp_csv.flush()
-                readings_written += 1
-                last_written[dev] = seq_b
-                expected = seq_b + 1
-            else:
-                writer.writerow([dev, seq_b, ts_b, val_b, duplicate_flag, gap_flag, at_b])
-                temp_csv.flush()
-                readings_written += 1
-                last_written[dev] = seq_b
-                expected += 1
 
 # =====================================================
-# Final flush
+# Main loop
 # =====================================================
-for dev in list(buffers.keys()):
-    # buffers[dev] is a dict(seq -> (timestamp, value, arrival_time))
-    if isinstance(buffers[dev], list):
-        seqs = sorted(buffers[dev], key=lambda x: x[1])
-        for seq_b, ts_b, val_b, at_b in seqs:
-            duplicate_flag = 0
-            gap_flag = 0
-            expected = last_written.get(dev, -1) + 1
-            if seq_b < expected:
-                duplicate_flag = 1
-                dup_total += 1
-                if dev not in dup_seq_seen:
-                    dup_seq_seen[dev] = set()
-                if seq_b not in dup_seq_seen[dev]:
-                    dup_seq_seen[dev].add(seq_b)
-                    dup_seq_count += 1
-            elif seq_b > expected:
-                missing = seq_b - expected
-                loss_count += missing
-                gap_flag = 1
-                writer.writerow([dev, seq_b, ts_b, val_b, duplicate_flag, gap_flag, at_b])
-                temp_csv.flush()
-                readings_written += 1
-                last_written[dev] = seq_b
-                expected = seq_b + 1
-            else:
-                writer.writerow([dev, seq_b, ts_b, val_b, duplicate_flag, gap_flag, at_b])
-                temp_csv.flush()
-                readings_written += 1
-                last_written[dev] = seq_b
-                expected += 1
-    else:
-        # legacy list handling (shouldn't occur) — keep old behavior
-        buffers[dev].sort(key=lambda x: x[0])
-        for pkt in buffers[dev]:
-            writer.writerow([
-                dev,
-                pkt[1],
-                pkt[0],
-                pkt[2],
-                pkt[3],
-                pkt[4],
-                pkt[5]
-            ])
-            elapsed = int(time.time() - start_time)
+def serve(server_socket, state, start_time, worker_id=0, inboxes=None):
+    """Receive until RUN_DURATION elapses.
+
+    Each wakeup drains the socket in bulk through a BatchReceiver and decodes the
+    datagrams in place, so a burst costs one select() instead of one timed-out
+    recvfrom() per packet.
+
+    With several workers each one owns the devices where device_id % workers == worker_id.
+    steer_by_device() has the kernel deliver datagrams to their owner's SO_REUSEPORT socket.
+    Where it cannot (no CBPF support, frames too short), a packet for a device owned
+    elsewhere is forwarded to the owner's inbox (AF_UNIX socketpair) without blocking;
+    a full inbox drops it, counted in forward_drops. The owner replies from its own
+    socket, which is bound to the same address.
+    """
+    num_workers = len(inboxes) if inboxes else 1
+    my_inbox = inboxes[worker_id][0] if inboxes else None
+    watch = [server_socket] + ([my_inbox] if my_inbox else [])
+    rx = BatchReceiver(server_socket)
+    admission = AdmissionControl(state, server_socket)
+    buf, lengths, addrs, slot_size = rx.buf, rx.lengths, rx.addrs, rx.slot_size
+    profiler = state.profiler
+    if my_inbox is not None:
+        my_inbox.setblocking(False)
+
+    while time.time() - start_time < RUN_DURATION:
+        readable, _, _ = select.select(watch, [], [], state.poll_timeout(0.5))
+        woke = time.perf_counter()
+
+        if my_inbox is not None and my_inbox in readable:
+            while True:
+                try:
+                    msg = my_inbox.recv(2048)
+                except BlockingIOError:
+                    break
+                ip, port = FWD_ADDR.unpack_from(msg)
+                reply = state.handle_datagram(msg, FWD_ADDR.size, len(msg) - FWD_ADDR.size, time.time())
+                if reply is not None:
+                    send_reply(server_socket, reply, (skt.inet_ntoa(ip), port))
+                if profiler is not None and profiler.active:
+                    profiler.mark('ack')
+                    profiler.end()
+
+        if server_socket in readable:
+            if profiler is not None:
+                rx_start = time.perf_counter()
+            n = rx.drain()
+            if profiler is not None and n:
+                profiler.observe('receive', (time.perf_counter() - rx_start) / n)
+            # one arrival timestamp per drained batch; the batch was queued within the same wakeup
+            arrival_time = time.time()
+            state.m_rx_batch.observe(n)
+            for i in range(n):
+                offset = i * slot_size
+                length = lengths[i]
+                if num_workers > 1 and length >= 4:
+                    # v1 and v2 frames carry device_id at different offsets
+                    owner = device_id_of(buf, offset) % num_workers
+                    if owner != worker_id:
+                        ip, port = addrs[i]
+                        fwd = FWD_ADDR.pack(skt.inet_aton(ip), port) + bytes(buf[offset:offset + length])
+                        try:
+                            # never block: two workers forwarding to each other's full inbox would deadlock
+                            inboxes[owner][1].send(fwd, skt.MSG_DONTWAIT)
+                        except OSError:
+                            state.forward_drops += 1
+                        continue
+                reply = state.handle_datagram(buf, offset, length, arrival_time)
+                if reply is not None:
+                    send_reply(server_socket, reply, addrs[i])
+                if profiler is not None and profiler.active:
+                    profiler.mark('ack')
+                    profiler.end()
+
+        now = time.time()
+        state.release_due(now)
+        state.sink.tick()
+        state.evict_idle(now)
+        state.maybe_snapshot(int(time.time() - start_time), snapshot_points)
+        admission.record(time.perf_counter() - woke)
+        admission.poll()
+
+    # Final flush
+    state.flush_all()
+
+
+async def serve_asyncio(state):
+    server = TelemetryServer(state, snapshot_points)
+    await server.start(server_IP, server_port)
+    server.admission = AdmissionControl(state, server.transport.get_extra_info('socket'))
+    await server.run_for(RUN_DURATION)
+
+
+def attach_rollup(sink, prefix='roll'):
+    if ROLLUP_DIR:
+        sink.rollup = RollupStore(ROLLUP_DIR, prefix)
+    return sink
+
+
+def send_reply(sock, reply, address):
+    try:
+        sock.sendto(reply, address)
+    except Exception:
+        pass
 
-            elapsed = int(time.time() - start_time)
 
+def run_worker(worker_id, server_socket, inboxes, csv_path, start_time, results):
+    """Serve one worker's share; always puts (worker_id, counters, snapshots) on results,
+    or (worker_id, None, error) if the worker failed before it could serve."""
+    state = exporter = capture = None
+    error = None
+    try:
+        if PACKETS_SINK == 'binary':
+            sink = SegmentSink(PACKETS_DIR, prefix=f"w{worker_id}")
+        else:
+            sink = CsvSink(open(csv_path, 'w', newline=''))
+        state = IngestState(attach_rollup(sink, f"w{worker_id}"))
+        state.registry.const_labels['worker'] = str(worker_id)
+        exporter = start_exporter(state, worker_id)
+        capture = CaptureControl(f"w{worker_id}").install()
+        serve(server_socket, state, start_time, worker_id, inboxes)
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        try:
+            if capture is not None:
+                capture.close()
+            if state is not None:
+                state.sink.close()
+                print_stages(state.profiler)
+            log_totals()
+            if exporter is not None:
+                exporter.close()
+        finally:
+            if error is None and state is not None:
+                results.put((worker_id, state.counters(), state.snapshots))
+            else:
+                results.put((worker_id, None, error or "worker stopped before serving"))
 
 
-# =====================================================
-# Metrics
-# =====================================================
-print("\n[METRICS]")
-# packets_received: unique packets accepted
-print(f"Packets received: {packets_received}")
-print(f"Readings written: {readings_written}")
-print(f"Packets lost: {loss_count}")
-print(f"Duplicate packets (total arrivals): {dup_total}")
-print(f"Duplicate sequences: {dup_seq_count}")
-# duplicate_rate per spec: dup_total / (readings_written + dup_total)
-dup_rate = dup_total / max((readings_written + dup_total), 1)
-print(f"Duplicate rate: {dup_rate:.6f}")
-# bytes per report (per reading)
-bytes_per_report = packets_bytes_total / max(readings_written, 1)
-print(f"Bytes per report: {bytes_per_report:.2f}")
-print(f"CPU_MS_PER_REPORT = {(cpu_total_time / max(readings_written,1)) * 1000:.3f}")
+def start_exporter(state, worker_id=0):
+    """Expose state's metrics registry if METRICS_PORT or METRICS_JSON is set."""
+    if not (METRICS_PORT or METRICS_JSON):
+        return None
+    json_path = f"{METRICS_JSON}.w{worker_id}" if METRICS_JSON and SERVER_WORKERS > 1 else METRICS_JSON
+    return MetricsExporter(state.registry, port=METRICS_PORT + worker_id if METRICS_PORT else 0, json_path=json_path)
 
-print("----------------------------------------------------------")
 
+def run_workers(csv_path, start_time):
+    """Fork SERVER_WORKERS ingest processes and merge their counters and CSV shards."""
+    ctx = mp.get_context('fork')
+    csv_dir = os.path.dirname(csv_path)
+    if csv_dir:
+        os.makedirs(csv_dir, exist_ok=True)
+    inboxes = [skt.socketpair(skt.AF_UNIX, skt.SOCK_DGRAM) for _ in range(SERVER_WORKERS)]
+    results = ctx.Queue()
+    shard_paths = [f"{csv_path}.w{i}" for i in range(SERVER_WORKERS)]
+    procs = []
+    steered = False
+    for i in range(SERVER_WORKERS):
+        sock = make_server_socket(reuse_port=True)
+        if i == 0:
+            steered = steer_by_device(sock, SERVER_WORKERS)
+        p = ctx.Process(target=run_worker, args=(i, sock, inboxes, shard_paths[i], start_time, results), daemon=True)
+        p.start()
+        sock.close()
+        procs.append(p)
+    if not steered:
+        print("[SERVER] Kernel steering unavailable: workers forward datagrams of devices they do not own")
+    # SIGUSR1 / SIGUSR2 sent to the parent start or stop captures in every worker
+    forward_signals([p.pid for p in procs])
+
+    reports, failed = collect_reports(procs, results, start_time)
+    for p in procs:
+        p.join(1.0)
+
+    counters = merge_counters(r[1] for r in reports)
+    snapshots = {}
+    for t in snapshot_points:
+        taken = [r[2][t] for r in reports if t in r[2]]
+        if taken:
+            snapshots[t] = merge_counters(taken)
+    if PACKETS_SINK != 'binary':
+        csv_path = merge_csv_shards(csv_path, shard_paths)
+    return counters, snapshots, csv_path, failed
+
+
+def collect_reports(procs, results, start_time):
+    """Wait for every worker's report; returns (reports, failed worker ids).
+
+    A worker that exits without a report (killed, or died outside run_worker's
+    handling) or is still running WORKER_REPORT_GRACE seconds after the run should
+    have ended is reported as failed instead of blocking the parent forever.
+    """
+    deadline = start_time + RUN_DURATION + SINK_CLOSE_TIMEOUT + WORKER_REPORT_GRACE
+    pending = set(range(len(procs)))
+    exited = set()
+    reports, failed = [], []
+    while pending:
+        try:
+            worker_id, counters, snapshots = results.get(timeout=1.0)
+        except queue.Empty:
+            for i in sorted(pending):
+                if procs[i].exitcode is None and time.time() < deadline:
+                    continue
+                # an exited worker's report is flushed before it exits; give it one more poll
+                if i in exited or procs[i].exitcode is None:
+                    pending.discard(i)
+                    failed.append(i)
+                    print(f"[SERVER] Worker {i} sent no report (exit code {procs[i].exitcode})")
+                    if procs[i].exitcode is None:
+                        procs[i].terminate()
+                exited.add(i)
+            continue
+        pending.discard(worker_id)
+        if counters is None:
+            failed.append(worker_id)
+            print(f"[SERVER] Worker {worker_id} failed: {snapshots}")
+        else:
+            reports.append((worker_id, counters, snapshots))
+    return reports, sorted(failed)
 
 
 # =====================================================
-# Derived metric (REAL)
-# =====================================================
-cpu_ms_per_report = (cpu_total_time / max(readings_written, 1)) * 1000
-
-# =====================================================
-# 1) Bytes per Report
+# Metrics
 # =====================================================
-plt.figure()
-plt.bar(snap_time, snap_bytes)
-plt.xlabel("Time (seconds)")
-plt.ylabel("Bytes per Report")
-plt.title("Bytes per Report vs Time")
-plt.grid(True, axis='y')
-plt.tight_layout()
-plt.savefig("bytes_per_report_over_time.png")
-plt.close()
-
-plt.figure()
-plt.bar(snap_time, snap_dup_rate)
-plt.xlabel("Time (seconds)")
-plt.ylabel("Duplicate Rate")
-plt.title("Duplicate Rate vs Time")
-plt.grid(True, axis='y')
-plt.tight_layout()
-plt.savefig("duplicate_rate_over_time.png")
-plt.close()
-
-
-plt.figure()
-plt.bar(snap_time, snap_loss)
-plt.xlabel("Time (seconds)")
-plt.ylabel("Packets Lost")
-plt.title("Packet Loss vs Time")
-plt.grid(True, axis='y')
-plt.tight_layout()
-plt.savefig("packet_loss_over_time.png")
-plt.close()
-
-
-
-plt.figure()
-plt.bar(snap_time, snap_cpu)
-plt.xlabel("Time (seconds)")
-plt.ylabel("CPU ms per Report")
-plt.title("CPU Time per Report vs Time")
-plt.grid(True, axis='y')
-plt.tight_layout()
-plt.savefig("cpu_ms_per_report_over_time.png")
-plt.close()
-
-
+def print_metrics(c):
+    print("\n[METRICS]")
+    # packets_received: unique packets accepted
+    print(f"Packets received: {c['packets_received']}")
+    print(f"Readings written: {c['readings_written']}")
+    print(f"Packets lost: {c['loss_count']}")
+    # server-side drops are not network loss; only shown when there were any
+    if c.get('shed_readings') or c.get('shed_heartbeats'):
+        print(f"Shed by admission control: {c['shed_readings']} readings, {c['shed_heartbeats']} heartbeats")
+    if c.get('forward_drops'):
+        print(f"Dropped on full worker inbox: {c['forward_drops']} datagrams")
+    if c.get('socket_drops'):
+        print(f"Dropped on full socket buffer: {c['socket_drops']} datagrams")
+    if c.get('malformed_packets'):
+        print(f"Malformed packets: {c['malformed_packets']}")
+    if c.get('reserved_id_packets'):
+        print(f"v1 packets from reserved device ids 0xFF00-0xFFFF (dropped): {c['reserved_id_packets']}")
+    print(f"Duplicate packets (total arrivals): {c['dup_total']}")
+    print(f"Duplicate sequences: {c['dup_seq_count']}")
+    rates = derived_metrics(c)
+    print(f"Duplicate rate: {rates['dup_rate']:.6f}")
+    print(f"Bytes per report: {rates['bytes_per_report']:.2f}")
+    print(f"CPU_MS_PER_REPORT = {rates['cpu_ms_per_report']:.3f}")
+
+    print("----------------------------------------------------------")
+
+
+def write_snapshots(path, snapshots, counters, elapsed):
+    """Write the snapshot time-series (plus a final record) as JSON lines for report.py."""
+    try:
+        snap_dir = os.path.dirname(path)
+        if snap_dir:
+            os.makedirs(snap_dir, exist_ok=True)
+        with open(path, 'w') as f:
+            for t in sorted(snapshots):
+                f.write(json.dumps({'t': t, **snapshots[t], **derived_metrics(snapshots[t])}) + '\n')
+            f.write(json.dumps({'t': round(elapsed, 3), 'final': True, **counters, **derived_metrics(counters)}) + '\n')
+    except OSError as e:
+        print(f"[SERVER] Could not write snapshots to {path}: {e}")
+        return
+    print(f"[SERVER] Snapshots written to: {path} (render charts with: python3 report.py {path})")
+
+
+def main():
+    # CSV path: allow override via PACKETS_CSV env var. If opening fails, fall back to /tmp
+    csv_path = os.getenv('PACKETS_CSV', 'temp.csv')
+    start_time = time.time()
+
+    if SERVER_WORKERS > 1:
+        print(f"[SERVER] Listening on UDP {server_IP}:{server_port} with {SERVER_WORKERS} workers (SO_REUSEPORT)")
+        counters, snapshots, csv_path, failed = run_workers(csv_path, start_time)
+        if PACKETS_SINK == 'binary':
+            print(f"[SERVER] Wrote packet segments to: {PACKETS_DIR}")
+        else:
+            print(f"[SERVER] Wrote packets CSV to: {csv_path}")
+    else:
+        if SERVER_ENGINE != 'asyncio':
+            server_socket = make_server_socket()
+        print(f"[SERVER] Listening on UDP {server_IP}:{server_port} ({SERVER_ENGINE} engine)")
+        if PACKETS_SINK == 'binary':
+            print(f"[SERVER] Writing packet segments to: {PACKETS_DIR}")
+            state = IngestState(attach_rollup(SegmentSink(PACKETS_DIR)))
+        else:
+            temp_csv, csv_path = open_packets_csv(csv_path)
+            print(f"[SERVER] Writing packets CSV to: {csv_path}")
+            state = IngestState(attach_rollup(CsvSink(temp_csv)))
+        exporter = start_exporter(state)
+        capture = CaptureControl().install()
+        if SERVER_ENGINE == 'asyncio':
+            asyncio.run(serve_asyncio(state))
+        else:
+            serve(server_socket, state, start_time)
+        capture.close()
+        state.sink.close()
+        print_stages(state.profiler)
+        log_totals()
+        if exporter is not None:
+            exporter.close()
+        if state.sink.backpressure_events:
+            print(f"[SERVER] Sink backpressure: {state.sink.backpressure_events} events, "
+                  f"up to {state.sink.max_held_rows} rows held in memory")
+        counters, snapshots = state.counters(), state.snapshots
+        failed = []
+
+    print_metrics(counters)
+    # snapshot series for offline charts; defaults to the output directory of the run
+    snapshots_path = os.getenv('SNAPSHOTS_FILE') or os.path.join(
+        os.path.dirname(csv_path) if PACKETS_SINK != 'binary' else PACKETS_DIR, 'snapshots.jsonl')
+    write_snapshots(snapshots_path, snapshots, counters, time.time() - start_time)
+    if failed:
+        print(f"[SERVER] {len(failed)} of {SERVER_WORKERS} workers failed; totals cover the others only")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
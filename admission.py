@@ -0,0 +1,149 @@
+"""Admission control: measure receive-path overload and shed non-critical traffic first.
+
+Measured every ADMIT_PROBE_S whether or not control is on:
+
+    busy      share of wall time the receive loop spent processing rather than waiting
+              in select(): how far it is from falling behind
+    backlog   bytes queued on the UDP socket relative to its receive buffer, from
+              /proc/net/udp (Linux). Elsewhere busy above BUSY_KNEE stands in for it,
+              scaled so that a saturated loop reads 1
+    drops     datagrams the kernel dropped because that buffer was full. They never
+              reach the server, so without this they would show up as loss_count
+
+With ADMIT_CONTROL=1 the backlog drives a level:
+
+    0 normal
+    1 sample  keep one in ADMIT_SAMPLE non-danger DATA packets
+    2 shed    drop every non-danger DATA packet, answer one in ADMIT_SAMPLE heartbeats
+
+Danger DATA (flags & FLAG_DANGER) and INIT are always processed. A level is entered
+at ADMIT_SAMPLE_AT / ADMIT_SHED_AT and left once the backlog falls below half of it.
+Shed readings are counted in shed_readings and kept out of loss_count.
+
+While the level is above 0 and ADMIT_HINT=1, ACK, SACK and ALIVE replies carry it as
+one trailing byte: a slow-down hint the client answers by batching more readings per
+packet. Older clients read those replies by prefix and ignore the extra byte.
+"""
+import os, socket as skt, time
+from eventlog import event, INFO
+
+ADMIT_CONTROL = os.getenv("ADMIT_CONTROL", "0") == "1"
+ADMIT_HINT = os.getenv("ADMIT_HINT", "1") == "1"
+ADMIT_SAMPLE = max(1, int(os.getenv("ADMIT_SAMPLE", 4)))
+ADMIT_SAMPLE_AT = float(os.getenv("ADMIT_SAMPLE_AT", 0.25))
+ADMIT_SHED_AT = float(os.getenv("ADMIT_SHED_AT", 0.5))
+ADMIT_PROBE_S = float(os.getenv("ADMIT_PROBE_S", 0.5))
+BUSY_KNEE = 0.8
+
+NORMAL, SAMPLE, SHED = 0, 1, 2
+LEVEL_NAMES = ('normal', 'sample', 'shed')
+
+LEVEL_LOG = event('server.admission', "[SERVER] Admission {name} (backlog {backlog:.0%}, busy {busy:.0%})", INFO)
+
+
+class SocketProbe:
+    """Receive-queue bytes and kernel drop count of one UDP socket, read from /proc/net/udp[6]."""
+
+    def __init__(self, sock):
+        self.inode = str(os.fstat(sock.fileno()).st_ino)
+        # the kernel reports (and enforces) twice the SO_RCVBUF that was asked for
+        self.rcvbuf = max(1, sock.getsockopt(skt.SOL_SOCKET, skt.SO_RCVBUF))
+        self.tables = [p for p in ('/proc/net/udp', '/proc/net/udp6') if os.path.exists(p)]
+
+    def read(self):
+        """(queued bytes, drops), or None if the socket cannot be found."""
+        for path in self.tables:
+            try:
+                with open(path) as f:
+                    next(f)
+                    for line in f:
+                        fields = line.split()
+                        # sl local rem st tx_queue:rx_queue tr retrnsmt uid timeout inode ref pointer drops
+                        if len(fields) > 12 and fields[9] == self.inode:
+                            return int(fields[4].split(':')[1], 16), int(fields[12])
+            except (OSError, ValueError, StopIteration):
+                continue
+        return None
+
+
+class AdmissionControl:
+    """Per-worker overload measurement and, with ADMIT_CONTROL, the shedding level.
+
+    The receive loop calls record() after each wakeup and poll() with its other
+    periodic work. IngestState consults admit_data() / admit_heartbeat() only while
+    state.admission is set (ADMIT_CONTROL) and the level is above 0.
+    """
+
+    def __init__(self, state, sock, control=ADMIT_CONTROL):
+        self.state = state
+        self.probe = SocketProbe(sock) if sock is not None else None
+        self.level = NORMAL
+        self.backlog = 0.0
+        self.busy = 0.0
+        self.countdown = ADMIT_SAMPLE
+        self.busy_time = 0.0
+        self.last_probe = time.monotonic()
+        self.next_probe = self.last_probe + ADMIT_PROBE_S
+        r = state.registry
+        r.callback("telemetry_admission_level", "0 normal, 1 sampling, 2 shedding non-critical traffic",
+                   lambda: self.level, kind='gauge')
+        r.callback("telemetry_socket_backlog_ratio", "receive queue fill (or busy ratio past the knee)",
+                   lambda: self.backlog, kind='gauge')
+        r.callback("telemetry_loop_busy_ratio", "share of time the receive loop spent processing",
+                   lambda: self.busy, kind='gauge')
+        if control:
+            state.admission = self
+
+    def record(self, busy_seconds):
+        self.busy_time += busy_seconds
+
+    def poll(self):
+        now = time.monotonic()
+        if now < self.next_probe:
+            return
+        elapsed = now - self.last_probe
+        self.last_probe = now
+        self.next_probe = now + ADMIT_PROBE_S
+        self.busy = min(1.0, self.busy_time / elapsed) if elapsed > 0 else 0.0
+        self.busy_time = 0.0
+        sample = self.probe.read() if self.probe is not None else None
+        if sample is not None:
+            queued, drops = sample
+            self.backlog = min(1.0, queued / self.probe.rcvbuf)
+            self.state.socket_drops = drops
+        else:
+            self.backlog = max(0.0, (self.busy - BUSY_KNEE) / (1 - BUSY_KNEE))
+        if self.state.admission is self:
+            self._set_level(self._next_level())
+
+    def _next_level(self):
+        backlog, level = self.backlog, self.level
+        if backlog >= ADMIT_SHED_AT:
+            return SHED
+        if level == SHED and backlog >= ADMIT_SHED_AT / 2:
+            return SHED
+        if backlog >= ADMIT_SAMPLE_AT or (level >= SAMPLE and backlog >= ADMIT_SAMPLE_AT / 2):
+            return SAMPLE
+        return NORMAL
+
+    def _set_level(self, level):
+        if level == self.level:
+            return
+        self.level = level
+        self.state.hint = bytes((level,)) if level and ADMIT_HINT else b''
+        if LEVEL_LOG.enabled:
+            LEVEL_LOG.emit(name=LEVEL_NAMES[level], backlog=self.backlog, busy=self.busy)
+
+    def _keep_one(self):
+        self.countdown -= 1
+        if self.countdown:
+            return False
+        self.countdown = ADMIT_SAMPLE
+        return True
+
+    def admit_data(self):
+        """Whether to process a non-danger DATA packet at the current level."""
+        return self.level == SAMPLE and self._keep_one()
+
+    def admit_heartbeat(self):
+        return self.level < SHED or self._keep_one()
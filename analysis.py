@@ -0,0 +1,287 @@
+"""Vectorized post-run analysis of stored readings (NumPy).
+
+Streams packets.csv files or binary segment directories (storage.py) in fixed-size
+chunks and computes, per device and per run: loss and gap lengths from the seq
+numbers, duplicates, inter-arrival time and jitter, and value statistics including
+danger readings (value >= 60). Several runs can be compared in one call:
+
+    python3 analysis.py tests/baseline tests/loss5 tests/delay_jitter
+    python3 analysis.py tests/loss5 --per-device --json loss5.json
+
+Memory is bounded by --chunk rows plus fixed per-device accumulators (device_id is
+16-bit), so row counts in the hundreds of millions stream through in constant
+space. Rows of one device must appear in the order the server wrote them, which
+holds for its CSV, merged worker shards and segment files.
+"""
+import argparse, glob, itertools, json, os
+import numpy as np
+from storage import SegmentReader, SEGMENT_SUFFIX
+
+DANGER_THRESHOLD = 60
+CHUNK_ROWS = 1 << 20
+# gap-length histogram: gaps of MAX_GAP_BUCKET or more readings share the last bucket
+MAX_GAP_BUCKET = 64
+DEVICES = 1 << 16
+
+COLUMNS = ('device_id', 'seq_num', 'timestamp', 'value', 'duplicate_flag', 'arrival_time')
+SEQ_MOD = 1 << 32
+SEQ_HALF = 1 << 31
+
+
+# -------------------------
+# Loading
+# -------------------------
+def iter_csv(path, chunk_rows=CHUNK_ROWS):
+    """{column: array} chunks of a packets.csv file."""
+    with open(path) as f:
+        header = f.readline().strip().split(',')
+        usecols = [header.index(c) for c in COLUMNS]
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                return
+            data = np.loadtxt(lines, delimiter=',', usecols=usecols, ndmin=2)
+            yield {name: data[:, i] for i, name in enumerate(COLUMNS)}
+
+
+def iter_segments(directory, chunk_rows=CHUNK_ROWS):
+    """{column: array} chunks of every segment in directory, read through the memory map."""
+    reader = SegmentReader(directory)
+    for path in reader.segments():
+        records = reader.map_segment(path)
+        for start in range(0, len(records), chunk_rows):
+            part = records[start:start + chunk_rows]
+            yield {name: np.asarray(part[name]) for name in COLUMNS}
+
+
+def iter_run(path, chunk_rows=CHUNK_ROWS):
+    """Chunks of a run: a CSV file, a segment directory, or a run directory holding either."""
+    if not os.path.isdir(path):
+        return iter_csv(path, chunk_rows)
+    if glob.glob(os.path.join(path, '*' + SEGMENT_SUFFIX)):
+        return iter_segments(path, chunk_rows)
+    if os.path.exists(os.path.join(path, 'packets.csv')):
+        return iter_csv(os.path.join(path, 'packets.csv'), chunk_rows)
+    if os.path.isdir(os.path.join(path, 'segments')):
+        return iter_segments(os.path.join(path, 'segments'), chunk_rows)
+    raise FileNotFoundError(f"{path}: no packets.csv or {SEGMENT_SUFFIX} segments")
+
+
+# -------------------------
+# Statistics
+# -------------------------
+def _previous(values, first, carried):
+    """values shifted by one within each device group; group heads take the carried value."""
+    prev = np.empty_like(values)
+    prev[1:] = values[:-1]
+    prev[first] = carried
+    return prev
+
+
+class RunStats:
+    """Per-device accumulators for one run, updated one chunk at a time.
+
+    The last seq / arrival / transit time of every device, and the transit time of the
+    last reading of the packet before its current one, are carried between chunks, so
+    a device's stream may be split anywhere.
+    """
+
+    def __init__(self):
+        n = DEVICES
+        self.rows = np.zeros(n, np.int64)
+        self.lost = np.zeros(n, np.int64)
+        self.gaps = np.zeros(n, np.int64)
+        self.max_gap = np.zeros(n, np.int64)
+        self.duplicates = np.zeros(n, np.int64)
+        self.restarts = np.zeros(n, np.int64)
+        self.danger = np.zeros(n, np.int64)
+        self.value_sum = np.zeros(n)
+        self.value_sq = np.zeros(n)
+        self.value_min = np.full(n, np.inf)
+        self.value_max = np.full(n, -np.inf)
+        self.ia_count = np.zeros(n, np.int64)
+        self.ia_sum = np.zeros(n)
+        self.ia_sq = np.zeros(n)
+        self.jitter_sum = np.zeros(n)
+        self.jitter_count = np.zeros(n, np.int64)
+        self.gap_hist = np.zeros(MAX_GAP_BUCKET + 1, np.int64)
+        self.last_seq = np.full(n, -1, np.int64)
+        self.last_arrival = np.full(n, np.nan)
+        self.last_transit = np.full(n, np.nan)
+        self.last_tail_transit = np.full(n, np.nan)
+
+    def add(self, chunk):
+        dev = chunk['device_id'].astype(np.int64)
+        if not len(dev):
+            return
+        # stable sort keeps each device's rows in written order
+        order = np.argsort(dev, kind='stable')
+        dev = dev[order]
+        seq = chunk['seq_num'].astype(np.int64)[order]
+        value = chunk['value'].astype(np.float64)[order]
+        arrival = chunk['arrival_time'].astype(np.float64)[order]
+        transit = arrival - chunk['timestamp'].astype(np.float64)[order]
+        dup_flag = chunk['duplicate_flag'][order] != 0
+
+        first = np.empty(len(dev), dtype=bool)
+        first[0] = True
+        np.not_equal(dev[1:], dev[:-1], out=first[1:])
+        starts = np.flatnonzero(first)
+        ends = np.append(starts[1:], len(dev)) - 1
+        devs = dev[starts]
+
+        def per_device(x):
+            return np.add.reduceat(x, starts)
+
+        # serial-number step from the previous reading of the same device (first reading: from -1)
+        step = (seq - _previous(seq, first, self.last_seq[devs]) + SEQ_HALF) % SEQ_MOD - SEQ_HALF
+        gap = np.where(step > 1, step - 1, 0)
+        self.rows[devs] += ends - starts + 1
+        self.lost[devs] += per_device(gap)
+        self.gaps[devs] += per_device(gap > 0)
+        self.max_gap[devs] = np.maximum(self.max_gap[devs], np.maximum.reduceat(gap, starts))
+        self.gap_hist += np.bincount(np.minimum(gap[gap > 0], MAX_GAP_BUCKET), minlength=MAX_GAP_BUCKET + 1)
+        self.duplicates[devs] += per_device((step == 0) | dup_flag)
+        # seq went backwards by more than a reorder: the device restarted (new epoch)
+        self.restarts[devs] += per_device(step < 0)
+
+        self.danger[devs] += per_device(value >= DANGER_THRESHOLD)
+        self.value_sum[devs] += per_device(value)
+        self.value_sq[devs] += per_device(value * value)
+        self.value_min[devs] = np.minimum(self.value_min[devs], np.minimum.reduceat(value, starts))
+        self.value_max[devs] = np.maximum(self.value_max[devs], np.maximum.reduceat(value, starts))
+
+        # inter-arrival and jitter between packets; readings of one packet share an arrival time.
+        # jitter is the mean |change in transit time| (arrival - sender timestamp), as in RFC 3550,
+        # between the last readings of consecutive packets: a batch is sent right after its last
+        # reading, while earlier readings also carry how long they waited for the batch to fill
+        interarrival = arrival - _previous(arrival, first, self.last_arrival[devs])
+        new_packet = interarrival > 0
+        interarrival = np.where(new_packet, interarrival, 0.0)
+        # at the first row of a packet: transit of the last reading of the packet before it
+        tail = _previous(transit, first, self.last_transit[devs])
+        # ... and, carried forward over each packet, that of the packet before that one
+        carried = self.last_tail_transit[devs]
+        earlier = np.where(new_packet, tail, np.nan)
+        earlier[starts] = np.where(new_packet[starts], tail[starts], carried)
+        earlier = earlier[np.maximum.accumulate(np.where(new_packet | first, np.arange(len(dev)), 0))]
+        transit_change = np.abs(tail - _previous(earlier, first, carried))
+        jitter_sample = new_packet & ~np.isnan(transit_change)
+        self.ia_count[devs] += per_device(new_packet)
+        self.ia_sum[devs] += per_device(interarrival)
+        self.ia_sq[devs] += per_device(interarrival * interarrival)
+        self.jitter_sum[devs] += per_device(np.where(jitter_sample, transit_change, 0.0))
+        self.jitter_count[devs] += per_device(jitter_sample)
+
+        self.last_seq[devs] = seq[ends]
+        self.last_arrival[devs] = arrival[ends]
+        self.last_transit[devs] = transit[ends]
+        self.last_tail_transit[devs] = earlier[ends]
+
+    def _summarize(self, idx):
+        rows = self.rows[idx].sum()
+        lost = self.lost[idx].sum()
+        ia_count = self.ia_count[idx].sum()
+        ia_mean = self.ia_sum[idx].sum() / max(ia_count, 1)
+        value_mean = self.value_sum[idx].sum() / max(rows, 1)
+        return {
+            'readings': int(rows),
+            'lost': int(lost),
+            'loss_rate': lost / max(rows + lost, 1),
+            'gaps': int(self.gaps[idx].sum()),
+            'max_gap': int(self.max_gap[idx].max(initial=0)),
+            'duplicates': int(self.duplicates[idx].sum()),
+            'dup_rate': self.duplicates[idx].sum() / max(rows, 1),
+            'restarts': int(self.restarts[idx].sum()),
+            'danger': int(self.danger[idx].sum()),
+            'danger_rate': self.danger[idx].sum() / max(rows, 1),
+            'value_mean': value_mean,
+            'value_std': float(np.sqrt(max(self.value_sq[idx].sum() / max(rows, 1) - value_mean ** 2, 0.0))),
+            'value_min': float(self.value_min[idx].min(initial=np.inf)) if rows else None,
+            'value_max': float(self.value_max[idx].max(initial=-np.inf)) if rows else None,
+            'interarrival_mean_s': ia_mean,
+            'interarrival_std_s': float(np.sqrt(max(self.ia_sq[idx].sum() / max(ia_count, 1) - ia_mean ** 2, 0.0))),
+            'jitter_ms': self.jitter_sum[idx].sum() / max(self.jitter_count[idx].sum(), 1) * 1000,
+        }
+
+    def devices(self):
+        return [int(d) for d in np.flatnonzero(self.rows)]
+
+    def summary(self):
+        """Totals over all devices, plus the gap-length histogram."""
+        out = self._summarize(self.rows > 0)
+        out['devices'] = len(self.devices())
+        out['gap_lengths'] = {(f"{n}+" if n == MAX_GAP_BUCKET else str(n)): int(c)
+                              for n, c in enumerate(self.gap_hist) if c}
+        return out
+
+    def per_device(self):
+        return {d: self._summarize(d) for d in self.devices()}
+
+
+def analyze(path, chunk_rows=CHUNK_ROWS):
+    stats = RunStats()
+    for chunk in iter_run(path, chunk_rows):
+        stats.add(chunk)
+    return stats
+
+
+# -------------------------
+# CLI
+# -------------------------
+def run_label(path):
+    path = path.rstrip('/')
+    if os.path.isdir(path):
+        return os.path.basename(path)
+    return os.path.basename(os.path.dirname(path)) or os.path.basename(path)
+
+
+def run_labels(paths):
+    """Short labels for paths; runs whose short labels collide are labelled by their path."""
+    short = [run_label(p) for p in paths]
+    labels = [p.rstrip('/') or p if short.count(label) > 1 else label for p, label in zip(paths, short)]
+    # the same path given twice still needs distinct keys
+    seen = {}
+    for i, label in enumerate(labels):
+        seen[label] = seen.get(label, 0) + 1
+        if seen[label] > 1:
+            labels[i] = f"{label} ({seen[label]})"
+    return labels
+
+
+def print_table(rows):
+    w = max([18] + [len(label) + 2 for label, _ in rows])
+    print(f"{'run':<{w}}{'devices':>8}{'readings':>11}{'lost':>8}{'loss %':>8}{'max gap':>8}{'dups':>7}"
+          f"{'danger %':>9}{'value':>8}{'ia s':>8}{'jitter ms':>10}")
+    for label, s in rows:
+        print(f"{label:<{w}}{s.get('devices', 1):>8}{s['readings']:>11}{s['lost']:>8}{s['loss_rate'] * 100:>8.2f}"
+              f"{s['max_gap']:>8}{s['duplicates']:>7}{s['danger_rate'] * 100:>9.2f}{s['value_mean']:>8.1f}"
+              f"{s['interarrival_mean_s']:>8.2f}{s['jitter_ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="packets.csv files, segment directories or run directories")
+    parser.add_argument('--per-device', action='store_true', help="also print one line per device")
+    parser.add_argument('--json', help="write all results to this JSON file")
+    parser.add_argument('--chunk', type=int, default=CHUNK_ROWS, help="rows per chunk (bounds memory)")
+    args = parser.parse_args()
+
+    results = {}
+    for path, label in zip(args.paths, run_labels(args.paths)):
+        stats = analyze(path, args.chunk)
+        results[label] = {'summary': stats.summary(), 'devices': stats.per_device()}
+
+    print_table([(label, r['summary']) for label, r in results.items()])
+    if args.per_device:
+        for label, r in results.items():
+            print(f"\n[{label}]")
+            print_table([(f"device {d}", s) for d, s in r['devices'].items()])
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"[ANALYSIS] wrote {args.json}")
+
+
+if __name__ == "__main__":
+    main()
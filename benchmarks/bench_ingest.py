@@ -0,0 +1,286 @@
+"""In-process ingest benchmark: decode -> dedup -> reorder -> sink, no sockets, no sleeps.
+
+Feeds pre-encoded DATA packets for several traffic shapes straight into
+IngestState.handle_datagram, writing to a real sink (--sink csv or binary, in a
+temporary directory; null skips the write stage), and reports packets/sec, ns per
+reading, p50/p99 per-packet latency and peak traced memory. Throughput is process
+CPU time, so the sink's writer thread counts, from the first packet until the sink
+has closed; each of --repeat repetitions replays the stream at least --min-time
+CPU seconds and the median repetition is reported.
+
+Shared machines drift by tens of percent over minutes, so regressions are judged on
+"relative": ingest time divided by the time of a fixed reference loop (plain header
+and value decoding of the same packets) run right before it in each repetition, which
+cancels out the machine's current speed. The spread column is the interquartile range
+of the relative cost over the repetitions, divided by its median. A scenario fails the
+run when its median relative cost is above its baseline by more than --tolerance,
+which by default is the larger of the baseline's and this run's spread (at least
+MIN_TOLERANCE), so the gate moves with the noise it has measured.
+
+    python3 benchmarks/bench_ingest.py            # compare against baselines (a few seconds)
+    python3 benchmarks/bench_ingest.py --save     # record new baselines on this machine
+"""
+import argparse, gc, json, os, random, shutil, struct, sys, tempfile, time, tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from headers import HEADER_STRUCT
+from ingest import IngestState
+from sinks import CsvSink
+from storage import SegmentSink
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines.json')
+# smallest regression the default tolerance flags, however quiet the runs were
+MIN_TOLERANCE = 0.15
+
+
+class NullSink:
+    """Sink stand-in that only counts rows (--sink null), to measure the receive path alone."""
+
+    backpressure_events = 0
+    rows_dropped = rows_failed = 0
+    cpu_time = 0.0
+
+    def __init__(self):
+        self.rows = 0
+
+    def write(self, row):
+        self.rows += 1
+
+    def tick(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# -------------------------
+# Synthetic streams: lists of encoded datagrams
+# -------------------------
+def encode(dev, seq, values, flags=0, ts=1700000000):
+    return HEADER_STRUCT.pack(dev, seq, ts, 1, flags) + struct.pack(f"!{len(values)}H", *values)
+
+
+def stream_in_order(rnd, devices=100, per_device=50):
+    return [encode(100 + d, s, [rnd.randint(1, 110)]) for s in range(per_device) for d in range(devices)]
+
+
+def stream_reordered(rnd, devices=100, per_device=50):
+    packets = []
+    for d in range(devices):
+        seqs = list(range(per_device))
+        for base in range(0, per_device, 8):
+            block = seqs[base:base + 8]
+            rnd.shuffle(block)
+            seqs[base:base + 8] = block
+        packets.extend(encode(100 + d, s, [rnd.randint(1, 110)]) for s in seqs)
+    rnd.shuffle(packets)
+    return packets
+
+
+def stream_duplicated(rnd, devices=100, per_device=50):
+    packets = stream_in_order(rnd, devices, per_device)
+    out = []
+    for p in packets:
+        out.append(p)
+        if rnd.random() < 0.2:
+            out.append(p)
+    return out
+
+
+def stream_lossy(rnd, devices=100, per_device=50):
+    return [p for p in stream_in_order(rnd, devices, per_device) if rnd.random() >= 0.05]
+
+
+def stream_batched(rnd, devices=100, per_device=25, batch=8):
+    return [encode(100 + d, s, [rnd.randint(1, 110) for _ in range(batch)])
+            for s in range(0, per_device * batch, batch) for d in range(devices)]
+
+
+def stream_many_devices(rnd, devices=2500, per_device=2):
+    return [encode(d, s, [rnd.randint(1, 110)]) for s in range(per_device) for d in range(devices)]
+
+
+SCENARIOS = {
+    'in_order': stream_in_order,
+    'reordered': stream_reordered,
+    'duplicated': stream_duplicated,
+    'lossy': stream_lossy,
+    'batched': stream_batched,
+    'many_devices': stream_many_devices,
+}
+
+
+# -------------------------
+# Runner
+# -------------------------
+def readings_in(packets):
+    return sum((len(p) - HEADER_STRUCT.size) // 2 for p in packets)
+
+
+class SinkFactory:
+    """Fresh sinks of one kind, each writing under its own temporary directory."""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.root = tempfile.mkdtemp(prefix='bench_ingest-') if kind != 'null' else None
+        self.made = 0
+
+    def __call__(self):
+        if self.kind == 'null':
+            return NullSink()
+        self.made += 1
+        directory = os.path.join(self.root, str(self.made))
+        if self.kind == 'binary':
+            return SegmentSink(directory)
+        os.makedirs(directory)
+        return CsvSink(open(os.path.join(directory, 'packets.csv'), 'w', newline=''))
+
+    def cleanup(self):
+        if self.root is not None:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+
+def replay_ingest(packets, make_sink):
+    state = IngestState(make_sink())
+    handle = state.handle_datagram
+    for p in packets:
+        handle(p, 0, len(p), 0.0)
+    state.flush_all()
+    state.sink.close()
+
+
+def replay_reference(packets, make_sink=None):
+    """Machine-speed yardstick: decode every header and value list, no ingest logic."""
+    unpack_header = HEADER_STRUCT.unpack_from
+    size = HEADER_STRUCT.size
+    totals = {}
+    for p in packets:
+        dev = unpack_header(p)[0]
+        values = struct.unpack_from(f"!{(len(p) - size) // 2}H", p, size)
+        totals[dev] = totals.get(dev, 0) + sum(values)
+    return totals
+
+
+def time_replays(replay, packets, make_sink, min_time):
+    """Process CPU seconds per replay(packets, make_sink), averaged over at least min_time."""
+    total, rounds = 0.0, 0
+    gc.collect()
+    while total < min_time or not rounds:
+        start = time.process_time()
+        replay(packets, make_sink)
+        total += time.process_time() - start
+        rounds += 1
+    return total / rounds
+
+
+def run_scenario(packets, make_sink, repeat, min_time):
+    times, relative = [], []
+    for _ in range(max(1, repeat)):
+        reference = time_replays(replay_reference, packets, None, min_time / 2)
+        elapsed = time_replays(replay_ingest, packets, make_sink, min_time)
+        times.append(elapsed)
+        relative.append(elapsed / reference)
+    times.sort()
+    relative.sort()
+    median = times[len(times) // 2]
+    median_relative = relative[len(relative) // 2]
+    quartile = len(relative) // 4
+
+    # per-packet latency pass (timer overhead included, so compare runs with each other only)
+    state = IngestState(make_sink())
+    handle = state.handle_datagram
+    clock = time.perf_counter_ns
+    samples = []
+    for p in packets:
+        t0 = clock()
+        handle(p, 0, len(p), 0.0)
+        samples.append(clock() - t0)
+    samples.sort()
+    state.sink.close()
+
+    # memory pass
+    tracemalloc.start()
+    state = IngestState(make_sink())
+    for p in packets:
+        state.handle_datagram(p, 0, len(p), 0.0)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    state.sink.close()
+
+    readings = readings_in(packets)
+    return {
+        'packets': len(packets),
+        'readings': readings,
+        'packets_per_sec': len(packets) / median,
+        'ns_per_reading': median * 1e9 / max(readings, 1),
+        'relative': median_relative,
+        'spread': (relative[-1 - quartile] - relative[quartile]) / median_relative,
+        'p50_ns': samples[len(samples) // 2],
+        'p99_ns': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+        'peak_mem_kib': peak / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', action='append', choices=sorted(SCENARIOS), help="run only these scenarios")
+    parser.add_argument('--sink', choices=('csv', 'binary', 'null'), default='csv',
+                        help="sink written to (in a temporary directory); null skips the write stage")
+    parser.add_argument('--repeat', type=int, default=5, help="timed repetitions; the median one is reported")
+    parser.add_argument('--min-time', type=float, default=0.05, help="CPU seconds each repetition replays its stream for")
+    parser.add_argument('--save', action='store_true', help="store results as the new baselines")
+    parser.add_argument('--tolerance', type=float,
+                        help="allowed regression of the relative cost (fraction); default: the larger spread "
+                             f"of baseline and run, at least {MIN_TOLERANCE:.0%}")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    # the ingest path prints nothing for DATA packets, so stdout stays readable
+    names = args.scenario or list(SCENARIOS)
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    results = {}
+    regressions = []
+    make_sink = SinkFactory(args.sink)
+    # baselines are per sink kind; csv keeps the plain scenario names
+    suffix = '' if args.sink == 'csv' else f"/{args.sink}"
+    print(f"{'scenario':<14}{'packets':>9}{'pkt/s':>12}{'ns/reading':>12}{'relative':>10}{'spread':>8}{'p50 ns':>9}{'p99 ns':>9}"
+          f"{'peak KiB':>10}  vs baseline")
+    try:
+        for name in names:
+            packets = SCENARIOS[name](random.Random(args.seed))
+            r = results[name + suffix] = run_scenario(packets, make_sink, args.repeat, args.min_time)
+            base = baselines.get(name + suffix)
+            change = ''
+            if base and not args.save:
+                if 'relative' not in base:
+                    sys.exit(f"Baseline for {name} predates relative costs; rerun with --save")
+                ratio = r['relative'] / base['relative'] - 1
+                tolerance = args.tolerance
+                if tolerance is None:
+                    tolerance = max(MIN_TOLERANCE, base.get('spread', 0.0), r['spread'])
+                change = f"{ratio:+.1%} (allowed {tolerance:.0%})"
+                if ratio > tolerance:
+                    change += '  REGRESSION'
+                    regressions.append(name)
+            print(f"{name:<14}{r['packets']:>9}{r['packets_per_sec']:>12.0f}{r['ns_per_reading']:>12.0f}"
+                  f"{r['relative']:>10.2f}{r['spread']:>8.0%}{r['p50_ns']:>9}{r['p99_ns']:>9}{r['peak_mem_kib']:>10.0f}  {change}")
+    finally:
+        make_sink.cleanup()
+
+    if args.save:
+        baselines.update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f"Baselines saved to {BASELINES}")
+    elif regressions:
+        print(f"Regressions (relative cost above baseline by more than allowed): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
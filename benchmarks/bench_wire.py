@@ -0,0 +1,101 @@
+"""Wire format benchmark: v1 (Header.Pack_Message / unPack + '!H' values) vs v2 (wire.py).
+
+For several batch sizes, encodes and decodes a stream of DATA packets both ways and
+reports bytes per reading on the wire and encode / decode ns per reading. Readings
+are spaced like the client's (READING_INTERVAL ~4 s, with jitter), an hour into the
+device's session, so the v2 timestamp deltas have realistic sizes.
+
+    python3 benchmarks/bench_wire.py
+    python3 benchmarks/bench_wire.py --batch 1 --batch 8 --packets 20000
+"""
+import argparse, os, random, struct, sys, time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+from headers import Header
+import wire
+
+DEVICE_ID = 101
+SESSION_AGE_MS = 3600 * 1000
+
+
+def make_batches(rnd, packets, batch):
+    """[(first_seq, stamps_ms, values)] with v1-style values (mostly 1-50, some 51-110)."""
+    base_ms = 1700000000000
+    now_ms = base_ms + SESSION_AGE_MS
+    seq = 0
+    out = []
+    for _ in range(packets):
+        stamps, values = [], []
+        for _ in range(batch):
+            now_ms += 4000 + rnd.randint(-50, 50)
+            stamps.append(now_ms)
+            values.append(rnd.randint(51, 110) if rnd.random() < 0.10 else rnd.randint(1, 50))
+        out.append((seq, stamps, values))
+        seq += batch
+    return base_ms, out
+
+
+def encode_v1(batches):
+    encoded = []
+    for seq, stamps, values in batches:
+        h = Header(device_id=DEVICE_ID, seq_num=seq, msg_type=1, flags=0, timestamp=stamps[0] // 1000)
+        encoded.append(h.Pack_Message() + struct.pack(f"!{len(values)}H", *values))
+    return encoded
+
+
+def decode_v1(packets):
+    h = Header()
+    for p in packets:
+        h.unPack(p[:Header.Size])
+        struct.unpack(f"!{(len(p) - Header.Size) // 2}H", p[Header.Size:])
+
+
+def encode_v2(base_ms, batches):
+    return [wire.encode_data(DEVICE_ID, seq, 0, base_ms, stamps, values) for seq, stamps, values in batches]
+
+
+def decode_v2(base_ms, packets):
+    for p in packets:
+        wire.decode_data(p, 0, len(p), base_ms)
+
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch', type=int, action='append', help="readings per packet (repeatable)")
+    parser.add_argument('--packets', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=3, help="timed repetitions; the best one is reported")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print(f"{'batch':>5} {'format':<7}{'bytes/reading':>14}{'encode ns':>11}{'decode ns':>11}")
+    for batch in args.batch or [1, 5, 32]:
+        base_ms, batches = make_batches(random.Random(args.seed), args.packets, batch)
+        readings = args.packets * batch
+
+        enc_v1, packets_v1 = timed(lambda: encode_v1(batches), args.repeat)
+        dec_v1, _ = timed(lambda: decode_v1(packets_v1), args.repeat)
+        enc_v2, packets_v2 = timed(lambda: encode_v2(base_ms, batches), args.repeat)
+        dec_v2, _ = timed(lambda: decode_v2(base_ms, packets_v2), args.repeat)
+
+        # v2 must round-trip exactly
+        for (seq, stamps, values), p in zip(batches, packets_v2):
+            assert wire.decode_data(p, 0, len(p), base_ms)[2:] == (seq, stamps, values)
+
+        for name, packets, enc, dec in (('v1', packets_v1, enc_v1, dec_v1), ('v2', packets_v2, enc_v2, dec_v2)):
+            size = sum(map(len, packets)) / readings
+            print(f"{batch:>5} {name:<7}{size:>14.2f}{enc * 1e9 / readings:>11.0f}{dec * 1e9 / readings:>11.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,196 @@
+"""Leveled, asynchronous event log for the per-packet [SERVER] / [CLIENT] / [NETEM] lines.
+
+Events are declared once at import and guarded at each use, so a disabled event
+costs the hot path one attribute check:
+
+    HEARTBEAT_LOG = event('server.heartbeat', "[SERVER] HEARTBEAT from {dev}")
+    ...
+    if HEARTBEAT_LOG.enabled:
+        HEARTBEAT_LOG.emit(dev=dev)
+
+emit() only applies sampling / rate limits and queues (time, event, fields); a
+background thread formats and writes the lines, so a slow stdout (or the `tee`
+behind it) never blocks the receive loop. When the queue is full, lines are
+dropped and counted rather than waited for.
+
+    LOG_LEVEL     debug | info | warning | error | off; per-packet events are debug
+    LOG_FORMAT    text (the classic lines) | json (one object per line, fields included)
+    LOG_FILE      append here instead of stdout
+    LOG_SAMPLE    name=N,... log one in N occurrences; N=0 turns the event off.
+                  Names are fnmatch patterns: server.*=0, client.data*=10
+    LOG_RATE      at most this many lines per second per event (0 = unlimited)
+    LOG_INTERVAL  seconds between [LOG] lines counting what was sampled out, rate
+                  limited or dropped in the interval
+"""
+import atexit, fnmatch, json, os, queue, sys, threading, time
+
+LEVELS = {'debug': 10, 'info': 20, 'warning': 30, 'error': 40, 'off': 100}
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+
+LOG_LEVEL = LEVELS.get(os.getenv("LOG_LEVEL", "debug").lower(), DEBUG)
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text").lower()
+LOG_FILE = os.getenv("LOG_FILE")
+LOG_RATE = float(os.getenv("LOG_RATE", 0))
+LOG_INTERVAL = float(os.getenv("LOG_INTERVAL", 10))
+LOG_QUEUE_MAX = 65536
+LEVEL_NAMES = {v: k for k, v in LEVELS.items()}
+
+
+def _parse_sample(spec):
+    rules = []
+    for part in spec.split(','):
+        if '=' in part:
+            pattern, n = part.split('=', 1)
+            rules.append((pattern.strip(), int(n)))
+    return rules
+
+
+LOG_SAMPLE = _parse_sample(os.getenv("LOG_SAMPLE", ""))
+
+
+class Event:
+    """One kind of log line. Counters are approximate under concurrent emitters."""
+
+    def __init__(self, name, template, level, every, rate):
+        self.name = name
+        self.template = template
+        self.level = level
+        self.every = every
+        self.rate = rate
+        self.enabled = level >= LOG_LEVEL and every > 0
+        self.count = 0
+        self.suppressed = 0
+        self.dropped = 0
+        self.window_end = 0.0
+        self.window_left = 0
+
+    def emit(self, **fields):
+        self.count += 1
+        if self.every > 1 and self.count % self.every:
+            self.suppressed += 1
+            return
+        if self.rate:
+            now = time.monotonic()
+            if now >= self.window_end:
+                self.window_end = now + 1.0
+                self.window_left = self.rate
+            if self.window_left <= 0:
+                self.suppressed += 1
+                return
+            self.window_left -= 1
+        _writer.put(self, fields)
+
+    def format(self, t, fields):
+        if LOG_FORMAT == 'json':
+            return json.dumps({'t': round(t, 6), 'level': LEVEL_NAMES[self.level], 'event': self.name, **fields},
+                              default=str)
+        return self.template.format(**fields)
+
+
+class LogWriter:
+    """Queue plus the background thread that writes it; started on first use (again after fork)."""
+
+    def __init__(self):
+        self.events = {}
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_MAX)
+        self.thread = None
+        # per event: (suppressed, dropped) at the last summary
+        self.reported = {}
+
+    def put(self, event, fields):
+        if self.thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait((time.time(), event, fields))
+        except queue.Full:
+            event.dropped += 1
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+
+    def _run(self):
+        q = self.queue
+        out = open(LOG_FILE, 'a', buffering=1 << 16) if LOG_FILE else sys.stdout
+        next_summary = time.monotonic() + LOG_INTERVAL
+        while True:
+            try:
+                items = [q.get(timeout=max(0.0, next_summary - time.monotonic()))]
+            except queue.Empty:
+                items = []
+            while items and len(items) < 1024:
+                try:
+                    items.append(q.get_nowait())
+                except queue.Empty:
+                    break
+            lines = []
+            for t, event, fields in items:
+                try:
+                    lines.append(event.format(t, fields))
+                except (KeyError, ValueError, TypeError) as e:
+                    lines.append(f"[LOG] bad fields for {event.name}: {e!r}")
+            if time.monotonic() >= next_summary:
+                lines.extend(self.summary(total=False))
+                next_summary = time.monotonic() + LOG_INTERVAL
+            if lines:
+                try:
+                    out.write('\n'.join(lines) + '\n')
+                    out.flush()
+                except (OSError, ValueError):
+                    pass
+            for _ in items:
+                q.task_done()
+
+    def summary(self, total):
+        """[LOG] lines for events that lost lines since the last summary (or ever, with total)."""
+        parts = []
+        for event in list(self.events.values()):
+            last = (0, 0) if total else self.reported.get(event.name, (0, 0))
+            suppressed, dropped = event.suppressed - last[0], event.dropped - last[1]
+            self.reported[event.name] = (event.suppressed, event.dropped)
+            if suppressed or dropped:
+                parts.append(f"{event.name} {suppressed} sampled out, {dropped} dropped (of {event.count})")
+        if not parts:
+            return []
+        return [f"[LOG] {'totals' if total else f'last {LOG_INTERVAL:g}s'}: {'; '.join(parts)}"]
+
+    def flush(self):
+        if self.thread is not None:
+            self.queue.join()
+
+
+_writer = LogWriter()
+# a forked worker must not share the parent's queue or expect its thread
+os.register_at_fork(after_in_child=_writer.reset)
+atexit.register(_writer.flush)
+
+
+def event(name, template, level=DEBUG):
+    """Declare (or return the already declared) event called name."""
+    existing = _writer.events.get(name)
+    if existing is not None:
+        return existing
+    every = 1
+    for pattern, n in LOG_SAMPLE:
+        if fnmatch.fnmatchcase(name, pattern):
+            every = n
+    e = _writer.events[name] = Event(name, template, level, every, LOG_RATE)
+    return e
+
+
+def flush_log():
+    """Wait until every queued line is written; call before printing shutdown summaries."""
+    _writer.flush()
+
+
+def log_totals():
+    """Print what sampling, rate limits and a full queue kept out of the log over the whole run."""
+    flush_log()
+    for line in _writer.summary(total=True):
+        print(line)
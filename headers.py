@@ -63,3 +63,23 @@ class Header:
         2,#message type
         self.flags 
         )
+
+
+# precompiled codec for the receive hot path (decode with unpack_from, no Header objects)
+HEADER_STRUCT = struct.Struct(Header.Format)
+
+# DATA flags
+FLAG_DANGER = 0x01   # reading needs an ACK
+FLAG_SACK = 0x02     # sender understands selective ACKs (reply with SACK_STRUCT instead of '!BI')
+
+# Selective ACK (msg type 5): cumulative seq, base seq, 64-bit bitmap.
+# Every seq <= cumulative is settled (written or given up as lost; 0xFFFFFFFF = none yet);
+# bit i of the bitmap means seq (base - i) has been received.
+MSG_SACK = 5
+SACK_STRUCT = struct.Struct('!BIIQ')
+SACK_NONE = 0xFFFFFFFF
+SACK_BITS = 64
+
+# INIT payload: boot id the device picks at start-up. A new boot id starts a new seq
+# stream (epoch) on the server; a repeated INIT with the same boot id changes nothing.
+INIT_STRUCT = struct.Struct('!I')
@@ -0,0 +1,446 @@
+import os, struct, time
+from itertools import repeat
+from headers import Header, HEADER_STRUCT, FLAG_DANGER, FLAG_SACK, MSG_SACK, SACK_STRUCT, SACK_NONE, SACK_BITS
+from wire import V2_MARKER, V2_PREFIX, WIRE_MAX, MSG_INIT_ACK, INIT_ACK_STRUCT, parse_init, decode_data, is_v2_frame
+from seqnum import SEQ_MASK, unwrap
+from sessions import SessionTable
+from timerwheel import TimerWheel
+from metrics import Registry, LATENCY_BUCKETS, PROCESSING_BUCKETS, DEPTH_BUCKETS
+from profiling import StageProfiler, PROFILE_STAGES
+from eventlog import event, INFO
+
+# counters every ingest worker reports at shutdown; summed by the parent in multi-worker mode
+COUNTER_NAMES = (
+    'packets_received', 'packets_bytes_total', 'dup_total', 'dup_seq_count',
+    'loss_count', 'readings_written', 'cpu_counts', 'cpu_total_time',
+    'shed_readings', 'shed_heartbeats', 'socket_drops', 'forward_drops', 'malformed_packets',
+    'reserved_id_packets',
+)
+
+# reorder stage: in-order readings are written at once; readings behind a gap are held
+# at most REORDER_HOLD_MS (then the gap counts as loss), and at most REORDER_WINDOW per device
+REORDER_HOLD_MS = float(os.getenv("REORDER_HOLD_MS", 2000))
+REORDER_WINDOW = int(os.getenv("REORDER_WINDOW", 64))
+# resolution of the release timer wheel shared by all devices
+REORDER_TICK_MS = float(os.getenv("REORDER_TICK_MS", 10))
+REORDER_HOLD = REORDER_HOLD_MS / 1000
+REORDER_TICK = REORDER_TICK_MS / 1000
+
+HEARTBEAT_LOG = event('server.heartbeat', "[SERVER] HEARTBEAT from {dev}")
+INIT_LOG = event('server.init', "[SERVER] INIT from {dev}", INFO)
+
+ALIVE_REPLY = struct.pack('!B', 4)
+ACK_STRUCT = struct.Struct('!BI')
+# '!nH' payload decoders for v1 DATA, one per reading count seen
+_VALUE_STRUCTS = {}
+
+
+def _values_struct(n):
+    s = _VALUE_STRUCTS.get(n)
+    if s is None:
+        s = _VALUE_STRUCTS[n] = struct.Struct(f'!{n}H')
+    return s
+
+
+class IngestState:
+    """Per-device dedup/reorder state and metrics for one ingest worker.
+
+    Every device_id must be owned by exactly one IngestState, otherwise the
+    duplicate and gap accounting below is wrong.
+    """
+
+    def __init__(self, sink, registry=None):
+        # sink: CsvSink-like object with write(row), tick() and close()
+        self.sink = sink
+
+        # packets_received: number of unique DATA packets accepted (not duplicate packets)
+        self.packets_received = 0
+        # total bytes across accepted packets (for bytes_per_report)
+        self.packets_bytes_total = 0
+        # duplicate metrics: total duplicate packet arrivals, and number of distinct seqs that experienced duplication
+        self.dup_total = 0
+        self.dup_seq_count = 0
+        self.loss_count = 0
+        # readings handed to the sink; counters() leaves out the rows it dropped or failed to write
+        self.readings_written = 0
+        self.cpu_counts = 0
+        self.cpu_total_time = 0
+        # server-side drops, kept apart from loss_count (network loss): readings and heartbeats
+        # shed by admission control, and datagrams the kernel dropped on a full socket buffer
+        self.shed_readings = 0
+        self.shed_heartbeats = 0
+        self.socket_drops = 0
+        # datagrams for another worker's device dropped because its inbox was full
+        self.forward_drops = 0
+        # v2 DATA frames that failed to decode (truncated, or values outside 0..65535)
+        self.malformed_packets = 0
+        # datagrams led by the v2 marker that are not v2 frames: v1 frames from the device
+        # ids 0xFF00-0xFFFF that v2 reserves; dropped rather than misread
+        self.reserved_id_packets = 0
+        # admission.AdmissionControl while ADMIT_CONTROL is on, and the slow-down hint byte
+        # appended to ACK/SACK/ALIVE replies while it sheds (b'' otherwise)
+        self.admission = None
+        self.hint = b''
+
+        # dev -> DeviceSession (reorder window, epoch, activity); idle sessions are evicted
+        self.sessions = SessionTable()
+        # release deadlines of sessions holding readings behind a gap
+        self.timers = TimerWheel(REORDER_TICK)
+
+        # snapshot point (seconds) -> counters at that moment
+        self.snapshots = {}
+
+        self.registry = registry if registry is not None else Registry()
+        self._register_metrics(self.registry)
+        # sampled per-stage timings (PROFILE_STAGES); None keeps the hot path to one check
+        self.profiler = None
+        # True while the current datagram is the sampled one
+        self.profiling = False
+        if PROFILE_STAGES:
+            self.profiler = StageProfiler(self.registry)
+            sink.write_observer = lambda seconds: self.profiler.observe('write', seconds)
+
+    def _register_metrics(self, r):
+        # plain counters are read at scrape time; only histograms and per-device counts touch the hot path
+        for name in ('packets_received', 'packets_bytes_total', 'dup_total', 'dup_seq_count',
+                     'loss_count', 'shed_readings', 'shed_heartbeats', 'socket_drops',
+                     'forward_drops', 'malformed_packets', 'reserved_id_packets'):
+            r.callback(f"telemetry_{name}", name.replace('_', ' '), lambda name=name: getattr(self, name))
+        # a gauge: rows the sink drops after the hand-off take it back down
+        r.callback("telemetry_readings_written", "readings handed to the sink less those it dropped or failed to write",
+                   lambda: self.counters()['readings_written'], kind='gauge')
+        r.callback("telemetry_cpu_seconds_total", "receive-path plus sink writer CPU seconds",
+                   lambda: self.counters()['cpu_total_time'])
+        r.callback("telemetry_devices", "devices with a live session", lambda: len(self.sessions), kind='gauge')
+        r.callback("telemetry_sessions_evicted", "sessions dropped for idleness or the SESSION_MAX cap",
+                   lambda: self.sessions.evicted)
+        r.callback("telemetry_sink_backpressure_events", "sink batches held back by a full queue",
+                   lambda: self.sink.backpressure_events)
+        r.callback("telemetry_sink_rows_dropped", "rows dropped because the sink queue stayed full",
+                   lambda: self.sink.rows_dropped)
+        r.callback("telemetry_sink_rows_failed", "rows the sink writer failed to write",
+                   lambda: self.sink.rows_failed)
+        self.m_latency = r.histogram("telemetry_write_latency_seconds",
+                                     "arrival to hand-off to the sink, per reading", LATENCY_BUCKETS)
+        self.m_processing = r.histogram("telemetry_packet_processing_seconds",
+                                        "CPU time per DATA packet", PROCESSING_BUCKETS)
+        self.m_depth = r.histogram("telemetry_reorder_depth", "readings buffered for the device after each DATA packet",
+                                   DEPTH_BUCKETS)
+        self.m_rx_batch = r.histogram("telemetry_rx_batch_datagrams",
+                                      "datagrams drained per wakeup (socket backlog)", DEPTH_BUCKETS)
+        self.m_device_readings = r.labeled_counter("telemetry_device_readings",
+                                                   "accepted readings per device (bounded)", "device")
+
+    # -------------------------
+    # Packet handling
+    # -------------------------
+    def handle_packet(self, packet, arrival_time):
+        """Process one datagram. Returns the reply to send back, or None."""
+        return self.handle_datagram(packet, 0, len(packet), arrival_time)
+
+    def handle_datagram(self, buf, offset, length, arrival_time):
+        """Process the datagram stored at buf[offset:offset + length] without copying it."""
+        if self.profiler is not None and self.profiler.sample():
+            return self.sampled(self.handle_datagram, buf, offset, length, arrival_time)
+        if length and buf[offset] == V2_MARKER:
+            return self.handle_v2(buf, offset, length, arrival_time)
+        if length < Header.Size:
+            return None
+
+        dev, seq, timestamp, msg_type, flags = HEADER_STRUCT.unpack_from(buf, offset)
+        if msg_type == 1:
+            return self.on_data(dev, seq, timestamp, flags, buf, offset, length, arrival_time)
+        if msg_type == 0:
+            return self.on_heartbeat(dev, arrival_time)
+        if msg_type == 2:
+            return self.on_init(dev, arrival_time, *parse_init(buf, offset, length))
+        return None
+
+    def sampled(self, handle, *args):
+        """Run handle(*args) as the profiler's sampled datagram.
+
+        The engine closes the sample with profiler.mark('ack') and end() once the reply is sent.
+        """
+        profiler = self.profiler
+        profiler.begin()
+        self.profiling = True
+        try:
+            reply = handle(*args)
+        finally:
+            self.profiling = False
+        if 'decode' not in profiler.pending:
+            # not a DATA packet: no stages to report
+            profiler.active = False
+        return reply
+
+    def handle_v2(self, buf, offset, length, arrival_time):
+        """Compact v2 frame (wire.py), sent by devices that negotiated it in their INIT."""
+        if not is_v2_frame(buf, offset, length):
+            self.reserved_id_packets += 1
+            return None
+        _, version_type, dev = V2_PREFIX.unpack_from(buf, offset)
+        if version_type & 0x0F == 1:
+            return self.on_data_v2(dev, buf, offset, length, arrival_time)
+        return self.on_heartbeat(dev, arrival_time)
+
+    def on_heartbeat(self, dev, arrival_time):
+        # reply so clients can detect server liveness; keeps an existing session from going idle
+        admission = self.admission
+        if admission is not None and admission.level and not admission.admit_heartbeat():
+            self.shed_heartbeats += 1
+            return None
+        if HEARTBEAT_LOG.enabled:
+            HEARTBEAT_LOG.emit(dev=dev)
+        self.sessions.touch(dev, arrival_time)
+        return ALIVE_REPLY + self.hint if self.hint else ALIVE_REPLY
+
+    def on_init(self, dev, arrival_time, boot_id=None, wire=1, base_ms=None):
+        # device (re)started: release what the previous stream left, then start a new epoch.
+        # A repeated INIT (same boot id, e.g. duplicated in the network) keeps the stream.
+        if INIT_LOG.enabled:
+            INIT_LOG.emit(dev=dev)
+        session = self._session(dev, arrival_time)
+        if boot_id is None or boot_id != session.boot_id:
+            self._new_epoch(session, boot_id)
+        if base_ms is None:
+            # legacy INIT (boot id only): the device does not expect an answer
+            return None
+        # confirm the version the device should use from now on; the device repeats INIT
+        # until this arrives, so a lost INIT cannot leave its new stream behind the old one
+        session.wire = min(wire, WIRE_MAX)
+        session.base_ms = base_ms
+        return INIT_ACK_STRUCT.pack(MSG_INIT_ACK, session.wire)
+
+    def on_data(self, dev, seq, timestamp, flags, buf, offset, length, arrival_time):
+        # thread CPU only: the sink's writer thread accounts for its own share
+        cpu_start = time.thread_time()
+        window = self._session(dev, arrival_time)
+        admission = self.admission
+        if admission is not None and admission.level and not flags & FLAG_DANGER and not admission.admit_data():
+            return self._shed(window, seq, (length - Header.Size) // 2)
+        # payload is one or more !H readings (batch support); reading i carries seq + i,
+        # all stamped with the header's 1-second timestamp
+        values = _values_struct((length - Header.Size) // 2).unpack_from(buf, offset + Header.Size)
+        return self._accept_data(window, dev, seq, repeat(timestamp), values, flags, length, arrival_time, cpu_start)
+
+    def on_data_v2(self, dev, buf, offset, length, arrival_time):
+        cpu_start = time.thread_time()
+        window = self._session(dev, arrival_time)
+        base_ms = window.base_ms
+        try:
+            _, flags, seq, stamps, values = decode_data(buf, offset, length, base_ms or 0)
+        except (IndexError, ValueError):
+            self.malformed_packets += 1
+            return None
+        admission = self.admission
+        if admission is not None and admission.level and not flags & FLAG_DANGER and not admission.admit_data():
+            return self._shed(window, seq & SEQ_MASK, len(values))
+        if base_ms is None:
+            # INIT never reached us: deltas have nothing to anchor to, use the arrival time
+            stamps = repeat(arrival_time)
+        else:
+            stamps = [ts / 1000 for ts in stamps]
+        return self._accept_data(window, dev, seq & SEQ_MASK, stamps, values, flags, length, arrival_time, cpu_start)
+
+    def _accept_data(self, window, dev, seq, stamps, values, flags, length, arrival_time, cpu_start):
+        if self.profiling:
+            self.profiler.mark('decode')
+        # serial-number arithmetic: place the 32-bit wire seq next to this stream's position
+        # only INIT (a new boot id) starts a new stream: a seq far behind the stream is a
+        # stale duplicate, however old, and is counted as one below
+        ext_seq = unwrap(seq, max(window.max_seq_seen, window.last_written))
+        # track highest sequence seen for this device
+        if ext_seq > window.max_seq_seen:
+            window.max_seq_seen = ext_seq
+        reply = self._handle_data(window, dev, ext_seq, stamps, values, flags, length, arrival_time)
+        if reply is not None and self.hint:
+            reply += self.hint
+        cpu = time.thread_time() - cpu_start
+        self.cpu_counts += 1
+        self.cpu_total_time += cpu
+        self.m_processing.observe(cpu)
+        return reply
+
+    def _handle_data(self, window, dev, seq, stamps, values, flags, length, arrival_time):
+        # seq is unwrapped; replies and rows carry it masked back to 32 bits.
+        # reading i carries seq + i and timestamp stamps[i]
+        num_readings = len(values)
+
+        # classify readings: detect duplicates and buffer new readings
+        accepted = False
+        seq_i = seq
+        for timestamp, value in zip(stamps, values):
+            if window.is_duplicate(seq_i):
+                # already written or already buffered -> duplicate arrival
+                self._count_duplicate(window, seq_i)
+                seq_i += 1
+                continue
+            if seq_i == window.last_written + 1 and not window.pending:
+                # in order with nothing held: straight to the sink, no heap round trip
+                self.sink.write((dev, seq_i & SEQ_MASK, timestamp, value, 0, 0, arrival_time))
+                self.readings_written += 1
+                self.m_latency.observe(0.0)
+                window.last_written = seq_i
+            else:
+                window.add((seq_i, timestamp, value, arrival_time))
+            accepted = True
+            seq_i += 1
+
+        # accept packet only if it contains at least one new reading
+        if accepted:
+            self.packets_received += 1
+            self.packets_bytes_total += length
+            self.m_device_readings.inc(dev, num_readings)
+        if self.profiling:
+            self.profiler.mark('classify')
+        if window.pending:
+            self._release(dev, window, arrival_time)
+        self.m_depth.observe(len(window.pending))
+        if self.profiling:
+            self.profiler.mark('reorder')
+
+        # send ACK if requested: selective ACK covering the whole window when the client
+        # understands it, otherwise the legacy per-packet ACK (type 1 + seq32)
+        if flags & FLAG_DANGER:
+            if flags & FLAG_SACK:
+                base = seq + max(num_readings, 1) - 1
+                cumulative, bitmap = window.sack(base, SACK_BITS)
+                return SACK_STRUCT.pack(MSG_SACK, cumulative & SEQ_MASK if cumulative >= 0 else SACK_NONE,
+                                        base & SEQ_MASK, bitmap)
+            return ACK_STRUCT.pack(1, seq & SEQ_MASK)
+        return None
+
+    def _shed(self, window, seq, count):
+        # remember the seqs so the gap they leave is not charged to loss_count
+        ext_seq = unwrap(seq, max(window.max_seq_seen, window.last_written))
+        if ext_seq > window.last_written:
+            window.note_shed(ext_seq, ext_seq + count)
+            if ext_seq > window.max_seq_seen:
+                window.max_seq_seen = ext_seq
+        self.shed_readings += count
+        return None
+
+    def _count_duplicate(self, window, seq):
+        self.dup_total += 1
+        if window.mark_duplicate(seq):
+            self.dup_seq_count += 1
+
+    def _release(self, dev, window, now):
+        # write whatever now continues the stream; anything left waits for its gap
+        if window.heap[0] == window.last_written + 1:
+            self._write_batch(dev, window, window.pop_ready(), now)
+        while len(window.pending) > REORDER_WINDOW:
+            # window full: give up on the lowest gap
+            self._write_batch(dev, window, window.pop_through(window.heap[0]), now)
+            self._write_batch(dev, window, window.pop_ready(), now)
+        if window.pending and not window.release_at:
+            # not scheduled means nothing was held before this packet, so it is the oldest
+            window.release_at = now + REORDER_HOLD
+            self.timers.schedule(window.release_at, window)
+
+    def release_due(self, now):
+        """Write out readings held past REORDER_HOLD_MS; call every REORDER_TICK_MS or so."""
+        cutoff = now - REORDER_HOLD
+        for window in self.timers.advance(now):
+            window.release_at = 0.0
+            if not window.pending:
+                continue
+            through = window.expired_through(cutoff)
+            if through is not None:
+                self._write_batch(window.device_id, window, window.pop_through(through), now)
+                self._write_batch(window.device_id, window, window.pop_ready(), now)
+            if window.pending:
+                window.release_at = window.oldest_arrival() + REORDER_HOLD
+                self.timers.schedule(window.release_at, window)
+
+    def poll_timeout(self, idle):
+        """How long the receive loop may block before release_due() is needed again."""
+        return min(REORDER_TICK, idle) if len(self.timers) else idle
+
+    def _write_batch(self, dev, window, batch, now=None):
+        # batch is in seq order and every seq is above last_written (checked on insert)
+        expected = window.last_written + 1
+        write = self.sink.write
+        observe_latency = self.m_latency.observe
+        if now is None:
+            now = time.time()
+        for seq_b, ts_b, val_b, at_b in batch:
+            gap_flag = 0
+            if seq_b > expected:
+                # gap detected, count missing as loss unless admission control shed them
+                missing = seq_b - expected
+                if window.shed is not None:
+                    missing -= window.take_shed(expected, seq_b)
+                self.loss_count += missing
+                gap_flag = 1
+            write((dev, seq_b & SEQ_MASK, ts_b, val_b, 0, gap_flag, at_b))
+            self.readings_written += 1
+            observe_latency(now - at_b)
+            expected = seq_b + 1
+        window.last_written = expected - 1
+
+    def flush_all(self):
+        """Final flush of everything still buffered (shutdown)."""
+        for session in self.sessions:
+            self._write_batch(session.device_id, session, session.pop_all())
+
+    # -------------------------
+    # Sessions
+    # -------------------------
+    def _session(self, dev, now):
+        session, evicted = self.sessions.get(dev, now)
+        if evicted:
+            self._flush_evicted(evicted)
+        return session
+
+    def _new_epoch(self, session, boot_id):
+        self._write_batch(session.device_id, session, session.pop_all())
+        session.reset(session.epoch + 1, boot_id)
+
+    def evict_idle(self, now):
+        """Drop sessions idle past SESSION_IDLE_TIMEOUT, writing out their pending readings."""
+        evicted = self.sessions.evict_idle(now)
+        if evicted:
+            self._flush_evicted(evicted)
+        return len(evicted)
+
+    def _flush_evicted(self, evicted):
+        for session in evicted:
+            self._write_batch(session.device_id, session, session.pop_all())
+            self.sessions.remember(session)
+
+    # -------------------------
+    # Metrics
+    # -------------------------
+    def counters(self):
+        c = {name: getattr(self, name) for name in COUNTER_NAMES}
+        c['cpu_total_time'] += self.sink.cpu_time
+        c['readings_written'] -= self.sink.rows_dropped + self.sink.rows_failed
+        return c
+
+    def maybe_snapshot(self, elapsed, snapshot_points):
+        for t in snapshot_points:
+            if elapsed >= t and t not in self.snapshots:
+                self.snapshots[t] = self.counters()
+                rates = derived_metrics(self.snapshots[t])
+                print(f"[SNAPSHOT @ {t}s] bytes={rates['bytes_per_report']:.2f}, dup={rates['dup_rate']:.4f}, "
+                      f"loss={self.loss_count}, cpu={rates['cpu_ms_per_report']:.3f}")
+
+
+def merge_counters(counter_sets):
+    totals = dict.fromkeys(COUNTER_NAMES, 0)
+    for counters in counter_sets:
+        for name in COUNTER_NAMES:
+            totals[name] += counters.get(name, 0)
+    return totals
+
+
+def derived_metrics(c):
+    written = max(c['readings_written'], 1)
+    return {
+        # duplicate_rate per spec: dup_total / (readings_written + dup_total)
+        'dup_rate': c['dup_total'] / max(c['readings_written'] + c['dup_total'], 1),
+        # bytes per report (per reading)
+        'bytes_per_report': c['packets_bytes_total'] / written,
+        'cpu_ms_per_report': (c['cpu_total_time'] / written) * 1000,
+    }
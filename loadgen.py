@@ -0,0 +1,334 @@
+"""Load generator: thousands of virtual devices from one process.
+
+Devices share a pool of LOADGEN_SOCKETS UDP sockets and are driven by one asyncio
+scheduler (a heap of next-send deadlines), so 10k devices cost 10k heap entries
+rather than 20k threads or 10k sockets. The server keys sessions by device id, so
+a device may use any socket; ACKs carry only the seq, so a danger packet goes out on
+a socket where no other packet with that seq is waiting for its ACK, and the ACK is
+matched by (socket, seq). When every socket has one, ACKs for that seq on the
+device's own socket are credited in the order the packets were sent. INIT_ACKs carry
+no device id either, so every device's INIT is repeated, like the client's, until as
+many INIT_ACKs came back as there are devices or CLIENT_INIT_ATTEMPTS rounds passed. Device ids skip the range reserved for v2 frames.
+
+Like the client, a device that gets a slow-down hint from the server (admission.py)
+sends 2**level times the readings per packet, 2**level times less often, so the
+reading rate stays and the packet rate drops. Configuration is by environment
+variable, like the client:
+
+    LOADGEN_DEVICES=10000 LOADGEN_RATE=0.25 LOADGEN_DURATION=30 python3 loadgen.py
+"""
+import asyncio, collections, heapq, os, random, struct, sys, time
+from headers import Header
+from seqnum import SEQ_MASK
+from globals import server_IP, server_port, client_IP
+from Client import SLOWDOWN_HOLD
+from TinyTelemetryV1_Client import batch_scale, CLIENT_INIT_ATTEMPTS, INIT_TIMEOUT
+from wire import V1_DEVICE_MAX, WIRE_V1, MSG_INIT_ACK, encode_init
+
+LOADGEN_DEVICES = int(os.getenv("LOADGEN_DEVICES", 1000))
+# UDP sockets shared by the devices (one file descriptor each); devices advance their seqs
+# in step, so this also bounds how many danger packets with one seq can await an ACK
+LOADGEN_SOCKETS = max(1, int(os.getenv("LOADGEN_SOCKETS", 256)))
+# readings per second per device, and readings per DATA packet
+LOADGEN_RATE = float(os.getenv("LOADGEN_RATE", 0.25))
+LOADGEN_BATCH = int(os.getenv("LOADGEN_BATCH", 1))
+# probability a reading is drawn from the high range (51-110) like custom_random(); >= 60 is danger
+LOADGEN_DANGER_RATIO = float(os.getenv("LOADGEN_DANGER_RATIO", 0.10))
+LOADGEN_DURATION = float(os.getenv("LOADGEN_DURATION", 30))
+LOADGEN_HEARTBEAT_S = float(os.getenv("LOADGEN_HEARTBEAT_S", 30))
+LOADGEN_FIRST_DEVICE = int(os.getenv("LOADGEN_FIRST_DEVICE", 1000))
+LOADGEN_SEED = os.getenv("LOADGEN_SEED")
+# retransmission for danger packets, as in the client: RTO doubles up to 4 s, 5 attempts
+ACK_TIMEOUT = float(os.getenv("LOADGEN_ACK_TIMEOUT", 1.0))
+MAX_ATTEMPTS = 5
+
+ACK = struct.Struct('!BI')
+
+
+class VirtualDevice:
+    __slots__ = ('device_id', 'endpoint', 'seq', 'next_heartbeat')
+
+    def __init__(self, device_id, endpoint):
+        self.device_id = device_id
+        self.endpoint = endpoint  # home socket: INIT, heartbeats and DATA unless a seq clashes
+        self.seq = 0
+        self.next_heartbeat = 0.0
+
+
+class Endpoint(asyncio.DatagramProtocol):
+    """One pooled UDP socket; matches ACKs to the danger packets outstanding on it.
+
+    ACKs carry only the seq; pending maps it to the packets sent from this socket with
+    that seq, oldest first (normally just one), and an ACK settles the oldest.
+    """
+
+    def __init__(self, stats, index):
+        self.stats = stats
+        self.index = index
+        self.transport = None
+        self.pending = {}  # seq -> deque of Pending sent from this socket
+        # latest slow-down hint carried by an ACK or ALIVE reply, and when it arrived
+        self.hint = 0
+        self.hint_at = 0.0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) >= ACK.size and data[0] == 1:
+            self._note_hint(data, ACK.size)
+            p = self.settle(ACK.unpack_from(data)[1])
+            if p is not None:
+                p.acked = True
+                if p.attempts == 1:
+                    # Karn: only unambiguous samples count towards latency
+                    self.stats.ack_latencies.append(time.monotonic() - p.first_sent)
+                self.stats.acked += 1
+        elif data[:1] == b'\x04':
+            self._note_hint(data, 1)
+            self.stats.alive += 1
+        elif data[:1] == bytes([MSG_INIT_ACK]):
+            self.stats.init_acks += 1
+
+    def _note_hint(self, data, size):
+        self.hint = data[size] if len(data) > size else 0
+        self.hint_at = time.monotonic()
+
+    def track(self, p):
+        self.pending.setdefault(p.seq, collections.deque()).append(p)
+
+    def settle(self, seq, p=None):
+        """Remove p (default: the oldest) from the packets awaiting an ACK for seq."""
+        waiting = self.pending.get(seq)
+        if not waiting:
+            return None
+        if p is None:
+            p = waiting.popleft()
+        else:
+            waiting.remove(p)
+        if not waiting:
+            del self.pending[seq]
+        return p
+
+    def slowdown(self, now):
+        if self.hint and now - self.hint_at > SLOWDOWN_HOLD:
+            self.hint = 0
+        return self.hint
+
+    def error_received(self, exc):
+        self.stats.send_errors += 1
+
+    def send(self, packet):
+        self.transport.sendto(packet, (server_IP, server_port))
+        self.stats.packets_sent += 1
+        self.stats.bytes_sent += len(packet)
+
+
+class Pending:
+    __slots__ = ('endpoint', 'seq', 'packet', 'first_sent', 'attempts', 'acked')
+
+    def __init__(self, endpoint, seq, packet, now):
+        self.endpoint = endpoint
+        self.seq = seq
+        self.packet = packet
+        self.first_sent = now
+        self.attempts = 1
+        self.acked = False
+
+
+class Stats:
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.readings_sent = 0
+        self.danger_readings = 0
+        self.retransmits = 0
+        self.acked = 0
+        self.unacked = 0
+        self.alive = 0
+        self.init_acks = 0
+        self.send_errors = 0
+        self.slowed_packets = 0
+        self.rerouted = 0
+        self.shared_seq = 0
+        self.ack_latencies = []
+
+
+def make_value(rnd):
+    return rnd.randint(51, 110) if rnd.random() < LOADGEN_DANGER_RATIO else rnd.randint(1, 50)
+
+
+def device_ids(first, count):
+    """count consecutive ids from first, wrapping to 0 before the ids reserved for v2 frames."""
+    usable = V1_DEVICE_MAX + 1
+    if count > usable:
+        sys.exit(f"[LOADGEN] LOADGEN_DEVICES={count}: only {usable} device ids are usable")
+    start = first if 0 <= first < usable else 0
+    return [(start + i) % usable for i in range(count)]
+
+
+def pick_endpoint(home, endpoints, seq):
+    """home, or the next pooled socket with no packet of this seq awaiting an ACK (home if none)."""
+    if seq not in home.pending:
+        return home
+    for k in range(1, len(endpoints)):
+        ep = endpoints[(home.index + k) % len(endpoints)]
+        if seq not in ep.pending:
+            return ep
+    return home
+
+
+def raise_fd_limit(needed):
+    """Lift the soft open-file limit towards the hard one; warn if needed descriptors won't fit."""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft != resource.RLIM_INFINITY and soft < needed:
+            soft = hard if hard == resource.RLIM_INFINITY else min(hard, max(needed, soft))
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    except (ImportError, ValueError, OSError):
+        return
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        print(f"[LOADGEN] WARNING: open-file limit {soft} is below the {needed} descriptors needed; raise ulimit -n")
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float('nan')
+    k = min(len(sorted_values) - 1, int(round(p / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[k]
+
+
+async def run(duration=LOADGEN_DURATION):
+    loop = asyncio.get_running_loop()
+    rnd = random.Random(int(LOADGEN_SEED)) if LOADGEN_SEED else random.Random()
+    stats = Stats()
+
+    ids = device_ids(LOADGEN_FIRST_DEVICE, LOADGEN_DEVICES)
+    sockets = min(LOADGEN_SOCKETS, LOADGEN_DEVICES)
+    raise_fd_limit(sockets + 64)
+    endpoints = []
+    for k in range(sockets):
+        try:
+            _, ep = await loop.create_datagram_endpoint(lambda k=k: Endpoint(stats, k), local_addr=(client_IP, 0))
+        except OSError as e:
+            for ep in endpoints:
+                ep.transport.close()
+            sys.exit(f"[LOADGEN] Could not open socket {k + 1} of {sockets}: {e}; "
+                     f"lower LOADGEN_SOCKETS or raise ulimit -n")
+        endpoints.append(ep)
+    devices = [VirtualDevice(device_id, endpoints[i % sockets]) for i, device_id in enumerate(ids)]
+    inits = [encode_init(d.device_id, rnd.getrandbits(32), int(time.time() * 1000), WIRE_V1) for d in devices]
+    for attempt in range(CLIENT_INIT_ATTEMPTS):
+        # a repeated INIT keeps the stream (same boot id), so resending to every device is safe
+        for d, init in zip(devices, inits):
+            d.endpoint.send(init)
+        waited = loop.time() + INIT_TIMEOUT
+        while stats.init_acks < len(devices) and loop.time() < waited:
+            await asyncio.sleep(0.01)
+        if stats.init_acks >= len(devices):
+            break
+
+    # one packet every batch / rate seconds per device; start times spread over one interval
+    interval = max(1, LOADGEN_BATCH) / max(LOADGEN_RATE, 1e-9)
+    start = time.monotonic()
+    end = start + duration
+    schedule = [(start + rnd.random() * interval, i) for i in range(len(devices))]
+    heapq.heapify(schedule)
+    for d in devices:
+        d.next_heartbeat = start + rnd.random() * LOADGEN_HEARTBEAT_S
+    retransmit = []  # heap of (deadline, counter, Pending)
+    counter = 0
+
+    while True:
+        now = time.monotonic()
+        if now >= end:
+            break
+
+        # due DATA sends
+        while schedule and schedule[0][0] <= now:
+            due, i = heapq.heappop(schedule)
+            d = devices[i]
+            scale = batch_scale(d.endpoint.slowdown(now))
+            if scale > 1:
+                stats.slowed_packets += 1
+            values = [make_value(rnd) for _ in range(max(1, LOADGEN_BATCH) * scale)]
+            danger = any(v >= 60 for v in values)
+            h = Header(device_id=d.device_id, seq_num=d.seq, msg_type=1, flags=1 if danger else 0)
+            packet = h.Pack_Message() + struct.pack(f"!{len(values)}H", *values)
+            ep = pick_endpoint(d.endpoint, endpoints, d.seq) if danger else d.endpoint
+            if ep is not d.endpoint:
+                stats.rerouted += 1
+            elif danger and d.seq in ep.pending:
+                stats.shared_seq += 1
+            ep.send(packet)
+            stats.readings_sent += len(values)
+            stats.danger_readings += sum(1 for v in values if v >= 60)
+            if danger:
+                p = Pending(ep, d.seq, packet, now)
+                ep.track(p)
+                counter += 1
+                heapq.heappush(retransmit, (now + ACK_TIMEOUT, counter, p))
+            d.seq = (d.seq + len(values)) & SEQ_MASK
+            if LOADGEN_HEARTBEAT_S > 0 and now >= d.next_heartbeat:
+                d.endpoint.send(Header(device_id=d.device_id, msg_type=0).heartbeat())
+                d.next_heartbeat = now + LOADGEN_HEARTBEAT_S
+            heapq.heappush(schedule, (due + interval * scale, i))
+
+        # retransmission timers
+        while retransmit and retransmit[0][0] <= now:
+            _, _, p = heapq.heappop(retransmit)
+            if p.acked:
+                continue
+            if p.attempts >= MAX_ATTEMPTS:
+                stats.unacked += 1
+                p.endpoint.settle(p.seq, p)
+                continue
+            p.attempts += 1
+            stats.retransmits += 1
+            p.endpoint.send(p.packet)
+            rto = min(4.0, ACK_TIMEOUT * (2 ** (p.attempts - 1)))
+            counter += 1
+            heapq.heappush(retransmit, (now + rto, counter, p))
+
+        next_due = min(schedule[0][0] if schedule else end,
+                       retransmit[0][0] if retransmit else end, end)
+        await asyncio.sleep(max(0.0, next_due - time.monotonic()))
+
+    elapsed = time.monotonic() - start
+    # give in-flight ACKs a moment to arrive
+    await asyncio.sleep(min(1.0, ACK_TIMEOUT))
+    for ep in endpoints:
+        stats.unacked += sum(len(waiting) for waiting in ep.pending.values())
+        ep.pending.clear()
+        ep.transport.close()
+    report(stats, elapsed)
+    return stats
+
+
+def report(stats, elapsed):
+    lat = sorted(stats.ack_latencies)
+    print("\n[LOADGEN]")
+    print(f"Devices: {LOADGEN_DEVICES} on {min(LOADGEN_SOCKETS, LOADGEN_DEVICES)} sockets, "
+          f"batch={LOADGEN_BATCH}, rate={LOADGEN_RATE}/s/device")
+    print(f"Duration: {elapsed:.2f} s")
+    print(f"Packets sent: {stats.packets_sent} ({stats.packets_sent / max(elapsed, 1e-9):.1f} pkt/s)")
+    print(f"Readings sent: {stats.readings_sent} ({stats.readings_sent / max(elapsed, 1e-9):.1f} readings/s)")
+    print(f"Bytes sent: {stats.bytes_sent}")
+    print(f"Danger readings: {stats.danger_readings}")
+    print(f"ACKs: {stats.acked}, retransmits: {stats.retransmits}, unacked: {stats.unacked}")
+    if stats.rerouted:
+        print(f"Danger packets sent from another socket (seq already awaiting an ACK on the device's): "
+              f"{stats.rerouted}")
+    if stats.shared_seq:
+        print(f"Danger packets sharing a seq awaiting an ACK on their socket (credited in send order; "
+              f"raise LOADGEN_SOCKETS): {stats.shared_seq}")
+    print(f"ACK latency ms: p50={percentile(lat, 50) * 1000:.2f} p90={percentile(lat, 90) * 1000:.2f} "
+          f"p99={percentile(lat, 99) * 1000:.2f} (n={len(lat)})")
+    print(f"INIT_ACKs: {stats.init_acks}, ALIVE replies: {stats.alive}, send errors: {stats.send_errors}")
+    if stats.slowed_packets:
+        print(f"Packets batched up on a server slow-down hint: {stats.slowed_packets}")
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
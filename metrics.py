@@ -0,0 +1,227 @@
+"""In-process metrics registry with Prometheus text export and JSON dumps.
+
+Metric objects are updated with plain attribute arithmetic from the single ingest
+thread (no locks on the hot path); exporters only read them. Values owned by other
+code (e.g. IngestState counters) are exposed through callbacks evaluated at scrape
+time, so they cost nothing per packet.
+"""
+import bisect, json, os, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# local HTTP endpoint for /metrics (0 = disabled); worker N listens on METRICS_PORT + N
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+# periodic JSON dump path (unset = disabled) and interval in seconds
+METRICS_JSON = os.getenv("METRICS_JSON")
+METRICS_JSON_INTERVAL = float(os.getenv("METRICS_JSON_INTERVAL", 10))
+# per-device series kept before new devices are folded into device="other"
+METRICS_MAX_DEVICES = int(os.getenv("METRICS_MAX_DEVICES", 1000))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60)
+PROCESSING_BUCKETS = (1e-6, 5e-6, 1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 1e-3, 1e-2)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500, 1000)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self):
+        yield self.name, {}, self.value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class CallbackMetric:
+    """Counter or gauge whose value is read from fn() at collection time."""
+
+    def __init__(self, name, help_text, fn, kind='counter'):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+        self.kind = kind
+
+    def samples(self):
+        yield self.name, {}, self.fn()
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.bounds = tuple(buckets)
+        # counts[i] = observations <= bounds[i] but > bounds[i - 1]; last slot is +Inf
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, n in zip(self.bounds, self.counts):
+            cumulative += n
+            yield self.name + '_bucket', {'le': _fmt(bound)}, cumulative
+        yield self.name + '_bucket', {'le': '+Inf'}, self.count
+        yield self.name + '_sum', {}, self.sum
+        yield self.name + '_count', {}, self.count
+
+
+class BoundedLabelCounter:
+    """Counter per label value with at most max_series series; the rest share 'other'."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help_text, label, max_series=METRICS_MAX_DEVICES):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.max_series = max_series
+        self.values = {}
+        self.other = 0
+
+    def inc(self, key, n=1):
+        values = self.values
+        if key in values:
+            values[key] += n
+        elif len(values) < self.max_series:
+            values[key] = n
+        else:
+            self.other += n
+
+    def samples(self):
+        for key, value in list(self.values.items()):
+            yield self.name, {self.label: str(key)}, value
+        if self.other:
+            yield self.name, {self.label: 'other'}, self.other
+
+
+def _fmt(v):
+    return repr(float(v)) if not isinstance(v, int) else str(v)
+
+
+class Registry:
+    def __init__(self, const_labels=None):
+        self.metrics = []
+        self.const_labels = dict(const_labels or {})
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text):
+        return self.register(Counter(name, help_text))
+
+    def gauge(self, name, help_text):
+        return self.register(Gauge(name, help_text))
+
+    def histogram(self, name, help_text, buckets):
+        return self.register(Histogram(name, help_text, buckets))
+
+    def callback(self, name, help_text, fn, kind='counter'):
+        return self.register(CallbackMetric(name, help_text, fn, kind))
+
+    def labeled_counter(self, name, help_text, label, max_series=METRICS_MAX_DEVICES):
+        return self.register(BoundedLabelCounter(name, help_text, label, max_series))
+
+    def render_prometheus(self):
+        lines = []
+        for m in self.metrics:
+            lines.append(f"# HELP {m.name} {m.help}")
+            lines.append(f"# TYPE {m.name} {m.kind}")
+            for name, labels, value in m.samples():
+                labels = {**self.const_labels, **labels}
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        out = {'time': time.time(), 'labels': self.const_labels}
+        for m in self.metrics:
+            if isinstance(m, Histogram):
+                out[m.name] = {'buckets': dict(zip(map(_fmt, m.bounds), m.counts)), 'inf': m.counts[-1],
+                               'sum': m.sum, 'count': m.count}
+            elif isinstance(m, BoundedLabelCounter):
+                out[m.name] = {str(k): v for k, v in list(m.values.items())}
+                if m.other:
+                    out[m.name]['other'] = m.other
+            else:
+                out[m.name] = next(m.samples())[2]
+        return out
+
+
+# -------------------------
+# Exporters
+# -------------------------
+class MetricsExporter:
+    """Serves registry over HTTP (GET /metrics, Prometheus text) and/or dumps JSON periodically."""
+
+    def __init__(self, registry, port=METRICS_PORT, host=METRICS_HOST,
+                 json_path=METRICS_JSON, json_interval=METRICS_JSON_INTERVAL):
+        self.registry = registry
+        self.httpd = None
+        self.json_path = json_path
+        self.json_interval = json_interval
+        self.stop_event = threading.Event()
+        if port:
+            self.httpd = ThreadingHTTPServer((host, port), _make_handler(registry))
+            self.httpd.daemon_threads = True
+            threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+            print(f"[SERVER] Metrics on http://{host}:{port}/metrics")
+        if json_path:
+            threading.Thread(target=self._dump_loop, daemon=True).start()
+
+    def _dump_loop(self):
+        while not self.stop_event.wait(self.json_interval):
+            self.dump_json()
+
+    def dump_json(self):
+        if not self.json_path:
+            return
+        tmp = self.json_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.registry.to_dict(), f)
+        os.replace(tmp, self.json_path)
+
+    def close(self):
+        self.stop_event.set()
+        if self.httpd is not None:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+        self.dump_json()
+
+
+def _make_handler(registry):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/metrics', '/'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
@@ -0,0 +1,175 @@
+import heapq, os, random, threading, time
+from eventlog import event
+
+DROP_LOG = event('netem.drop', "[SIM NETEM] DROPPED seq={seq}")
+SCHEDULE_LOG = event('netem.schedule', "[NETEM SCHEDULE] seq={seq} delay_ms={delay_ms:.1f} target={target:.3f}")
+RELEASE_LOG = event('netem.release', "[NETEM RELEASE] seq={seq} sent to {addr}")
+# share of delayed packets reordered when SIMULATE_REORDER is unset
+DEFAULT_REORDER = 0.3
+
+
+class NetemProfile:
+    """Impairments applied to outgoing packets (a user-space stand-in for tc netem).
+
+    loss / duplicate / reorder are probabilities; delay_ms +- jitter_ms is the base
+    one-way delay; a reordered packet gets up to reorder_extra_ms more delay so later
+    packets overtake it; rate_kbps (0 = unlimited) serializes packets like a slow link.
+    """
+
+    def __init__(self, enabled=False, loss=0.0, delay_ms=0.0, jitter_ms=0.0, reorder=0.0,
+                 reorder_extra_ms=None, duplicate=0.0, rate_kbps=0.0, seed=None):
+        self.enabled = enabled
+        self.loss = loss
+        self.delay_ms = delay_ms
+        self.jitter_ms = jitter_ms
+        self.reorder = reorder
+        self.reorder_extra_ms = delay_ms * 2 if reorder_extra_ms is None else reorder_extra_ms
+        self.duplicate = duplicate
+        self.rate_kbps = rate_kbps
+        self.seed = seed
+
+    @classmethod
+    def from_env(cls):
+        seed = os.getenv("SIMULATE_SEED")
+        return cls(
+            enabled=os.getenv("SIMULATE_NETEM", "0") == "1",
+            loss=float(os.getenv("SIMULATE_LOSS", "0")),
+            delay_ms=float(os.getenv("SIMULATE_DELAY_MS", "0")),
+            jitter_ms=float(os.getenv("SIMULATE_JITTER_MS", "0")),
+            # reordering only matters when there is a delay to extend
+            reorder=float(os.getenv("SIMULATE_REORDER", str(DEFAULT_REORDER))),
+            reorder_extra_ms=float(os.environ["SIMULATE_REORDER_MS"]) if "SIMULATE_REORDER_MS" in os.environ else None,
+            duplicate=float(os.getenv("SIMULATE_DUPLICATE", "0")),
+            rate_kbps=float(os.getenv("SIMULATE_RATE_KBPS", "0")),
+            seed=int(seed) if seed else None,
+        )
+
+    def delays(self):
+        return self.delay_ms > 0 or self.jitter_ms > 0 or self.rate_kbps > 0
+
+
+class NetemScheduler:
+    """Per-socket impairment engine.
+
+    Packets that need no delay are sent inline. Delayed packets go on a deadline heap
+    served by one thread that sleeps on a condition variable exactly until the next
+    deadline (or until an earlier packet is scheduled), so an idle or lightly loaded
+    scheduler costs no polling.
+    """
+
+    def __init__(self, sock, profile, verbose=False, rng=None):
+        self.sock = sock
+        self.profile = profile
+        self.verbose = verbose
+        self.rng = rng or random.Random(profile.seed)
+        self.heap = []  # (deadline, counter, packet, addr, tag)
+        self.counter = 0
+        self.cond = threading.Condition()
+        self.link_free_at = 0.0
+        self.closed = False
+        self.thread = None
+        self.sent = 0
+        self.dropped = 0
+        self.duplicated = 0
+        self.delayed = 0
+
+    def send(self, packet, addr, tag=None):
+        """Send or schedule packet. Returns True if sent or scheduled, False if dropped."""
+        if not self.profile.enabled:
+            return self._send_now(packet, addr)
+        now = time.time()
+        deadlines = self.plan(len(packet), now, tag)
+        if not deadlines:
+            return False
+        if not self.profile.delays():
+            ok = self._send_now(packet, addr)
+            if len(deadlines) == 2:
+                self._send_now(packet, addr)
+            return ok
+        for deadline in deadlines:
+            self._schedule(deadline, packet, addr, tag)
+            if self.verbose and SCHEDULE_LOG.enabled:
+                SCHEDULE_LOG.emit(seq=tag, delay_ms=(deadline - now) * 1000, target=deadline)
+        return True
+
+    def plan(self, size, now, tag=None):
+        """Impairment decisions for one packet of size bytes sent at now.
+
+        Returns the delivery time of each copy: [] if dropped, two entries if duplicated.
+        Also used without a socket by the simulated transport (simulate.py).
+        """
+        p = self.profile
+        rng = self.rng
+        if p.loss > 0 and rng.random() < p.loss:
+            self.dropped += 1
+            if DROP_LOG.enabled:
+                DROP_LOG.emit(seq=tag)
+            return []
+        copies = 2 if p.duplicate > 0 and rng.random() < p.duplicate else 1
+        if copies == 2:
+            self.duplicated += 1
+        if not p.delays():
+            return [now] * copies
+
+        deadlines = []
+        for _ in range(copies):
+            delay_ms = p.delay_ms + rng.uniform(-p.jitter_ms, p.jitter_ms)
+            # occasional reordering by increasing delay for this packet
+            if p.reorder > 0 and rng.random() < p.reorder:
+                delay_ms += rng.uniform(0, p.reorder_extra_ms)
+            deadline = now + max(0.0, delay_ms / 1000.0)
+            if p.rate_kbps > 0:
+                # serialize on the emulated link: a packet leaves after the previous one
+                start = max(deadline, self.link_free_at)
+                self.link_free_at = start + size * 8 / (p.rate_kbps * 1000.0)
+                deadline = self.link_free_at
+            deadlines.append(deadline)
+        return deadlines
+
+    def _send_now(self, packet, addr):
+        try:
+            self.sock.sendto(packet, addr)
+        except Exception:
+            return False
+        self.sent += 1
+        return True
+
+    def _schedule(self, deadline, packet, addr, tag):
+        with self.cond:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.counter += 1
+            heapq.heappush(self.heap, (deadline, self.counter, packet, addr, tag))
+            self.delayed += 1
+            # wake the sender only if this packet is now the earliest one
+            if self.heap[0][1] == self.counter:
+                self.cond.notify()
+
+    def _run(self):
+        heap = self.heap
+        while True:
+            with self.cond:
+                while not self.closed:
+                    if heap:
+                        wait = heap[0][0] - time.time()
+                        if wait <= 0:
+                            break
+                        self.cond.wait(wait)
+                    else:
+                        self.cond.wait()
+                if self.closed:
+                    return
+                due = []
+                now = time.time()
+                while heap and heap[0][0] <= now:
+                    due.append(heapq.heappop(heap))
+            for _, _, packet, addr, tag in due:
+                self._send_now(packet, addr)
+                if self.verbose and RELEASE_LOG.enabled:
+                    RELEASE_LOG.emit(seq=tag, addr=addr)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
@@ -0,0 +1,164 @@
+"""Opt-in hot-path instrumentation: sampled per-stage timings and on-demand profilers.
+
+PROFILE_STAGES=1 times one datagram in every PROFILE_SAMPLE through the receive
+path and records each stage in a histogram on the metrics registry
+(telemetry_stage_<stage>_seconds), so the numbers are exported with /metrics and
+METRICS_JSON:
+
+    receive   socket drain, per datagram
+    decode    header and payload decode, session lookup
+    classify  duplicate checks, buffering, in-order hand-off to the sink
+    reorder   releasing held readings
+    ack       building and sending the reply
+    write     sink writer thread, per row
+
+With PROFILE_STAGES off, IngestState.profiler is None and the hot path pays one
+attribute check per datagram.
+
+Separately, SIGUSR1 starts/stops cProfile on the receive thread and SIGUSR2
+starts/stops tracemalloc, on a running server (the parent forwards both to its
+workers). Stopping a capture writes its report to PROFILE_DIR.
+"""
+import cProfile, io, os, pstats, signal, time, tracemalloc
+from metrics import PROCESSING_BUCKETS, METRICS_JSON
+
+PROFILE_STAGES = os.getenv("PROFILE_STAGES", "0") == "1"
+PROFILE_SAMPLE = max(1, int(os.getenv("PROFILE_SAMPLE", 64)))
+# capture reports land next to the metrics JSON unless told otherwise
+PROFILE_DIR = os.getenv("PROFILE_DIR") or (os.path.dirname(METRICS_JSON) if METRICS_JSON else '') or '.'
+PROFILE_TOP = 40
+
+STAGES = ('receive', 'decode', 'classify', 'reorder', 'ack', 'write')
+
+
+class StageProfiler:
+    """Samples one datagram in sample_every and times the stages it passes through.
+
+    begin() starts a sampled datagram; mark(stage) charges the time since the
+    previous mark to stage; end() records the sampled datagram's stages.
+    """
+
+    def __init__(self, registry, sample_every=PROFILE_SAMPLE):
+        self.sample_every = sample_every
+        self.countdown = sample_every
+        self.active = False
+        self.last = 0.0
+        self.pending = {}
+        self.hist = {stage: registry.histogram(f"telemetry_stage_{stage}_seconds",
+                                               f"{stage} stage time per sampled datagram", PROCESSING_BUCKETS)
+                     for stage in STAGES}
+        self.hist['write'].help = "sink writer time per row"
+
+    def sample(self):
+        if self.active:
+            return False
+        self.countdown -= 1
+        if self.countdown:
+            return False
+        self.countdown = self.sample_every
+        return True
+
+    def begin(self):
+        self.active = True
+        self.pending.clear()
+        self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.pending[stage] = self.pending.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def end(self):
+        for stage, seconds in self.pending.items():
+            self.hist[stage].observe(seconds)
+        self.pending.clear()
+        self.active = False
+
+    def observe(self, stage, seconds):
+        self.hist[stage].observe(seconds)
+
+    def summary(self):
+        """stage -> (samples, mean microseconds)."""
+        return {stage: (h.count, h.sum / h.count * 1e6) for stage, h in self.hist.items() if h.count}
+
+
+class CaptureControl:
+    """Toggles cProfile (SIGUSR1) and tracemalloc (SIGUSR2) and writes their reports."""
+
+    def __init__(self, label='server', out_dir=PROFILE_DIR):
+        self.label = label
+        self.out_dir = out_dir
+        self.profile = None
+
+    def install(self):
+        if not hasattr(signal, 'SIGUSR1'):
+            return self
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.toggle_cprofile())
+        signal.signal(signal.SIGUSR2, lambda signum, frame: self.toggle_tracemalloc())
+        return self
+
+    def _path(self, kind, suffix):
+        os.makedirs(self.out_dir, exist_ok=True)
+        return os.path.join(self.out_dir, f"{kind}-{self.label}-{int(time.time())}{suffix}")
+
+    def toggle_cprofile(self):
+        if self.profile is None:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+            print(f"[PROFILE] cProfile started ({self.label})")
+            return
+        profile, self.profile = self.profile, None
+        profile.disable()
+        path = self._path('profile', '.pstats')
+        profile.dump_stats(path)
+        text = io.StringIO()
+        pstats.Stats(profile, stream=text).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        with open(path[:-len('.pstats')] + '.txt', 'w') as f:
+            f.write(text.getvalue())
+        print(f"[PROFILE] cProfile stopped, wrote {path}")
+
+    def toggle_tracemalloc(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            print(f"[PROFILE] tracemalloc started ({self.label})")
+            return
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        path = self._path('tracemalloc', '.txt')
+        with open(path, 'w') as f:
+            f.write(f"current {current} bytes, peak {peak} bytes\n")
+            for stat in snapshot.statistics('lineno')[:PROFILE_TOP]:
+                f.write(f"{stat}\n")
+        print(f"[PROFILE] tracemalloc stopped, wrote {path}")
+
+    def close(self):
+        # a capture still running at shutdown is written out rather than lost
+        if self.profile is not None:
+            self.toggle_cprofile()
+        if tracemalloc.is_tracing():
+            self.toggle_tracemalloc()
+
+
+def forward_signals(pids):
+    """Parent side of multi-worker mode: pass SIGUSR1/SIGUSR2 on to every worker."""
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+
+    def forward(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGUSR1, forward)
+    signal.signal(signal.SIGUSR2, forward)
+
+
+def print_stages(profiler):
+    if profiler is None:
+        return
+    parts = [f"{stage}={mean:.1f}us (n={n})" for stage, (n, mean) in profiler.summary().items()]
+    if parts:
+        print(f"[PROFILE] stage means: {', '.join(parts)}")
@@ -0,0 +1,117 @@
+import time
+from headers import SACK_STRUCT, SACK_NONE
+from seqnum import SEQ_MASK, seq_diff
+
+# RFC 6298 style retransmission timer bounds (seconds)
+RTO_INITIAL = 1.0
+RTO_MIN = 0.2
+RTO_MAX = 4.0
+
+
+class InFlight:
+    __slots__ = ('seq', 'last_seq', 'packet', 'first_sent', 'last_sent', 'attempts', 'deadline')
+
+    def __init__(self, seq, last_seq, packet, now, rto):
+        self.seq = seq
+        self.last_seq = last_seq
+        self.packet = packet
+        self.first_sent = now
+        self.last_sent = now
+        self.attempts = 1
+        self.deadline = now + rto
+
+
+class SackWindow:
+    """Client-side bookkeeping for danger packets awaiting a selective ACK.
+
+    Up to max_in_flight packets are outstanding at once, each with its own
+    retransmission deadline from an RTT estimate (SRTT/RTTVAR, Karn's rule:
+    retransmitted packets give no RTT sample). The caller sends and receives;
+    this class only decides what is acknowledged and what is due again.
+    """
+
+    def __init__(self, max_in_flight=32, max_attempts=5):
+        self.max_in_flight = max_in_flight
+        self.max_attempts = max_attempts
+        self.in_flight = {}  # first seq -> InFlight
+        self.srtt = None
+        self.rttvar = None
+        self.rto = RTO_INITIAL
+        self.retransmits = 0
+        self.given_up = 0
+
+    def __len__(self):
+        return len(self.in_flight)
+
+    def full(self):
+        return len(self.in_flight) >= self.max_in_flight
+
+    def track(self, seq, last_seq, packet, now=None):
+        now = time.time() if now is None else now
+        self.in_flight[seq] = InFlight(seq, last_seq, packet, now, self.rto)
+
+    def next_deadline(self):
+        if not self.in_flight:
+            return None
+        return min(p.deadline for p in self.in_flight.values())
+
+    def on_sack(self, data, now=None):
+        """Apply a SACK datagram. Returns the first seqs it acknowledged."""
+        now = time.time() if now is None else now
+        _, cumulative, base, bitmap = SACK_STRUCT.unpack_from(data)
+        acked = []
+        for seq, p in list(self.in_flight.items()):
+            if self._covered(p, cumulative, base, bitmap):
+                del self.in_flight[seq]
+                acked.append(seq)
+                if p.attempts == 1:
+                    self._sample(now - p.first_sent)
+        return acked
+
+    def on_ack(self, seq, now=None):
+        """Legacy '!BI' ACK for one packet."""
+        p = self.in_flight.pop(seq, None)
+        if p is not None and p.attempts == 1:
+            self._sample((time.time() if now is None else now) - p.first_sent)
+        return p is not None
+
+    @staticmethod
+    def _covered(p, cumulative, base, bitmap):
+        # serial-number comparisons: a packet may straddle the 32-bit wrap
+        for i in range(seq_diff(p.last_seq, p.seq) + 1):
+            s = (p.seq + i) & SEQ_MASK
+            if cumulative != SACK_NONE and seq_diff(s, cumulative) <= 0:
+                continue
+            offset = seq_diff(base, s)
+            if not (0 <= offset < 64 and bitmap >> offset & 1):
+                return False
+        return True
+
+    def due(self, now=None):
+        """Packets whose deadline passed: (to_resend, given_up) lists of InFlight."""
+        now = time.time() if now is None else now
+        resend, dropped = [], []
+        for seq, p in list(self.in_flight.items()):
+            if p.deadline > now:
+                continue
+            if p.attempts >= self.max_attempts:
+                del self.in_flight[seq]
+                dropped.append(p)
+                self.given_up += 1
+                continue
+            p.attempts += 1
+            p.last_sent = now
+            # exponential backoff per packet on top of the estimated RTO
+            p.deadline = now + min(RTO_MAX, self.rto * (2 ** (p.attempts - 1)))
+            resend.append(p)
+            self.retransmits += 1
+        return resend, dropped
+
+    def _sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(RTO_MAX, max(RTO_MIN, self.srtt + 4 * self.rttvar))
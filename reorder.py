@@ -0,0 +1,96 @@
+import heapq, os
+from array import array
+
+# how many recent duplicate seqs each device remembers for the distinct-duplicate count
+DUP_HISTORY = int(os.getenv("DUP_HISTORY", 256))
+
+
+class ReorderWindow:
+    """Pending readings and duplicate history for one device.
+
+    - pending: seq -> (seq, timestamp, value, arrival_time), so duplicate checks are O(1)
+    - heap: pending seqs, so readings are released in seq order without sorting
+    - dup_ring: seqs already counted as duplicated, slot seq % DUP_HISTORY; allocated on
+      the first duplicate and never larger than DUP_HISTORY entries
+    - release_at: deadline the device is scheduled under in the release timer (0 = none)
+    """
+
+    __slots__ = ('last_written', 'pending', 'heap', 'dup_ring', 'release_at')
+
+    def __init__(self):
+        self.last_written = -1
+        self.pending = {}
+        self.heap = []
+        self.dup_ring = None
+        self.release_at = 0.0
+
+    def __len__(self):
+        return len(self.pending)
+
+    def is_duplicate(self, seq):
+        return seq <= self.last_written or seq in self.pending
+
+    def add(self, reading):
+        seq = reading[0]
+        self.pending[seq] = reading
+        heapq.heappush(self.heap, seq)
+
+    def sack(self, base, bits=64):
+        """(cumulative, bitmap) for a selective ACK anchored at base.
+
+        cumulative is last_written (everything at or below it is settled); bit i is set
+        when base - i is buffered. Bits at or below cumulative are left clear.
+        """
+        pending = self.pending
+        bitmap = 0
+        for i in range(max(0, min(bits, base - self.last_written))):
+            if (base - i) in pending:
+                bitmap |= 1 << i
+        return self.last_written, bitmap
+
+    def mark_duplicate(self, seq):
+        """Record a duplicate arrival. Returns True the first time seq is seen duplicated.
+
+        Only the last DUP_HISTORY duplicated seqs are remembered; an older seq that
+        fell out of the ring is counted as distinct again.
+        """
+        ring = self.dup_ring
+        if ring is None:
+            ring = self.dup_ring = array('q', [-1]) * DUP_HISTORY
+        slot = seq % DUP_HISTORY
+        if ring[slot] == seq:
+            return False
+        ring[slot] = seq
+        return True
+
+    def pop_ready(self):
+        """Remove and return the pending readings that continue last_written without a gap."""
+        pending, heap = self.pending, self.heap
+        batch = []
+        expected = self.last_written + 1
+        while heap and heap[0] == expected:
+            batch.append(pending.pop(heapq.heappop(heap)))
+            expected += 1
+        return batch
+
+    def pop_through(self, seq):
+        """Remove and return every pending reading with a seq <= seq, in seq order."""
+        pending, heap = self.pending, self.heap
+        batch = []
+        while heap and heap[0] <= seq:
+            batch.append(pending.pop(heapq.heappop(heap)))
+        return batch
+
+    def oldest_arrival(self):
+        return min(r[3] for r in self.pending.values())
+
+    def expired_through(self, cutoff):
+        """Highest pending seq that arrived at or before cutoff, or None."""
+        expired = [seq for seq, r in self.pending.items() if r[3] <= cutoff]
+        return max(expired) if expired else None
+
+    def pop_all(self):
+        """Remove and return every pending reading in seq order."""
+        pending, heap = self.pending, self.heap
+        batch = [pending.pop(heapq.heappop(heap)) for _ in range(len(heap))]
+        return batch
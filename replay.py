@@ -0,0 +1,319 @@
+"""Replay recorded traffic into a running server, at original timing or faster.
+
+Sources, picked by content:
+
+    capture.pcap   tcpdump capture (run_pair.sh); the UDP payloads sent to --port are
+                   re-sent byte for byte, v1 and v2 frames alike. Classic pcap with
+                   Ethernet, Linux cooked (-i any), loopback or raw IP link types;
+                   pcapng must be converted first (tcpdump -r in.pcapng -w out.pcap)
+    packets.csv    server output; readings are rebuilt into v1 DATA packets, one per
+                   original arrival (a batch shares its arrival time), timed by
+                   arrival_time, preceded by an INIT for each device
+    client.log     client output. Text logs carry no times and are sent back to back;
+                   LOG_FORMAT=json logs (eventlog.py) keep their timing. DATA and INIT
+                   lines are rebuilt as v1 packets
+
+    python3 replay.py tests/manual_pair/capture.pcap              # original timing
+    python3 replay.py tests/loss5/packets.csv --speed 20          # 20x faster
+    python3 replay.py tests/baseline/client.log --fast --sockets 8
+
+Devices (or capture source addresses) are spread over --sockets UDP sockets, each
+keeping its own order, so a multi-worker server sees several 4-tuples. Replies are
+not read, so each rebuilt INIT is sent CLIENT_INIT_ATTEMPTS times (the copies share a
+boot id, which keeps the stream) in case one is lost. Rebuilt INITs carry fresh boot
+ids; replay into a freshly started server so recorded seqs are not taken for
+duplicates of a previous replay.
+"""
+import argparse, csv, json, random, re, struct, time
+import socket as skt
+from headers import HEADER_STRUCT, INIT_STRUCT, FLAG_DANGER
+from seqnum import SEQ_MASK
+from globals import server_IP, server_port, client_IP
+from TinyTelemetryV1_Client import CLIENT_INIT_ATTEMPTS
+
+PCAP_MAGIC_US = 0xa1b2c3d4
+PCAP_MAGIC_NS = 0xa1b23c4d
+PCAPNG_MAGIC = 0x0a0d0d0a
+PCAP_RECORD = {'<': struct.Struct('<IIII'), '>': struct.Struct('>IIII')}
+LINK_ETHERNET, LINK_NULL, LINK_RAW, LINK_LOOP, LINK_SLL, LINK_SLL2 = 1, 0, 101, 108, 113, 276
+ETH_VLAN = (0x8100, 0x88a8)
+ETH_IPV4, ETH_IPV6 = 0x0800, 0x86dd
+IPPROTO_UDP = 17
+UDP_HEADER = struct.Struct('!HHHH')
+# sleep only when the next packet is at least this far ahead
+MIN_SLEEP = 0.0005
+
+DATA_LINE = re.compile(r"\[CLIENT (\d+)\] DATA seq=(\d+) val=(\d+) danger=")
+BATCH_LINE = re.compile(r"\[CLIENT (\d+)\] DATA seq=(\d+)\.\.\d+ vals=\[([\d, ]*)\] danger=")
+INIT_LINE = re.compile(r"\[CLIENT (\d+)\] INIT sent")
+
+
+# -------------------------
+# Packet building
+# -------------------------
+def data_packet(dev, seq, values, timestamp):
+    flags = FLAG_DANGER if any(v >= 60 for v in values) else 0
+    return (HEADER_STRUCT.pack(dev, seq & SEQ_MASK, int(timestamp) & 0xFFFFFFFF, 1, flags)
+            + struct.pack(f"!{len(values)}H", *values))
+
+
+def init_packet(dev, boot_id, timestamp):
+    return HEADER_STRUCT.pack(dev, 0, int(timestamp) & 0xFFFFFFFF, 2, 0) + INIT_STRUCT.pack(boot_id)
+
+
+def init_packets(t, dev, boot_id, timestamp):
+    """(t, dev, INIT) entries for a rebuilt INIT and its repeats."""
+    init = init_packet(dev, boot_id, timestamp)
+    return [(t, dev, init)] * CLIENT_INIT_ATTEMPTS
+
+
+# -------------------------
+# Sources: each yields (time or None, key, payload); key picks the sender socket
+# -------------------------
+def _ip_udp(frame, off, port):
+    """((src ip, src port), payload) of a UDP datagram to port (0 = any) in an IP packet at frame[off]."""
+    if len(frame) < off + 20:
+        return None
+    version = frame[off] >> 4
+    if version == 4:
+        ihl = (frame[off] & 0x0F) * 4
+        frag = struct.unpack_from('!H', frame, off + 6)[0]
+        # fragments are not reassembled; telemetry datagrams never need it
+        if frame[off + 9] != IPPROTO_UDP or frag & 0x3FFF:
+            return None
+        src = skt.inet_ntop(skt.AF_INET, frame[off + 12:off + 16])
+        off += ihl
+    elif version == 6:
+        if len(frame) < off + 40 or frame[off + 6] != IPPROTO_UDP:
+            return None
+        src = skt.inet_ntop(skt.AF_INET6, frame[off + 8:off + 24])
+        off += 40
+    else:
+        return None
+    if len(frame) < off + UDP_HEADER.size:
+        return None
+    sport, dport, ulen, _ = UDP_HEADER.unpack_from(frame, off)
+    if port and dport != port:
+        return None
+    return (src, sport), frame[off + UDP_HEADER.size:off + ulen]
+
+
+def _ip_offset(frame, linktype):
+    """Offset of the IP header in a link-layer frame, or None."""
+    if linktype == LINK_ETHERNET:
+        if len(frame) < 14:
+            return None
+        off, ethertype = 14, struct.unpack_from('!H', frame, 12)[0]
+        while ethertype in ETH_VLAN and len(frame) >= off + 4:
+            ethertype = struct.unpack_from('!H', frame, off + 2)[0]
+            off += 4
+        return off if ethertype in (ETH_IPV4, ETH_IPV6) else None
+    if linktype == LINK_SLL:
+        return 16 if len(frame) >= 16 and struct.unpack_from('!H', frame, 14)[0] in (ETH_IPV4, ETH_IPV6) else None
+    if linktype == LINK_SLL2:
+        return 20 if len(frame) >= 20 and struct.unpack_from('!H', frame, 0)[0] in (ETH_IPV4, ETH_IPV6) else None
+    if linktype in (LINK_NULL, LINK_LOOP):
+        # 4-byte address family in host (NULL) or network (LOOP) order; the IP version nibble decides
+        return 4
+    if linktype in (LINK_RAW, 12, 14):
+        return 0
+    return None
+
+
+def read_pcap(path, port=server_port):
+    with open(path, 'rb') as f:
+        head = f.read(24)
+        if len(head) < 24:
+            raise ValueError(f"{path}: truncated pcap header")
+        magic = struct.unpack('<I', head[:4])[0]
+        if magic == PCAPNG_MAGIC:
+            raise ValueError(f"{path}: pcapng is not supported, convert with: tcpdump -r {path} -w out.pcap")
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            endian = '<'
+        else:
+            magic = struct.unpack('>I', head[:4])[0]
+            if magic not in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+                raise ValueError(f"{path}: not a pcap file")
+            endian = '>'
+        scale = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+        linktype = struct.unpack(endian + 'I', head[20:24])[0] & 0x0FFFFFFF
+        record = PCAP_RECORD[endian]
+        while True:
+            h = f.read(record.size)
+            if len(h) < record.size:
+                return
+            sec, frac, caplen, _ = record.unpack(h)
+            frame = f.read(caplen)
+            if len(frame) < caplen:
+                return
+            off = _ip_offset(frame, linktype)
+            if off is None:
+                continue
+            udp = _ip_udp(frame, off, port)
+            if udp is not None:
+                yield sec + frac * scale, udp[0], udp[1]
+
+
+def read_packets_csv(path, rnd):
+    """One DATA packet per original arrival; rows are sorted by arrival (worker shards interleave)."""
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        idx = [header.index(c) for c in ('device_id', 'seq_num', 'timestamp', 'value', 'arrival_time')]
+        rows = [(float(r[idx[4]]), int(r[idx[0]]), int(r[idx[1]]), float(r[idx[2]]), int(float(r[idx[3]])))
+                for r in reader if r]
+    rows.sort(key=lambda r: r[0])
+
+    seen = set()
+    batch = []
+    for row in rows + [None]:
+        if batch and (row is None or row[0] != batch[0][0] or row[1] != batch[0][1]
+                      or row[2] != (batch[-1][2] + 1) & SEQ_MASK):
+            arrival, dev, seq, timestamp, _ = batch[0]
+            if dev not in seen:
+                seen.add(dev)
+                yield from init_packets(arrival, dev, rnd.getrandbits(32), timestamp)
+            yield arrival, dev, data_packet(dev, seq, [r[4] for r in batch], timestamp)
+            batch = []
+        if row is not None:
+            batch.append(row)
+
+
+def read_client_log(path, rnd):
+    with open(path, errors='replace') as f:
+        for line in f:
+            if line.startswith('{'):
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue
+                t, name = rec.get('t'), rec.get('event')
+                if name == 'client.data':
+                    yield t, rec['dev'], data_packet(rec['dev'], rec['seq'], [rec['value']], t)
+                elif name == 'client.data_batch':
+                    yield t, rec['dev'], data_packet(rec['dev'], rec['seq'], rec['values'], t)
+                elif name == 'client.init':
+                    yield from init_packets(t, rec['dev'], rnd.getrandbits(32), t)
+                continue
+            m = DATA_LINE.search(line)
+            if m:
+                dev = int(m.group(1))
+                yield None, dev, data_packet(dev, int(m.group(2)), [int(m.group(3))], time.time())
+                continue
+            m = BATCH_LINE.search(line)
+            if m:
+                dev = int(m.group(1))
+                values = [int(v) for v in m.group(3).split(',') if v.strip()]
+                if values:
+                    yield None, dev, data_packet(dev, int(m.group(2)), values, time.time())
+                continue
+            m = INIT_LINE.search(line)
+            if m:
+                dev = int(m.group(1))
+                yield from init_packets(None, dev, rnd.getrandbits(32), time.time())
+
+
+def open_source(path, port=server_port, seed=None):
+    rnd = random.Random(seed)
+    with open(path, 'rb') as f:
+        magic = f.read(4)
+    if len(magic) == 4 and (struct.unpack('<I', magic)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS, PCAPNG_MAGIC)
+                            or struct.unpack('>I', magic)[0] in (PCAP_MAGIC_US, PCAP_MAGIC_NS)):
+        return read_pcap(path, port)
+    if path.endswith('.csv'):
+        return read_packets_csv(path, rnd)
+    return read_client_log(path, rnd)
+
+
+# -------------------------
+# Sending
+# -------------------------
+class ReplayStats:
+    def __init__(self):
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.first_t = None
+        self.last_t = None
+        self.max_late = 0.0
+        self.elapsed = 0.0
+
+
+def replay(packets, target=(server_IP, server_port), speed=1.0, sockets=4, limit=0):
+    """Send (t, key, payload) packets to target; speed 0 sends as fast as possible."""
+    socks = []
+    for _ in range(max(1, sockets)):
+        s = skt.socket(skt.AF_INET, skt.SOCK_DGRAM)
+        s.bind((client_IP, 0))
+        socks.append(s)
+    # each key (device or source address) sticks to one socket, assigned round-robin
+    owner = {}
+    stats = ReplayStats()
+    start = None
+    try:
+        for t, key, payload in packets:
+            if start is None:
+                # the clock starts at the first packet, after the source has loaded
+                start = time.perf_counter()
+            if t is not None:
+                if stats.first_t is None:
+                    stats.first_t = t
+                stats.last_t = t
+                if speed > 0:
+                    ahead = start + (t - stats.first_t) / speed - time.perf_counter()
+                    if ahead > MIN_SLEEP:
+                        time.sleep(ahead)
+                    elif -ahead > stats.max_late:
+                        stats.max_late = -ahead
+            sock = owner.get(key)
+            if sock is None:
+                sock = owner[key] = socks[len(owner) % len(socks)]
+            try:
+                sock.sendto(payload, target)
+            except OSError:
+                stats.send_errors += 1
+                continue
+            stats.packets_sent += 1
+            stats.bytes_sent += len(payload)
+            if limit and stats.packets_sent >= limit:
+                break
+    finally:
+        stats.elapsed = time.perf_counter() - start if start is not None else 0.0
+        for s in socks:
+            s.close()
+    return stats
+
+
+def report(stats, speed):
+    span = (stats.last_t - stats.first_t) if stats.first_t is not None else 0.0
+    elapsed = max(stats.elapsed, 1e-9)
+    print("\n[REPLAY]")
+    print(f"Packets sent: {stats.packets_sent} ({stats.packets_sent / elapsed:.1f} pkt/s), bytes: {stats.bytes_sent}")
+    print(f"Recorded span: {span:.2f} s, replayed in {stats.elapsed:.2f} s "
+          f"({span / elapsed:.1f}x, requested {'max' if speed <= 0 else f'{speed:g}x'})")
+    if speed > 0:
+        print(f"Max lateness: {stats.max_late * 1000:.1f} ms")
+    print(f"Send errors: {stats.send_errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('path', help="capture.pcap, packets.csv or client.log")
+    parser.add_argument('--speed', type=float, default=1.0, help="time scale: 1 = original timing, 10 = 10x faster")
+    parser.add_argument('--fast', action='store_true', help="ignore timing, send as fast as possible")
+    parser.add_argument('--sockets', type=int, default=4, help="sender sockets")
+    parser.add_argument('--target', default=f"{server_IP}:{server_port}", help="server host:port")
+    parser.add_argument('--port', type=int, default=server_port,
+                        help="pcap: replay only UDP datagrams sent to this port (0 = all)")
+    parser.add_argument('--limit', type=int, default=0, help="stop after this many packets")
+    parser.add_argument('--seed', type=int, help="seed for the boot ids of rebuilt INITs")
+    args = parser.parse_args()
+
+    host, _, port = args.target.rpartition(':')
+    speed = 0.0 if args.fast else args.speed
+    stats = replay(open_source(args.path, args.port, args.seed), (host, int(port)), speed, args.sockets, args.limit)
+    report(stats, speed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Offline charts from server snapshot files.
+
+The server writes its [SNAPSHOT] series to a JSON-lines file (SNAPSHOTS_FILE, by
+default snapshots.jsonl next to PACKETS_CSV). This tool renders the bytes /
+duplicate rate / loss / CPU charts from one or more of those files, so the server
+itself never imports matplotlib.
+
+    python3 report.py tests/baseline tests/loss5 tests/delay_jitter --out charts/
+"""
+import argparse, json, os
+
+SNAPSHOTS_NAME = 'snapshots.jsonl'
+
+CHARTS = (
+    ('bytes_per_report', "Bytes per Report", "Bytes per Report vs Time", "bytes_per_report_over_time.png"),
+    ('dup_rate', "Duplicate Rate", "Duplicate Rate vs Time", "duplicate_rate_over_time.png"),
+    ('loss_count', "Packets Lost", "Packet Loss vs Time", "packet_loss_over_time.png"),
+    ('cpu_ms_per_report', "CPU ms per Report", "CPU Time per Report vs Time", "cpu_ms_per_report_over_time.png"),
+)
+
+
+def load_snapshots(path):
+    """Snapshot records (dicts with 't' and the metric fields) from a file or run directory."""
+    if os.path.isdir(path):
+        path = os.path.join(path, SNAPSHOTS_NAME)
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    # charts show the fixed snapshot points; the final record is for summaries
+    return [r for r in records if not r.get('final')]
+
+
+def run_label(path):
+    path = path.rstrip('/')
+    if os.path.isdir(path):
+        return os.path.basename(path)
+    return os.path.basename(os.path.dirname(path)) or os.path.basename(path)
+
+
+def render(runs, out_dir='.'):
+    """runs: list of (label, records). One PNG per metric, one bar group per run."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    os.makedirs(out_dir, exist_ok=True)
+    width = 0.8 / max(len(runs), 1)
+    written = []
+    for key, ylabel, title, filename in CHARTS:
+        plt.figure()
+        for i, (label, records) in enumerate(runs):
+            times = [r['t'] for r in records]
+            values = [r[key] for r in records]
+            if len(runs) == 1:
+                plt.bar(times, values)
+            else:
+                # offset bars so each run is visible at every snapshot point
+                positions = [j + (i - (len(runs) - 1) / 2) * width for j in range(len(times))]
+                plt.bar(positions, values, width=width, label=label)
+                plt.xticks(range(len(times)), times)
+        if len(runs) > 1:
+            plt.legend()
+        plt.xlabel("Time (seconds)")
+        plt.ylabel(ylabel)
+        plt.title(title)
+        plt.grid(True, axis='y')
+        plt.tight_layout()
+        path = os.path.join(out_dir, filename)
+        plt.savefig(path)
+        plt.close()
+        written.append(path)
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='*', default=[SNAPSHOTS_NAME],
+                        help="snapshot files or run directories containing snapshots.jsonl")
+    parser.add_argument('--out', default='.', help="directory for the PNG charts")
+    args = parser.parse_args()
+    runs = [(run_label(p), load_snapshots(p)) for p in args.paths]
+    for path in render(runs, args.out):
+        print(f"[REPORT] wrote {path}")
+
+
+if __name__ == "__main__":
+    main()
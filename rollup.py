@@ -0,0 +1,262 @@
+"""Downsampled rollups of the reading stream for long-range queries.
+
+The sink's writer thread feeds every written batch to a RollupStore, which keeps,
+per device and per tier (ROLLUP_TIERS, default 1 s / 1 min / 1 h), the open bucket
+(count, sum, min, max, danger readings) keyed by reading timestamp, plus a ring of the
+last ROLLUP_RING closed buckets for in-process use. Closed buckets are appended to
+small files per tier and period:
+
+    <dir>/<prefix>-<resolution>s-<period start>.ttr
+    header:  magic b'TTR1', version u16, resolution u32, created f64
+    record:  device_id u16, start f64, count u32, sum f64, min u16, max u16,
+             danger u32                                             (30 bytes)
+
+A bucket closes when a later reading of the device arrives, or once the newest
+timestamp seen from any device is ROLLUP_IDLE_S past its end. A reading older than
+its device's open bucket is counted in `late` and left out. So is a value outside
+the u16 range of min/max, counted in `rejected`: ingest already refuses those, so a
+count there points at a bug upstream instead of killing the writer thread. A bucket
+closed early and reopened by a straggler is written twice; readers merge records
+with the same (device, start).
+
+RollupReader.query() picks the coarsest tier that still gives the requested detail,
+so a dashboard over weeks reads a few kilobytes of hourly records:
+
+    python3 rollup.py rollups --device 101 --hours 24
+"""
+import argparse, glob, os, struct, time
+from collections import deque, namedtuple
+
+ROLLUP_DIR = os.getenv("ROLLUP_DIR")
+ROLLUP_TIERS = tuple(int(r) for r in os.getenv("ROLLUP_TIERS", "1,60,3600").split(','))
+ROLLUP_RING = int(os.getenv("ROLLUP_RING", 60))
+ROLLUP_IDLE_S = float(os.getenv("ROLLUP_IDLE_S", 5))
+# buckets per file: an hour of 1 s buckets, 60 h of minutes, 150 days of hours
+FILE_BUCKETS = 3600
+# seconds between idle sweeps / file appends in the writer thread
+FLUSH_INTERVAL = 1.0
+DANGER_VALUE = 60
+VALUE_MAX = 0xFFFF
+
+MAGIC = b'TTR1'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHId')
+RECORD = struct.Struct('<HdIdHHI')
+ROLLUP_SUFFIX = '.ttr'
+
+Rollup = namedtuple('Rollup', 'start count mean min max danger')
+
+
+class Tier:
+    """Open buckets and rings of closed ones for one resolution."""
+
+    def __init__(self, resolution, ring):
+        self.resolution = resolution
+        self.ring = ring
+        self.open = {}      # device -> [start, count, sum, min, max, danger]
+        self.closed = {}    # device -> deque of closed buckets
+        self.pending = {}   # file period -> bytearray of records to append
+
+
+class RollupStore:
+    """Maintains the tiers from written rows and persists closed buckets to directory.
+
+    add(), tick() and close() run on the sink's writer thread; recent() may be called
+    from elsewhere and sees a slightly stale view.
+    """
+
+    def __init__(self, directory, prefix='roll', tiers=ROLLUP_TIERS, ring=ROLLUP_RING):
+        self.directory = directory
+        self.prefix = prefix
+        self.tiers = [Tier(r, ring) for r in sorted(tiers)]
+        self.watermark = 0.0
+        self.late = 0
+        self.rejected = 0
+        self.buckets_written = 0
+        self.last_tick = time.monotonic()
+        os.makedirs(directory, exist_ok=True)
+
+    def add(self, rows):
+        """Fold (device_id, seq_num, timestamp, value, ...) rows into every tier."""
+        watermark = self.watermark
+        for row in rows:
+            dev, ts, value = row[0], row[2], row[3]
+            if not 0 <= value <= VALUE_MAX:
+                self.rejected += 1
+                continue
+            if ts > watermark:
+                watermark = ts
+            danger = value >= DANGER_VALUE
+            for tier in self.tiers:
+                res = tier.resolution
+                start = ts - ts % res
+                b = tier.open.get(dev)
+                if b is not None and b[0] == start:
+                    b[1] += 1
+                    b[2] += value
+                    if value < b[3]:
+                        b[3] = value
+                    if value > b[4]:
+                        b[4] = value
+                    b[5] += danger
+                    continue
+                if b is not None:
+                    if start < b[0]:
+                        self.late += 1
+                        continue
+                    self._close(tier, dev, b)
+                tier.open[dev] = [start, 1, value, value, value, int(danger)]
+        self.watermark = watermark
+
+    def _close(self, tier, dev, b):
+        ring = tier.closed.get(dev)
+        if ring is None:
+            ring = tier.closed[dev] = deque(maxlen=tier.ring)
+        ring.append(tuple(b))
+        period = b[0] - b[0] % (tier.resolution * FILE_BUCKETS)
+        buf = tier.pending.get(period)
+        if buf is None:
+            buf = tier.pending[period] = bytearray()
+        buf += RECORD.pack(dev, b[0], b[1], b[2], b[3], b[4], b[5])
+        self.buckets_written += 1
+
+    def tick(self):
+        """Close buckets of idle devices and append closed buckets to disk, at most once per FLUSH_INTERVAL."""
+        now = time.monotonic()
+        if now - self.last_tick < FLUSH_INTERVAL:
+            return
+        self.last_tick = now
+        self._sweep(self.watermark - ROLLUP_IDLE_S)
+        self.flush()
+
+    def _sweep(self, cutoff):
+        for tier in self.tiers:
+            idle = [dev for dev, b in tier.open.items() if b[0] + tier.resolution <= cutoff]
+            for dev in idle:
+                self._close(tier, dev, tier.open.pop(dev))
+
+    def flush(self):
+        for tier in self.tiers:
+            pending, tier.pending = tier.pending, {}
+            for period, buf in pending.items():
+                path = os.path.join(self.directory,
+                                    f"{self.prefix}-{tier.resolution}s-{int(period)}{ROLLUP_SUFFIX}")
+                with open(path, 'ab') as f:
+                    if f.tell() == 0:
+                        f.write(FILE_HEADER.pack(MAGIC, VERSION, tier.resolution, time.time()))
+                    f.write(buf)
+
+    def close(self):
+        self._sweep(float('inf'))
+        self.flush()
+        print(f"[ROLLUP] {self.prefix}: wrote {self.buckets_written} buckets to {self.directory}"
+              + (f", {self.late} late readings left out" if self.late else "")
+              + (f", {self.rejected} out-of-range readings rejected" if self.rejected else ""))
+
+    def recent(self, device_id, resolution):
+        """Closed buckets still in the ring plus the open one, oldest first, as Rollups."""
+        for tier in self.tiers:
+            if tier.resolution == resolution:
+                buckets = list(tier.closed.get(device_id, ()))
+                b = tier.open.get(device_id)
+                if b is not None:
+                    buckets.append(tuple(b))
+                return [_rollup(b) for b in buckets]
+        raise KeyError(f"no {resolution} s tier")
+
+
+def _rollup(b):
+    start, count, total, lo, hi, danger = b
+    return Rollup(start, count, total / count, lo, hi, danger)
+
+
+# -------------------------
+# Reader
+# -------------------------
+class RollupReader:
+    """Queries the rollup files in a directory (any number of worker prefixes)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def files(self, resolution):
+        """[(period start, path)] of one tier."""
+        out = []
+        for path in glob.glob(os.path.join(self.directory, f"*-{resolution}s-*{ROLLUP_SUFFIX}")):
+            try:
+                period = int(os.path.basename(path)[:-len(ROLLUP_SUFFIX)].rsplit('-', 1)[1])
+            except ValueError:
+                continue
+            out.append((period, path))
+        return sorted(out)
+
+    def tiers(self):
+        found = set()
+        for path in glob.glob(os.path.join(self.directory, '*' + ROLLUP_SUFFIX)):
+            part = os.path.basename(path).rsplit('-', 2)[-2]
+            if part.endswith('s') and part[:-1].isdigit():
+                found.add(int(part[:-1]))
+        return sorted(found)
+
+    def pick_tier(self, start, end, max_points=1000):
+        """Coarsest tier with at least max_points buckets in [start, end), else the finest."""
+        tiers = self.tiers()
+        if not tiers:
+            raise FileNotFoundError(f"{self.directory}: no rollup files")
+        step = (end - start) / max(max_points, 1)
+        fitting = [r for r in tiers if r <= step]
+        return fitting[-1] if fitting else tiers[0]
+
+    def query(self, device_id, start, end, resolution=None, max_points=1000):
+        """(resolution, [Rollup]) for device_id, every bucket overlapping [start, end)."""
+        if resolution is None:
+            resolution = self.pick_tier(start, end, max_points)
+        span = resolution * FILE_BUCKETS
+        merged = {}
+        for period, path in self.files(resolution):
+            if period + span <= start or period >= end:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if len(data) < FILE_HEADER.size or data[:4] != MAGIC:
+                raise ValueError(f"{path}: not a rollup file")
+            body = memoryview(data)[FILE_HEADER.size:]
+            # a file still being appended to may end in a partial record
+            body = body[:len(body) - len(body) % RECORD.size]
+            for dev, b_start, count, total, lo, hi, danger in RECORD.iter_unpack(body):
+                if dev != device_id or b_start + resolution <= start or b_start >= end:
+                    continue
+                m = merged.get(b_start)
+                if m is None:
+                    merged[b_start] = [b_start, count, total, lo, hi, danger]
+                else:
+                    m[1] += count
+                    m[2] += total
+                    m[3] = min(m[3], lo)
+                    m[4] = max(m[4], hi)
+                    m[5] += danger
+        return resolution, [_rollup(merged[k]) for k in sorted(merged)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('directory', nargs='?', default=ROLLUP_DIR or 'rollups')
+    parser.add_argument('--device', type=int, required=True)
+    parser.add_argument('--start', type=float, help="epoch seconds (default: --hours before --end)")
+    parser.add_argument('--end', type=float, help="epoch seconds (default: now)")
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--resolution', type=int, help="tier in seconds (default: picked from the range)")
+    parser.add_argument('--points', type=int, default=1000, help="most buckets wanted when picking the tier")
+    args = parser.parse_args()
+
+    end = args.end if args.end is not None else time.time()
+    start = args.start if args.start is not None else end - args.hours * 3600
+    resolution, rows = RollupReader(args.directory).query(args.device, start, end, args.resolution, args.points)
+    print(f"[ROLLUP] device {args.device}, {resolution} s tier, {len(rows)} buckets")
+    print(f"{'start':>14}{'count':>8}{'mean':>9}{'min':>6}{'max':>6}{'danger':>8}")
+    for r in rows:
+        print(f"{r.start:>14.0f}{r.count:>8}{r.mean:>9.2f}{r.min:>6}{r.max:>6}{r.danger:>8}")
+
+
+if __name__ == "__main__":
+    main()
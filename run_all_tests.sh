@@ -4,6 +4,13 @@ set -euo pipefail
 DURATION=${DURATION:-80}
 WAIT_BETWEEN=${WAIT_BETWEEN:-5}
 
+# SIM=1: run the three scenarios in virtual time (simulate.py, under a second) instead of live
+if [ "${SIM:-0}" = "1" ]; then
+    python3 simulate.py baseline loss5 delay_jitter --duration "$DURATION"
+    echo " Results in ./tests/sim/"
+    exit 0
+fi
+
 echo "====================================="
 echo " Running Baseline Test"
 echo " Duration: ${DURATION} seconds"
@@ -32,6 +39,18 @@ echo " Duration: ${DURATION} seconds"
 echo "====================================="
 DURATION="$DURATION" bash test_delay_jitter.sh
 
+echo ""
+echo "====================================="
+echo " Rendering charts (needs matplotlib)"
+echo "====================================="
+SNAP_DIRS=()
+for d in tests/baseline tests/loss5 tests/delay_jitter; do
+    [ -f "$d/snapshots.jsonl" ] && SNAP_DIRS+=("$d")
+done
+if [ "${#SNAP_DIRS[@]}" -gt 0 ]; then
+    python3 report.py "${SNAP_DIRS[@]}" --out . || echo "report.py failed (is matplotlib installed?) - charts skipped."
+fi
+
 echo ""
 echo "====================================="
 echo " All tests completed!"
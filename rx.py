@@ -0,0 +1,49 @@
+import socket as skt
+import os
+
+# datagrams drained per wakeup, and bytes reserved per datagram slot
+RX_BATCH = int(os.getenv("RX_BATCH", 256))
+RX_SLOT = int(os.getenv("RX_SLOT", 1024))
+# kernel receive buffer requested for the server socket (bytes); 0 keeps the OS default
+SERVER_RCVBUF = int(os.getenv("SERVER_RCVBUF", 4 * 1024 * 1024))
+
+
+class BatchReceiver:
+    """Drains everything queued on a non-blocking UDP socket into one preallocated buffer.
+
+    After drain() returns n, datagram i lives at buf[i * slot_size : i * slot_size + lengths[i]]
+    and came from addrs[i]. Slots are reused on the next drain().
+    """
+
+    def __init__(self, sock, batch=RX_BATCH, slot_size=RX_SLOT):
+        self.sock = sock
+        self.slot_size = slot_size
+        self.buf = bytearray(batch * slot_size)
+        view = memoryview(self.buf)
+        self.slots = [view[i * slot_size:(i + 1) * slot_size] for i in range(batch)]
+        self.lengths = [0] * batch
+        self.addrs = [None] * batch
+        sock.setblocking(False)
+        if SERVER_RCVBUF > 0:
+            try:
+                sock.setsockopt(skt.SOL_SOCKET, skt.SO_RCVBUF, SERVER_RCVBUF)
+            except OSError:
+                pass
+
+    def drain(self):
+        """Read until the socket would block or the batch is full. Returns the datagram count."""
+        n = 0
+        recv_into = self.sock.recvfrom_into
+        size = self.slot_size
+        for slot in self.slots:
+            try:
+                nbytes, addr = recv_into(slot, size)
+            except (BlockingIOError, InterruptedError):
+                break
+            except OSError:
+                # e.g. ICMP port unreachable surfaced on the socket; nothing to read
+                break
+            self.lengths[n] = nbytes
+            self.addrs[n] = addr
+            n += 1
+        return n
@@ -0,0 +1,24 @@
+"""Serial-number arithmetic for the 32-bit seq_num field (RFC 1982 style).
+
+Wire seqs wrap at 2**32. The server keeps per-device seqs "unwrapped" (plain ints
+that keep growing past 2**32), so the reorder heap and the <= / > checks stay
+ordinary integer comparisons; only the wire boundary masks back to 32 bits.
+"""
+
+SEQ_BITS = 32
+SEQ_MOD = 1 << SEQ_BITS
+SEQ_MASK = SEQ_MOD - 1
+SEQ_HALF = SEQ_MOD >> 1
+
+
+def seq_diff(a, b):
+    """Signed distance a - b between two wire seqs, in (-2**31, 2**31]."""
+    d = (a - b) & SEQ_MASK
+    return d - SEQ_MOD if d > SEQ_HALF else d
+
+
+def unwrap(seq, ref):
+    """Unwrapped seq closest to ref for a wire seq (ref < 0: nothing seen yet)."""
+    if ref < 0:
+        return seq
+    return ref + seq_diff(seq, ref & SEQ_MASK)
@@ -0,0 +1,175 @@
+import abc, asyncio, time
+from headers import Header, HEADER_STRUCT
+from wire import V2_MARKER, V2_PREFIX, parse_init, is_v2_frame
+
+MSG_HEARTBEAT = 0
+MSG_DATA = 1
+MSG_INIT = 2
+
+
+# -------------------------
+# Packet handlers
+# -------------------------
+class PacketHandler(abc.ABC):
+    """Handles one msg_type. handle() returns the reply bytes to send back, or None.
+
+    handle_v2() gets the same msg_type from compact v2 frames (wire.py); by default
+    they are ignored.
+    """
+
+    msg_type = None
+
+    @abc.abstractmethod
+    def handle(self, dev, seq, timestamp, flags, buf, length, address, arrival_time):
+        """Reply to a v1 packet whose header has been unpacked into the arguments."""
+
+    def handle_v2(self, dev, buf, length, address, arrival_time):
+        return None
+
+
+class HeartbeatHandler(PacketHandler):
+    msg_type = MSG_HEARTBEAT
+
+    def __init__(self, state):
+        self.state = state
+
+    def handle(self, dev, seq, timestamp, flags, buf, length, address, arrival_time):
+        return self.state.on_heartbeat(dev, arrival_time)
+
+    def handle_v2(self, dev, buf, length, address, arrival_time):
+        return self.state.on_heartbeat(dev, arrival_time)
+
+
+class InitHandler(PacketHandler):
+    msg_type = MSG_INIT
+
+    def __init__(self, state):
+        self.state = state
+
+    def handle(self, dev, seq, timestamp, flags, buf, length, address, arrival_time):
+        return self.state.on_init(dev, arrival_time, *parse_init(buf, 0, length))
+
+
+class DataHandler(PacketHandler):
+    msg_type = MSG_DATA
+
+    def __init__(self, state):
+        self.state = state
+
+    def handle(self, dev, seq, timestamp, flags, buf, length, address, arrival_time):
+        return self.state.on_data(dev, seq, timestamp, flags, buf, 0, length, arrival_time)
+
+    def handle_v2(self, dev, buf, length, address, arrival_time):
+        return self.state.on_data_v2(dev, buf, 0, length, arrival_time)
+
+
+# -------------------------
+# Engine
+# -------------------------
+class TelemetryServer(asyncio.DatagramProtocol):
+    """asyncio telemetry server: one DatagramProtocol dispatching on Header.msg_type.
+
+    Replies (ALIVE, ACK) go out through the transport without blocking; snapshots, sink
+    flushing and reorder-deadline releases run as a periodic task on the loop rather
+    than after every packet.
+    Extra handlers (or replacements) can be added with register() before start().
+
+        server = TelemetryServer(IngestState(sink), snapshot_points=[10, 30, 60])
+        await server.start(host, port)
+        await server.run_for(RUN_DURATION)
+    """
+
+    def __init__(self, state, snapshot_points=(), tick_interval=0.2):
+        self.state = state
+        self.snapshot_points = list(snapshot_points)
+        self.tick_interval = tick_interval
+        self.handlers = {}
+        self.transport = None
+        self.start_time = None
+        self._periodic_task = None
+        # admission.AdmissionControl fed each datagram's handling time and polled with the
+        # periodic work, if the caller sets one
+        self.admission = None
+        for handler in (HeartbeatHandler(state), DataHandler(state), InitHandler(state)):
+            self.register(handler)
+
+    def register(self, handler):
+        self.handlers[handler.msg_type] = handler
+
+    # DatagramProtocol callbacks
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        started = time.perf_counter()
+        state = self.state
+        # the loop hands over one datagram per callback
+        state.m_rx_batch.observe(1)
+        profiler = state.profiler
+        if profiler is not None and profiler.sample():
+            reply = state.sampled(self._dispatch, data, addr)
+        else:
+            reply = self._dispatch(data, addr)
+        if reply is not None:
+            self.transport.sendto(reply, addr)
+        if profiler is not None and profiler.active:
+            profiler.mark('ack')
+            profiler.end()
+        if self.admission is not None:
+            self.admission.record(time.perf_counter() - started)
+
+    def _dispatch(self, data, addr):
+        length = len(data)
+        if length and data[0] == V2_MARKER:
+            # compact v2 frames have their own header and share the msg_type numbering
+            if not is_v2_frame(data, 0, length):
+                self.state.reserved_id_packets += 1
+                return None
+            _, version_type, dev = V2_PREFIX.unpack_from(data)
+            handler = self.handlers.get(version_type & 0x0F)
+            if handler is None:
+                return None
+            return handler.handle_v2(dev, data, length, addr, time.time())
+        if length < Header.Size:
+            return None
+        dev, seq, timestamp, msg_type, flags = HEADER_STRUCT.unpack_from(data)
+        handler = self.handlers.get(msg_type)
+        if handler is None:
+            return None
+        return handler.handle(dev, seq, timestamp, flags, data, length, addr, time.time())
+
+    def error_received(self, exc):
+        # ICMP errors for earlier replies (client gone); nothing to do
+        pass
+
+    # lifecycle
+    async def start(self, host, port, reuse_port=False):
+        loop = asyncio.get_running_loop()
+        self.start_time = time.time()
+        await loop.create_datagram_endpoint(lambda: self, local_addr=(host, port), reuse_port=reuse_port or None)
+        self._periodic_task = loop.create_task(self._periodic())
+
+    async def _periodic(self):
+        while True:
+            await asyncio.sleep(self.state.poll_timeout(self.tick_interval))
+            now = time.time()
+            self.state.release_due(now)
+            self.state.sink.tick()
+            self.state.evict_idle(now)
+            self.state.maybe_snapshot(int(time.time() - self.start_time), self.snapshot_points)
+            if self.admission is not None:
+                self.admission.poll()
+
+    async def run_for(self, duration):
+        """Serve until duration seconds after start(), then stop and final-flush."""
+        await asyncio.sleep(max(0.0, self.start_time + duration - time.time()))
+        self.close()
+
+    def close(self):
+        if self._periodic_task is not None:
+            self._periodic_task.cancel()
+            self._periodic_task = None
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+        self.state.flush_all()
@@ -0,0 +1,141 @@
+import os
+from collections import OrderedDict
+from reorder import ReorderWindow
+
+# seconds without DATA/heartbeat before a device's session is evicted
+SESSION_IDLE_TIMEOUT = float(os.getenv("SESSION_IDLE_TIMEOUT", 300))
+# hard cap on live sessions; the least recently active one is evicted first
+SESSION_MAX = int(os.getenv("SESSION_MAX", 100000))
+# evicted devices whose last written seq is remembered, so a returning device is not
+# charged the whole gap as loss (device_id is 16-bit, so this is bounded anyway)
+SESSION_TOMBSTONES = int(os.getenv("SESSION_TOMBSTONES", 65536))
+
+
+class DeviceSession(ReorderWindow):
+    """Everything the server keeps for one active device: reorder window plus activity."""
+
+    __slots__ = ('device_id', 'epoch', 'boot_id', 'wire', 'base_ms', 'last_seen', 'max_seq_seen', 'shed')
+
+    def __init__(self, device_id, now, epoch=0):
+        super().__init__()
+        self.device_id = device_id
+        self.epoch = epoch
+        self.boot_id = None
+        # negotiated wire version and v2 timestamp base (ms), both set by INIT
+        self.wire = 1
+        self.base_ms = None
+        self.last_seen = now
+        # seqs here are unwrapped (seqnum.unwrap), so they keep growing past 2**32
+        self.max_seq_seen = -1
+        # [first, end) seq ranges shed by admission control and not yet passed by the stream;
+        # allocated on the first shed packet
+        self.shed = None
+
+    def reset(self, epoch, boot_id=None):
+        """Start a new stream (device rebooted): forget seqs, keep nothing pending."""
+        self.epoch = epoch
+        self.boot_id = boot_id
+        self.last_written = -1
+        self.max_seq_seen = -1
+        self.pending.clear()
+        self.heap.clear()
+        self.dup_ring = None
+        self.shed = None
+
+    def note_shed(self, first, end):
+        shed = self.shed
+        if shed is None:
+            self.shed = [[first, end]]
+        elif shed[-1][1] == first:
+            # consecutive batches of one device extend the same range
+            shed[-1][1] = end
+        else:
+            shed.append([first, end])
+
+    def take_shed(self, lo, hi):
+        """How many seqs in [lo, hi) were shed; forgets ranges that end by hi."""
+        count = 0
+        keep = []
+        for first, end in self.shed:
+            count += max(0, min(end, hi) - max(first, lo))
+            if end > hi:
+                keep.append([first, end])
+        self.shed = keep or None
+        return count
+
+
+class SessionTable:
+    """device_id -> DeviceSession, kept in least-recently-active order.
+
+    get() creates or touches a session; evict_idle() and the SESSION_MAX cap hand back
+    sessions whose pending readings the caller must flush, then pass to remember() so
+    a returning device continues from its last written seq.
+    """
+
+    # sessions are created as session_class(dev, now); benchmarks swap in other buffers
+    session_class = DeviceSession
+
+    def __init__(self, idle_timeout=SESSION_IDLE_TIMEOUT, max_sessions=SESSION_MAX,
+                 max_tombstones=SESSION_TOMBSTONES):
+        self.idle_timeout = idle_timeout
+        self.max_sessions = max_sessions
+        self.max_tombstones = max_tombstones
+        self.sessions = OrderedDict()
+        self.tombstones = {}  # dev -> (epoch, boot_id, wire, base_ms, last_written)
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions.values()))
+
+    def get(self, dev, now):
+        """Session for dev, marked active at now. Returns (session, sessions evicted to make room)."""
+        session = self.sessions.get(dev)
+        if session is not None:
+            session.last_seen = now
+            self.sessions.move_to_end(dev)
+            return session, ()
+        session = self.session_class(dev, now)
+        tomb = self.tombstones.pop(dev, None)
+        if tomb is not None:
+            session.epoch, session.boot_id, session.wire, session.base_ms, session.last_written = tomb
+        self.sessions[dev] = session
+        evicted = ()
+        if self.max_sessions and len(self.sessions) > self.max_sessions:
+            evicted = [self._evict_oldest()]
+        return session, evicted
+
+    def touch(self, dev, now):
+        """Record activity (e.g. a heartbeat) for a device that already has a session."""
+        session = self.sessions.get(dev)
+        if session is not None:
+            session.last_seen = now
+            self.sessions.move_to_end(dev)
+        return session
+
+    def evict_idle(self, now):
+        """Remove and return sessions idle for longer than idle_timeout."""
+        evicted = []
+        sessions = self.sessions
+        cutoff = now - self.idle_timeout
+        while sessions:
+            oldest = next(iter(sessions.values()))
+            if oldest.last_seen > cutoff:
+                break
+            evicted.append(self._evict_oldest())
+        return evicted
+
+    def _evict_oldest(self):
+        _, session = self.sessions.popitem(last=False)
+        self.evicted += 1
+        return session
+
+    def remember(self, session):
+        """Keep the stream position of an evicted session; the oldest tombstone goes first."""
+        tombstones = self.tombstones
+        tombstones[session.device_id] = (session.epoch, session.boot_id, session.wire, session.base_ms,
+                                         session.last_written)
+        if len(tombstones) > self.max_tombstones:
+            del tombstones[next(iter(tombstones))]
@@ -0,0 +1,327 @@
+"""Deterministic client/server scenarios in virtual time.
+
+Runs the real client (TinyTelemetryV1_Client.client_thread and its heartbeat
+thread, so INIT negotiation, batching, the SACK window or stop-and-wait, and
+heartbeats are the shipped code) for every device against a real IngestState,
+over a loopback transport that applies the scenario's netem impairments. Nothing
+sleeps: the client takes its time and waits from a VirtualClock that runs one
+client thread at a time and jumps from one pending event to the next, so a
+70-second run of the three test scenarios takes a fraction of a second. All
+randomness (readings, boot ids, netem decisions) is seeded, and the output is
+the same on every run for a given seed. The only exception is the
+CPU_MS_PER_REPORT line, which is measured.
+
+    python3 simulate.py                                  # baseline, loss5, delay_jitter
+    python3 simulate.py loss5 --duration 600 --devices 1000 --seed 7
+    SIMULATE_LOSS=0.2 SIMULATE_DELAY_MS=50 python3 simulate.py env
+
+Each scenario writes packets.csv, metrics.txt and snapshots.jsonl to
+tests/sim/<scenario>/, in the same formats as the wall-clock test scripts. The
+client settings (CLIENT_BATCH_*, CLIENT_WIRE, CLIENT_SACK, CLIENT_SACK_WINDOW) and
+the server settings (REORDER_*, SESSION_*) are read from the environment as usual.
+"""
+import argparse, contextlib, heapq, io, os, random, threading, time
+from netem import NetemProfile, NetemScheduler, DEFAULT_REORDER
+from ingest import IngestState
+from sinks import CsvSink
+from Client import Client
+from eventlog import flush_log
+import TinyTelemetryV1_Client as client_mod
+from TinyTelemetryV1_Server import print_metrics, write_snapshots, snapshot_points
+from globals import server_IP, server_port
+
+# virtual wall-clock time of every run's start, so timestamps in the output repeat too
+SIM_EPOCH = 1700000000.0
+SIM_DIR = os.path.join('tests', 'sim')
+# the test scripts start the client once the server is listening
+CLIENT_START = 0.5
+# how often the server loop wakes without traffic
+SERVER_IDLE = 0.5
+# the test scripts' DURATION
+SIM_DURATION = 70
+
+SCENARIOS = {
+    'baseline': lambda: NetemProfile(),
+    'loss5': lambda: NetemProfile(enabled=True, loss=0.05),
+    # the test script's delay_jitter run leaves SIMULATE_REORDER at its default
+    'delay_jitter': lambda: NetemProfile(enabled=True, delay_ms=100, jitter_ms=10, reorder=DEFAULT_REORDER),
+    # SIMULATE_* variables, as read by the client
+    'env': NetemProfile.from_env,
+}
+
+
+class SimStop(BaseException):
+    """Unwinds a client thread still waiting when its simulation ends."""
+
+
+def _held_lock():
+    # a plain lock used as a binary semaphore: release() from one thread wakes acquire() in another
+    lock = threading.Lock()
+    lock.acquire()
+    return lock
+
+
+class SimThread:
+    __slots__ = ('go', 'token', 'done', 'stopping', 'error')
+
+    def __init__(self):
+        self.go = _held_lock()
+        self.token = None
+        self.done = False
+        self.stopping = False
+        self.error = None
+
+
+class VirtualClock:
+    """Event queue standing in for time.time() / sleep(); ties run in scheduling order.
+
+    Offers the calls of Client.SystemClock, so the client code runs on it unchanged.
+    spawn() starts a real thread, but only one runs at a time: a client thread runs
+    until it sleeps or waits, which schedules its wake-up and hands control back to
+    run(). A wait on a future or queue also ends early once the future resolves or
+    notify() is called for the queue.
+    """
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self.heap = []
+        self.counter = 0
+        self.current = None
+        self.threads = []
+        self.baton = _held_lock()
+        self.queue_waiters = {}  # id(queue) -> [(SimThread, token)]
+
+    def time(self):
+        return self.now
+
+    def call_at(self, when, fn, *args):
+        self.counter += 1
+        heapq.heappush(self.heap, (max(when, self.now), self.counter, fn, args))
+
+    def call_later(self, delay, fn, *args):
+        self.call_at(self.now + delay, fn, *args)
+
+    def run(self, until):
+        heap = self.heap
+        while heap and heap[0][0] <= until:
+            when, _, fn, args = heapq.heappop(heap)
+            self.now = when
+            fn(*args)
+        self.now = max(self.now, until)
+
+    # client threads
+    def spawn(self, target, *args):
+        t = SimThread()
+        self.threads.append(t)
+        threading.Thread(target=self._thread_main, args=(t, target, args), daemon=True).start()
+        t.token = token = object()
+        self.call_at(self.now, self._resume, t, token)
+
+    def _thread_main(self, t, target, args):
+        t.go.acquire()
+        try:
+            if not t.stopping:
+                target(*args)
+        except SimStop:
+            pass
+        except BaseException as e:
+            t.error = e
+        finally:
+            t.done = True
+            self.baton.release()
+
+    def _resume(self, t, token):
+        if t.token is not token or t.done:
+            return
+        t.token = None
+        self.current = t
+        t.go.release()
+        self.baton.acquire()
+        self.current = None
+        if t.error is not None:
+            raise t.error
+
+    def _park(self, deadline):
+        """Suspend the calling client thread until deadline or an earlier _resume with its token."""
+        t = self.current
+        if t.stopping:
+            raise SimStop
+        self.call_at(deadline, self._resume, t, t.token)
+        self.baton.release()
+        t.go.acquire()
+        if t.stopping:
+            raise SimStop
+
+    def _token(self):
+        t = self.current
+        t.token = token = object()
+        return t, token
+
+    def sleep(self, seconds):
+        self._token()
+        self._park(self.now + max(0.0, seconds))
+
+    def result(self, fut, timeout):
+        if not fut.done():
+            t, token = self._token()
+            fut.add_done_callback(lambda _: self.call_at(self.now, self._resume, t, token))
+            self._park(self.now + timeout)
+        return fut.result() if fut.done() else None
+
+    def get(self, q, timeout):
+        if q.empty():
+            t, token = self._token()
+            waiters = self.queue_waiters.setdefault(id(q), [])
+            waiters.append((t, token))
+            self._park(self.now + timeout)
+            if (t, token) in waiters:
+                waiters.remove((t, token))
+        return q.get_nowait()
+
+    def notify(self, q):
+        """Wake the client threads waiting in get() on q (call after putting to it)."""
+        for t, token in self.queue_waiters.pop(id(q), ()):
+            self.call_at(self.now, self._resume, t, token)
+
+    def close(self):
+        """Unwind the client threads that are still waiting."""
+        for t in self.threads:
+            if not t.done:
+                t.stopping = True
+                self.current = t
+                t.go.release()
+                self.baton.acquire()
+        self.current = None
+        self.threads = []
+
+
+class SimLink:
+    """A simulated device's socket: netem decides each datagram's fate, the Simulation delivers it.
+
+    Stands in for the client's NetemScheduler (client.netem) and counts what went out.
+    """
+
+    def __init__(self, sim, client, rng):
+        self.sim = sim
+        self.client = client
+        self.netem = NetemScheduler(None, sim.profile, rng=rng)
+        self.packets_sent = 0
+        self.retransmits = 0
+        self.data_seqs = set()
+
+    def send(self, packet, addr, tag=None):
+        deadlines = self.netem.plan(len(packet), self.sim.clock.now, tag)
+        for deadline in deadlines:
+            self.sim.deliver(deadline, packet, self.client)
+        self.packets_sent += len(deadlines)
+        if tag is not None:
+            # DATA is tagged with its first seq: a seq sent before is a retransmission
+            if tag in self.data_seqs:
+                self.retransmits += 1
+            self.data_seqs.add(tag)
+        return bool(deadlines)
+
+
+class Simulation:
+    """One scenario: devices, loopback transport and the server's IngestState on one VirtualClock."""
+
+    def __init__(self, profile, out_dir, duration=SIM_DURATION, devices=client_mod.CLIENT_DEVICES,
+                 seed=1):
+        self.profile = profile
+        self.out_dir = out_dir
+        self.duration = duration
+        self.clock = VirtualClock(SIM_EPOCH)
+        self.start = SIM_EPOCH
+        self.client_start = SIM_EPOCH + CLIENT_START
+        os.makedirs(out_dir, exist_ok=True)
+        self.csv_path = os.path.join(out_dir, 'packets.csv')
+        self.state = IngestState(CsvSink(open(self.csv_path, 'w', newline='')))
+        # devices beyond the client's own CLIENT_DEVICES run as further client processes of the same size
+        per_process = len(client_mod.CLIENT_DEVICES)
+        self.processes = [client_mod.ClientProcess(self.clock, duration, self.client_start)
+                          for _ in range((len(devices) + per_process - 1) // per_process)]
+        self.devices = []
+        for d in devices:
+            client = Client(d, None, 0, clock=self.clock, rng=random.Random(f"{seed}:{d}"))
+            client.netem = SimLink(self, client, random.Random(f"{seed}:{d}:netem"))
+            client.start_receiver((server_IP, server_port))
+            self.devices.append(client)
+
+    def deliver(self, at, packet, client):
+        self.clock.call_at(at, self.server_receive, packet, client)
+
+    def server_receive(self, packet, client):
+        now = self.clock.now
+        if now - self.start >= self.duration:
+            # the server has stopped; the datagram goes nowhere
+            return
+        reply = self.state.handle_packet(packet, now)
+        if reply is not None:
+            self.clock.call_at(now, self.client_receive, reply, client)
+
+    def client_receive(self, reply, client):
+        client.replies.dispatch(reply)
+        self.clock.notify(client.replies.acks)
+
+    def server_tick(self):
+        now = self.clock.now
+        state = self.state
+        state.release_due(now)
+        state.sink.tick()
+        state.evict_idle(now)
+        state.maybe_snapshot(int(now - self.start), snapshot_points)
+        if now - self.start < self.duration:
+            self.clock.call_later(state.poll_timeout(SERVER_IDLE), self.server_tick)
+
+    def run(self):
+        per_process = len(client_mod.CLIENT_DEVICES)
+        for i, client in enumerate(self.devices):
+            # processes start together; devices within one are staggered like the client's threads
+            self.clock.call_at(self.client_start + i % per_process * client_mod.CLIENT_STAGGER,
+                               self.clock.spawn, client_mod.client_thread, client, self.processes[i // per_process])
+        self.clock.call_at(self.start, self.server_tick)
+        self.clock.run(self.start + self.duration)
+        self.clock.close()
+        self.state.flush_all()
+        self.state.sink.close()
+
+        text = io.StringIO()
+        with contextlib.redirect_stdout(text):
+            print_metrics(self.state.counters())
+        with open(os.path.join(self.out_dir, 'metrics.txt'), 'w') as f:
+            f.write(text.getvalue())
+        with contextlib.redirect_stdout(io.StringIO()):
+            write_snapshots(os.path.join(self.out_dir, 'snapshots.jsonl'), self.state.snapshots,
+                            self.state.counters(), self.duration)
+        return text.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scenarios', nargs='*', default=['baseline', 'loss5', 'delay_jitter'],
+                        help=f"any of: {', '.join(SCENARIOS)}")
+    parser.add_argument('--duration', type=float, default=SIM_DURATION, help="virtual seconds per run")
+    parser.add_argument('--devices', type=int, help="number of devices (default: the client's 101-103)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', default=SIM_DIR, help="output root; each scenario gets a subdirectory")
+    args = parser.parse_args()
+
+    devices = range(101, 101 + args.devices) if args.devices else client_mod.CLIENT_DEVICES
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name!r}")
+        wall = time.perf_counter()
+        sim = Simulation(SCENARIOS[name](), os.path.join(args.out, name), args.duration, devices, args.seed)
+        metrics = sim.run()
+        wall = time.perf_counter() - wall
+        flush_log()
+        links = [c.netem for c in sim.devices]
+        print(f"\n[SIM] {name}: {len(sim.devices)} devices, {args.duration:g} s simulated in {wall:.2f} s, "
+              f"{sum(l.packets_sent for l in links)} datagrams delivered, "
+              f"{sum(l.netem.dropped for l in links)} dropped by netem, "
+              f"{sum(l.retransmits for l in links)} retransmits -> {sim.out_dir}")
+        print(metrics, end='')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,201 @@
+import csv, io, os, queue, threading, time
+
+# rows handed from the receive loop to the writer thread per batch
+SINK_BATCH_ROWS = int(os.getenv("SINK_BATCH_ROWS", 1024))
+# writer thread flushes the file once this many bytes are buffered or this much time passed
+SINK_FLUSH_BYTES = int(os.getenv("SINK_FLUSH_BYTES", 64 * 1024))
+SINK_FLUSH_MS = float(os.getenv("SINK_FLUSH_MS", 200))
+# batches waiting for the writer thread before the receive loop starts holding rows itself
+SINK_QUEUE_MAX = int(os.getenv("SINK_QUEUE_MAX", 256))
+# rows the receive loop holds while the queue is full; beyond this the held batch is dropped
+SINK_HOLD_ROWS = int(os.getenv("SINK_HOLD_ROWS", 4 * SINK_BATCH_ROWS))
+# seconds close() waits for the writer thread before giving up on what is still queued
+SINK_CLOSE_TIMEOUT = float(os.getenv("SINK_CLOSE_TIMEOUT", 30))
+# write errors printed individually; later ones are only counted
+SINK_ERRORS_SHOWN = 5
+
+CSV_HEADER = [
+    'device_id', 'seq_num', 'timestamp', 'value',
+    'duplicate_flag', 'gap_flag', 'arrival_time'
+]
+
+
+class BatchedSink:
+    """Reading output written by a background thread.
+
+    Rows are (device_id, seq_num, timestamp, value, duplicate_flag, gap_flag, arrival_time).
+    write() only appends to an in-memory batch; full batches (or batches older than
+    SINK_FLUSH_MS) go to a bounded queue. If the queue is full the batch stays with
+    the caller (counted in backpressure_events) up to SINK_HOLD_ROWS rows; past that,
+    or once the writer thread has died, it is dropped and counted in rows_dropped, so
+    the receive loop never blocks on disk and memory stays bounded. A batch the writer
+    cannot write is retried row by row and the rows that still fail are counted in
+    rows_failed. close() drains everything and fsyncs.
+
+    Subclasses implement _write_rows(batch) -> bytes written, _flush() and _close().
+    """
+
+    def __init__(self):
+        self.batch = []
+        self.batch_started = time.monotonic()
+        self.queue = queue.Queue(maxsize=SINK_QUEUE_MAX)
+        self.backpressure_events = 0
+        self.max_held_rows = 0
+        self.rows_written = 0
+        self.rows_dropped = 0
+        self.rows_failed = 0
+        self.errors = 0
+        # CPU spent in the writer thread, folded into CPU_MS_PER_REPORT
+        self.cpu_time = 0.0
+        # optional callback(seconds per row) for each written batch (profiling.py write stage)
+        self.write_observer = None
+        # optional rollup.RollupStore fed every written batch on the writer thread
+        self.rollup = None
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    # -------------------------
+    # Receive-loop side
+    # -------------------------
+    def write(self, row):
+        batch = self.batch
+        batch.append(row)
+        if len(batch) >= SINK_BATCH_ROWS:
+            self._hand_off()
+
+    def tick(self):
+        """Hand off a partial batch once it is older than SINK_FLUSH_MS."""
+        if self.batch and (time.monotonic() - self.batch_started) * 1000 >= SINK_FLUSH_MS:
+            self._hand_off()
+
+    def _hand_off(self):
+        try:
+            if not self.thread.is_alive():
+                raise queue.Full
+            self.queue.put_nowait(self.batch)
+        except queue.Full:
+            self.backpressure_events += 1
+            self.max_held_rows = max(self.max_held_rows, len(self.batch))
+            if len(self.batch) < SINK_HOLD_ROWS and self.thread.is_alive():
+                return
+            self.rows_dropped += len(self.batch)
+        self.batch = []
+        self.batch_started = time.monotonic()
+
+    def close(self):
+        deadline = time.monotonic() + SINK_CLOSE_TIMEOUT
+        for item in ([self.batch] if self.batch else []) + [None]:
+            try:
+                if not self.thread.is_alive():
+                    raise queue.Full
+                self.queue.put(item, timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Full:
+                if item:
+                    self.rows_dropped += len(item)
+        self.batch = []
+        self.thread.join(max(0.0, deadline - time.monotonic()))
+        if self.thread.is_alive():
+            print(f"[SINK] Writer thread did not finish within {SINK_CLOSE_TIMEOUT:g}s; "
+                  f"about {self.queue.qsize() * SINK_BATCH_ROWS} queued rows are lost")
+            return
+        self._close()
+        if self.rollup is not None:
+            self.rollup.close()
+        if self.rows_dropped or self.rows_failed:
+            print(f"[SINK] {self.rows_dropped} rows dropped (queue full or writer stopped), "
+                  f"{self.rows_failed} rows failed to write")
+
+    # -------------------------
+    # Writer thread
+    # -------------------------
+    def _writer(self):
+        unflushed = 0
+        last_flush = time.monotonic()
+        timeout = SINK_FLUSH_MS / 1000.0
+        while True:
+            try:
+                batch = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                batch = ()
+            if batch is None:
+                return
+            cpu_start = time.thread_time()
+            if batch:
+                observer = self.write_observer
+                started = time.perf_counter() if observer is not None else 0.0
+                try:
+                    unflushed += self._write_rows(batch)
+                except Exception as e:
+                    self._error('batch write', e)
+                    batch, size = self._write_each(batch)
+                    unflushed += size
+                self.rows_written += len(batch)
+                if observer is not None and batch:
+                    observer((time.perf_counter() - started) / len(batch))
+                if self.rollup is not None:
+                    try:
+                        self.rollup.add(batch)
+                    except Exception as e:
+                        self._error('rollup update', e)
+            try:
+                if self.rollup is not None:
+                    self.rollup.tick()
+                now = time.monotonic()
+                if unflushed and (unflushed >= SINK_FLUSH_BYTES or (now - last_flush) >= timeout):
+                    unflushed = 0
+                    last_flush = now
+                    self._flush()
+            except Exception as e:
+                self._error('flush', e)
+            self.cpu_time += time.thread_time() - cpu_start
+
+    def _write_each(self, batch):
+        """Write a batch that failed as a whole one row at a time; (rows written, bytes)."""
+        written, size = [], 0
+        for row in batch:
+            try:
+                size += self._write_rows([row])
+            except Exception as e:
+                self.rows_failed += 1
+                self._error(f"row {row!r}", e)
+                continue
+            written.append(row)
+        return written, size
+
+    def _error(self, what, e):
+        self.errors += 1
+        if self.errors <= SINK_ERRORS_SHOWN:
+            print(f"[SINK] {what} failed: {e!r}" + (" (further errors only counted)"
+                                                     if self.errors == SINK_ERRORS_SHOWN else ""))
+
+
+def fsync_and_close(f):
+    f.flush()
+    try:
+        os.fsync(f.fileno())
+    except (OSError, ValueError):
+        pass
+    f.close()
+
+
+class CsvSink(BatchedSink):
+    """PACKETS_CSV output: one text row per reading."""
+
+    def __init__(self, out_file):
+        self.out_file = out_file
+        self.path = getattr(out_file, 'name', None)
+        csv.writer(out_file).writerow(CSV_HEADER)
+        super().__init__()
+
+    def _write_rows(self, batch):
+        text = io.StringIO()
+        csv.writer(text).writerows(batch)
+        data = text.getvalue()
+        self.out_file.write(data)
+        return len(data)
+
+    def _flush(self):
+        self.out_file.flush()
+
+    def _close(self):
+        fsync_and_close(self.out_file)
@@ -0,0 +1,150 @@
+"""Columnar-friendly binary segment storage for readings.
+
+Each segment file is a 16-byte header followed by fixed-width little-endian records,
+so a segment can be memory-mapped as a NumPy structured array and sliced per column:
+
+    header:  magic b'TTS1', version u16, record_size u16, created f64
+    record:  device_id u16, seq_num u32, timestamp f64, value u16,
+             duplicate_flag u8, gap_flag u8, arrival_time f64      (26 bytes)
+
+timestamp is seconds with the millisecond resolution of wire v2 readings. Version 1
+segments (timestamp u32 whole seconds, 22-byte records) are still readable.
+
+Segments rotate once they reach SEGMENT_MAX_BYTES or SEGMENT_MAX_SECONDS.
+"""
+import glob, os, struct, time
+from sinks import BatchedSink, fsync_and_close
+
+SEGMENT_MAX_BYTES = int(os.getenv("SEGMENT_MAX_BYTES", 64 * 1024 * 1024))
+SEGMENT_MAX_SECONDS = float(os.getenv("SEGMENT_MAX_SECONDS", 3600))
+
+MAGIC = b'TTS1'
+VERSION = 2
+FILE_HEADER = struct.Struct('<4sHHd')
+RECORD = struct.Struct('<HIdHBBd')
+SEGMENT_SUFFIX = '.tts'
+
+COLUMNS = ('device_id', 'seq_num', 'timestamp', 'value', 'duplicate_flag', 'gap_flag', 'arrival_time')
+COLUMN_TYPES = ('<u2', '<u4', '<f8', '<u2', 'u1', 'u1', '<f8')
+# version -> column types of the segments written by that version
+VERSION_COLUMN_TYPES = {
+    1: ('<u2', '<u4', '<u4', '<u2', 'u1', 'u1', '<f8'),
+    2: COLUMN_TYPES,
+}
+
+
+class SegmentSink(BatchedSink):
+    """Writes readings to rotating segment files in directory.
+
+    Segment names are <prefix>-<created_ms>-<n>.tts; give each ingest worker its own
+    prefix so workers never share a file.
+    """
+
+    def __init__(self, directory, prefix='seg'):
+        self.directory = directory
+        self.prefix = prefix
+        self.path = directory
+        self.segment_index = 0
+        self.segment = None
+        self.segment_bytes = 0
+        self.segment_opened = 0.0
+        os.makedirs(directory, exist_ok=True)
+        super().__init__()
+
+    def _open_segment(self):
+        if self.segment is not None:
+            fsync_and_close(self.segment)
+        now = time.time()
+        name = f"{self.prefix}-{int(now * 1000)}-{self.segment_index:06d}{SEGMENT_SUFFIX}"
+        self.segment_index += 1
+        self.segment = open(os.path.join(self.directory, name), 'wb')
+        self.segment.write(FILE_HEADER.pack(MAGIC, VERSION, RECORD.size, now))
+        self.segment_bytes = FILE_HEADER.size
+        self.segment_opened = now
+
+    def _write_rows(self, batch):
+        if (self.segment is None or self.segment_bytes >= SEGMENT_MAX_BYTES
+                or time.time() - self.segment_opened >= SEGMENT_MAX_SECONDS):
+            self._open_segment()
+        out = bytearray(RECORD.size * len(batch))
+        pack_into = RECORD.pack_into
+        offset = 0
+        for row in batch:
+            pack_into(out, offset, *row)
+            offset += RECORD.size
+        self.segment.write(out)
+        self.segment_bytes += len(out)
+        return len(out)
+
+    def _flush(self):
+        if self.segment is not None:
+            self.segment.flush()
+
+    def _close(self):
+        if self.segment is not None:
+            fsync_and_close(self.segment)
+            self.segment = None
+
+
+# -------------------------
+# Reader
+# -------------------------
+def _numpy():
+    try:
+        import numpy as np
+    except ImportError as e:
+        raise ImportError("reading binary segments requires numpy (pip install numpy)") from e
+    return np
+
+
+def record_dtype(version=VERSION):
+    np = _numpy()
+    return np.dtype(list(zip(COLUMNS, VERSION_COLUMN_TYPES[version])))
+
+
+class SegmentReader:
+    """Memory-maps the segments in a directory and returns NumPy arrays per column."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, '*' + SEGMENT_SUFFIX)))
+
+    def map_segment(self, path):
+        np = _numpy()
+        with open(path, 'rb') as f:
+            magic, version, record_size, _created = FILE_HEADER.unpack(f.read(FILE_HEADER.size))
+        if magic != MAGIC or version not in VERSION_COLUMN_TYPES:
+            raise ValueError(f"{path}: not a telemetry segment (version {version})")
+        dtype = record_dtype(version)
+        if record_size != dtype.itemsize:
+            raise ValueError(f"{path}: record size {record_size} does not match version {version}")
+        count = (os.path.getsize(path) - FILE_HEADER.size) // dtype.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=dtype)
+        # a segment still being written may end in a partial record; shape= ignores it
+        return np.memmap(path, dtype=dtype, mode='r', offset=FILE_HEADER.size, shape=(count,))
+
+    def read(self, device_id=None, start=None, end=None, columns=COLUMNS):
+        """Readings for one device (or all) with start <= timestamp < end, as {column: array}."""
+        np = _numpy()
+        dtype = record_dtype()
+        parts = []
+        for path in self.segments():
+            records = self.map_segment(path)
+            if len(records) == 0:
+                continue
+            mask = np.ones(len(records), dtype=bool)
+            if device_id is not None:
+                mask &= records['device_id'] == device_id
+            if start is not None:
+                mask &= records['timestamp'] >= start
+            if end is not None:
+                mask &= records['timestamp'] < end
+            # older segments are widened to the current layout so they concatenate
+            parts.append(records[mask].astype(dtype, copy=False))
+        if not parts:
+            return {name: np.zeros(0, dtype=t) for name, t in zip(COLUMNS, COLUMN_TYPES) if name in columns}
+        merged = np.concatenate(parts)
+        return {name: np.ascontiguousarray(merged[name]) for name in columns}
@@ -0,0 +1,56 @@
+import math
+
+
+class TimerWheel:
+    """Hashed timer wheel: O(1) schedule, expiry checked one tick slot at a time.
+
+    Deadlines are rounded up to the next tick, so keys never fire early by more
+    than a tick's rounding; a deadline further out than the wheel's span simply
+    stays in its slot until its tick comes round. Keys are not deduplicated or
+    cancelled - callers ignore keys that are no longer due.
+    """
+
+    def __init__(self, tick=0.01, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.current = None  # next tick to examine
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, deadline, key):
+        t = math.ceil(deadline / self.tick)
+        if self.current is None:
+            self.current = t
+        elif t < self.current:
+            t = self.current
+        self.slots[t % len(self.slots)].append((t, key))
+        self.count += 1
+
+    def advance(self, now):
+        """Remove and return the keys whose deadline is <= now."""
+        expired = []
+        if not self.count:
+            self.current = None
+            return expired
+        target = math.floor(now / self.tick)
+        if target < self.current:
+            return expired
+        slots = self.slots
+        n = len(slots)
+        # a long pause visits each slot once rather than every missed tick
+        for t in range(self.current, self.current + min(target - self.current + 1, n)):
+            slot = slots[t % n]
+            if not slot:
+                continue
+            keep = []
+            for entry in slot:
+                if entry[0] <= target:
+                    expired.append(entry[1])
+                else:
+                    keep.append(entry)
+            slot[:] = keep
+        self.count -= len(expired)
+        self.current = target + 1
+        return expired
@@ -0,0 +1,193 @@
+"""Wire format v2: compact frames negotiated in the INIT exchange.
+
+v1 (headers.Header) spends 12 header bytes per packet and 2 per reading, with a
+1-second timestamp shared by the whole batch. v2 keeps INIT in v1 framing and
+negotiates there; afterwards the device sends compact frames:
+
+    u8   0xFF marker (v1 device_ids 0xFF00-0xFFFF are reserved for it; the server drops
+         and counts v1 frames from those ids, except 0xFF20/0xFF21, which look like v2)
+    u8   version << 4 | msg_type
+    u16  device_id
+    DATA only:
+    u8   flags (FLAG_DANGER / FLAG_SACK as in v1, plus V2_VALUE_DELTA)
+    var  seq of the first reading (readings are consecutive, as in v1 batches)
+    per reading, up to the end of the datagram:
+    var  timestamp: the first as ms since the session base from INIT, the second as ms
+         since the first, then zigzag(interval - previous interval) - regular sampling
+         makes these 1 byte
+    var  value: as is, or with V2_VALUE_DELTA zigzag(value - previous value); the
+         encoder picks whichever is shorter for the batch
+
+var = unsigned LEB128 varint. A heartbeat is the 4-byte prefix only.
+
+INIT (v1 header, msg_type 2) payload: boot id u32, then optionally the highest wire
+version the device speaks (u8) and its session base time in ms (u64). A server that
+understands it answers INIT_ACK (type 6 + the version to use), also when only v1 is
+offered, and the device repeats INIT until it does; a device that gets no answer
+stays on v1.
+"""
+import struct
+from headers import Header, INIT_STRUCT
+
+V2_MARKER = 0xFF
+V1_DEVICE_MAX = (V2_MARKER << 8) - 1      # v1 device ids above this would read as v2 frames
+WIRE_V1 = 1
+WIRE_V2 = 2
+WIRE_MAX = WIRE_V2
+
+MSG_INIT_ACK = 6
+INIT_V2_STRUCT = struct.Struct('!IBQ')    # boot id, max wire version, base time ms
+INIT_ACK_STRUCT = struct.Struct('!BB')    # MSG_INIT_ACK, wire version
+V2_PREFIX = struct.Struct('!BBH')         # marker, version << 4 | msg_type, device_id
+V2_DATA_PREFIX = struct.Struct('!BBHB')   # ... + flags
+V2_VALUE_DELTA = 0x80                     # DATA flag: values are delta-coded
+VALUE_MAX = 0xFFFF                        # readings are u16, as in v1 and the sinks
+
+
+def encode_varint(n, out):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def decode_varint(buf, pos):
+    """(value, next position) for the varint at buf[pos]."""
+    b = buf[pos]
+    if b < 0x80:
+        return b, pos + 1
+    result = b & 0x7F
+    shift = 7
+    while True:
+        pos += 1
+        b = buf[pos]
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos + 1
+        shift += 7
+
+
+def varint_size(n):
+    size = 1
+    while n >= 0x80:
+        n >>= 7
+        size += 1
+    return size
+
+
+def zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def unzigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def is_v2_frame(buf, offset, length):
+    """True if buf[offset:offset + length] is a v2 heartbeat or DATA frame.
+
+    A datagram led by the marker that fails this is a v1 frame from a reserved device id.
+    """
+    return (length >= V2_PREFIX.size and buf[offset] == V2_MARKER
+            and buf[offset + 1] in (WIRE_V2 << 4, WIRE_V2 << 4 | 1))
+
+
+def device_id_of(buf, offset=0):
+    """device_id of a v1 or v2 datagram (the v2 marker shifts it by 2 bytes)."""
+    if buf[offset] == V2_MARKER:
+        offset += 2
+    return (buf[offset] << 8) | buf[offset + 1]
+
+
+# -------------------------
+# Encoding (device side)
+# -------------------------
+def encode_init(device_id, boot_id, base_ms, version=WIRE_MAX):
+    return Header(device_id=device_id, msg_type=2).Pack_Init() + INIT_V2_STRUCT.pack(boot_id, version, base_ms)
+
+
+def encode_heartbeat(device_id):
+    return V2_PREFIX.pack(V2_MARKER, WIRE_V2 << 4 | 0, device_id)
+
+
+def encode_data(device_id, seq, flags, base_ms, stamps_ms, values):
+    """v2 DATA frame; stamps_ms are absolute ms times, one per value, non-decreasing."""
+    deltas = [zigzag(b - a) for a, b in zip(values, values[1:])]
+    delta_coded = bool(values) and (varint_size(values[0]) + sum(map(varint_size, deltas))
+                                    < sum(map(varint_size, values)))
+    if delta_coded:
+        flags |= V2_VALUE_DELTA
+    out = bytearray(V2_DATA_PREFIX.pack(V2_MARKER, WIRE_V2 << 4 | 1, device_id, flags))
+    encode_varint(seq, out)
+    prev_ts = base_ms
+    interval = 0
+    for i, (ts, value) in enumerate(zip(stamps_ms, values)):
+        gap = max(0, ts - prev_ts)
+        # offset from the base, then the first interval, then interval changes
+        encode_varint(gap if i < 2 else zigzag(gap - interval), out)
+        if i:
+            interval = gap
+        prev_ts = ts
+        encode_varint(deltas[i - 1] if delta_coded and i else value, out)
+    return bytes(out)
+
+
+# -------------------------
+# Decoding (server side)
+# -------------------------
+def parse_init(buf, offset, length):
+    """(boot_id, wire version, base_ms) from an INIT; missing fields are None / WIRE_V1."""
+    payload = offset + Header.Size
+    if length >= Header.Size + INIT_V2_STRUCT.size:
+        boot_id, version, base_ms = INIT_V2_STRUCT.unpack_from(buf, payload)
+        return boot_id, version, base_ms
+    if length >= Header.Size + INIT_STRUCT.size:
+        return INIT_STRUCT.unpack_from(buf, payload)[0], WIRE_V1, None
+    return None, WIRE_V1, None
+
+
+def decode_data(buf, offset, length, base_ms):
+    """(device_id, flags, seq, stamps_ms, values) of a v2 DATA frame at buf[offset:offset + length].
+
+    Raises IndexError/ValueError on a truncated or malformed frame, including one
+    whose values fall outside 0..VALUE_MAX.
+    """
+    _, vt, dev, flags = V2_DATA_PREFIX.unpack_from(buf, offset)
+    end = offset + length
+    pos = offset + V2_DATA_PREFIX.size
+    seq, pos = decode_varint(buf, pos)
+    delta_coded = flags & V2_VALUE_DELTA
+    stamps, values = [], []
+    ts, interval, value = base_ms, 0, 0
+    i = 0
+    while pos < end:
+        # inline varint fast path: fields usually fit one byte
+        b = buf[pos]
+        if b < 0x80:
+            pos += 1
+        else:
+            b, pos = decode_varint(buf, pos)
+        if i < 2:
+            gap = b
+        else:
+            gap = interval + ((b >> 1) ^ -(b & 1))
+        if i:
+            interval = gap
+        ts += gap
+        b = buf[pos]
+        if b < 0x80:
+            pos += 1
+        else:
+            b, pos = decode_varint(buf, pos)
+        if delta_coded and i:
+            value += (b >> 1) ^ -(b & 1)
+        else:
+            value = b
+        stamps.append(ts)
+        values.append(value)
+        i += 1
+    if pos > end:
+        raise ValueError("truncated v2 frame")
+    if values and (min(values) < 0 or max(values) > VALUE_MAX):
+        raise ValueError("v2 reading outside 0..65535")
+    return dev, flags & ~V2_VALUE_DELTA, seq, stamps, values